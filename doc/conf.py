@@ -14,7 +14,7 @@ autodoc_default_flags = ["members", "undoc-members", "private-members",
 autodoc_member_order = "bysource"
 
 intersphinx_mapping = {'python': ('https://docs.python.org/3.5', None),
-                       'sqlalchemy': ('http://docs.sqlalchemy.org/en/rel_1_0', None)}
+                       'sqlalchemy': ('http://docs.sqlalchemy.org/en/14', None)}
 
 master_doc = "index"
 
@@ -13,13 +13,17 @@ TODO: write more here
 """
 from IPython.display import display
 import abc
+import collections
 import collections.abc
+import itertools
 import json
+import random
 from io import StringIO
 
 from ipywidgets import Label, Button, VBox, HBox, Tab, HTML
 
 import lovett.tree
+import lovett.util
 from lovett.ilovett import TreeWidget
 import lovett.format
 from lovett.format import Json
@@ -70,6 +74,21 @@ def _build_tree_view(corpus):
     return vbox
 
 
+#: A node matching a query, as returned by `CorpusBase.matching_nodes`.  For a
+#: `ListCorpus`, ``root`` is the index of the tree in the corpus and ``node``
+#: is the path to the node from the root, as a tuple of child indices.  For a
+#: `lovett.db.CorpusDb`, they are the database ids of the root and the node.
+NodeMatch = collections.namedtuple("NodeMatch", ["root", "node"])
+
+
+def _nodes_with_paths(t, path=()):
+    """Generate the nodes of a tree in preorder, with their paths."""
+    yield path, t
+    if not lovett.util.is_leaf(t):
+        for i, child in enumerate(t):
+            yield from _nodes_with_paths(child, path + (i,))
+
+
 class CorpusBase(collections.abc.Sequence, metaclass=abc.ABCMeta):
     """A base class for corpora.
 
@@ -100,20 +119,32 @@ class CorpusBase(collections.abc.Sequence, metaclass=abc.ABCMeta):
     """
 
     @abc.abstractmethod
-    def matching_trees(query):
+    def matching_trees(self, query, limit=None, offset=0, sample=None, seed=None):
         """Return the trees from this corpus that match a query.
 
         The query is matched to the trees recursively: if any internal node of
         the tree matches the query, then the whole tree is returned.
 
-        .. note:: TODO
-
-            Currently this function just returns the root trees containing a
-            match, not the matched subtrees themselves.  The latter
-            functionality might also prove useful...
+        This function returns the root trees containing a match; see
+        `matching_nodes` for the matched subtrees themselves.
 
         Args:
             query (Query): The query to match.
+            limit (int): If given, return at most this many trees.
+            offset (int): The number of matching trees to skip.  Together
+                with ``limit``, this allows paging through the results.  A
+                `CorpusDb` only avoids finding all the matches for queries
+                whose matches it finds in order, such as text and metadata
+                queries; for others (e.g. structural conjunctions) the first
+                page finds and caches all the matches, and later pages are
+                read from the cache.
+            sample (int): If given, return a random sample of this many of
+                the matching trees (or all of them, if there are fewer),
+                in corpus order.  Trees are tested in a random order until
+                enough matches have been found, so this is much faster than
+                finding all the matches when there are many.  It cannot be
+                combined with ``limit`` or ``offset``.
+            seed: The seed of the random sample, to make it reproducible.
 
         Returns:
             ResultSet: The matching trees.
@@ -129,13 +160,58 @@ class CorpusBase(collections.abc.Sequence, metaclass=abc.ABCMeta):
         # be an optimization
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def matching_nodes(self, query):
+        """Return the nodes from this corpus that match a query.
+
+        Args:
+            query (Query): The query to match.
+
+        Returns:
+            list of NodeMatch: The matching nodes, in corpus order and
+            preorder within each tree.  Use `subtree` to get the subtree of a
+            match.
+
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def subtree(self, match):
+        """Return the subtree of a node returned by `matching_nodes`.
+
+        Args:
+            match (NodeMatch): The match.
+
+        Returns:
+            Tree
+
+        """
+        raise NotImplementedError
+
+    def iter_matches(self, query):
+        """Iterate over the trees from this corpus that match a query.
+
+        Unlike `matching_trees`, the trees are generated as they are found.
+
+        Args:
+            query (Query): The query to match.
+
+        Yields:
+            Tree: The matching trees, in order.
+
+        """
+        for t in self:
+            if any(query.match_tree(node) for node in t.nodes()):
+                yield t
+
     def to_db(self, **kwargs):
         """Return a `CorpusDb` object containing the trees from the corpus."""
         import lovett.db as db
         if isinstance(self, db.CorpusDb):
             return self
         db = db.CorpusDb(**kwargs)
-        db.insert_trees(self)
+        with db.bulk_loading():
+            db.insert_trees(self)
         return db
 
     def to_corpus(self):
@@ -224,10 +300,134 @@ class ListCorpus(CorpusBase):
     def __len__(self):
         return len(self._trees)
 
-    def matching_trees(self, query):
-        return ResultSet([t for t in self if any(query.match_tree(node) for node in t.nodes())],
-                         query,
-                         metadata=self._metadata)
+    def matching_trees(self, query, limit=None, offset=0, sample=None, seed=None):
+        if sample is not None:
+            _check_sample(sample, limit, offset)
+            trees = self._sample_matches(query, sample, seed)
+        else:
+            stop = None if limit is None else offset + limit
+            trees = itertools.islice(self.iter_matches(query), offset, stop)
+        return ResultSet(ListCorpus(trees, metadata=self._metadata), query)
+
+    def _sample_matches(self, query, n, seed):
+        """Return a random sample of the trees which match a query.
+
+        Args:
+            query (QueryFunction): The query.
+            n (int): The size of the sample.
+            seed: The seed of the random number generator.
+
+        Returns:
+            list of Tree: The sample, in corpus order.
+
+        """
+        rng = random.Random(seed)
+        found = []
+        for i in lovett.util._random_order(len(self), rng):
+            if len(found) == n:
+                break
+            if any(query.match_tree(node) for node in self[i].nodes()):
+                found.append(i)
+        return [self[i] for i in sorted(found)]
+
+    def _combine(self, other, op):
+        """Combine the trees of two corpora like sets.
+
+        Trees are identified by identity, so this is only meaningful for
+        results from the same corpus.  This is used by the set operations of
+        `ResultSet`.
+
+        Args:
+            other (ListCorpus): The other corpus.
+            op (str): The operation: ``"&"``, ``"|"``, ``"-"`` or ``"^"``.
+
+        Returns:
+            ListCorpus: The trees of the result: those from this corpus, in
+            order, followed by those only in ``other``.
+
+        """
+        if not isinstance(other, ListCorpus):
+            raise ValueError("Only results from the same corpus can be combined")
+        mine = set(map(id, self._trees))
+        theirs = set(map(id, other._trees))
+        if op == "&":
+            trees = [t for t in self._trees if id(t) in theirs]
+        elif op == "|":
+            trees = self._trees + [t for t in other._trees if id(t) not in mine]
+        elif op == "-":
+            trees = [t for t in self._trees if id(t) not in theirs]
+        else:
+            trees = [t for t in self._trees if id(t) not in theirs] + \
+                [t for t in other._trees if id(t) not in mine]
+        return ListCorpus(trees, metadata=self._metadata)
+
+    def count(self, query):
+        """Return the number of trees which match a query.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            int
+
+        """
+        return sum(1 for t in self if any(query.match_tree(node) for node in t.nodes()))
+
+    def count_nodes(self, query):
+        """Return the number of nodes which match a query.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            int
+
+        """
+        return sum(1 for t in self for node in t.nodes() if query.match_tree(node))
+
+    def matching_nodes(self, query):
+        return [NodeMatch(i, path) for i, t in enumerate(self)
+                for path, node in _nodes_with_paths(t) if query.match_tree(node)]
+
+    def subtree(self, match):
+        t = self[match.root]
+        for i in match.node:
+            t = t[i]
+        return t
+
+    def group_counts(self, query, by="file", trees=False):
+        """Count the matches of a query in groups.
+
+        See `lovett.db.CorpusDb.group_counts` for the meaning of the
+        arguments.
+
+        Returns:
+            collections.Counter: A mapping from groups to counts.
+
+        """
+        if by not in ("file", "label"):
+            key = lovett.tree._check_metadata_name(by)
+        counts = collections.Counter()
+        for t in self:
+            groups = set()
+            for node in t.nodes():
+                if not query.match_tree(node):
+                    continue
+                if by == "file":
+                    group = t.metadata.get("FILE")
+                elif by == "label":
+                    group = node.label
+                else:
+                    group = node.metadata.get(key, t.metadata.get(key))
+                    if group is not None:
+                        # As the value would be read back from a database
+                        group = lovett.util._metadata_str_to_py(lovett.util._metadata_py_to_str(group))
+                if trees:
+                    groups.add(group)
+                else:
+                    counts[group] += 1
+            counts.update(groups)
+        return counts
 
 
 class Corpus(ListCorpus, collections.abc.MutableSequence):
@@ -269,10 +469,19 @@ class ResultSet(CorpusBase):
     It arranges for the original query to be displayed in the IPython
     notebook, and for matching tree nodes to be highlighted.
 
+    Result sets from the same corpus can be combined like sets, with ``&``
+    (trees in both), ``|`` (trees in either), ``-`` (trees in the first but
+    not the second) and ``^`` or `symmetric_difference` (trees in exactly
+    one), without running any query again.  For a `lovett.db.CorpusDb`, this
+    takes time linear in the number of results.
+
     """
     def __init__(self, backing, query, metadata=None):
         self._backing = backing
         self._query = query
+        # The query whose matches in the trees are the results; for a
+        # combination of result sets, `_query` is only a description
+        self._match_query = query
 
     def __getitem__(self, i):
         return self._backing[i]
@@ -280,8 +489,98 @@ class ResultSet(CorpusBase):
     def __len__(self):
         return len(self._backing)
 
-    def matching_trees(self, query):
-        return self._backing.matching_trees(query)
+    def __iter__(self):
+        return iter(self._backing)
+
+    def _combine(self, other, op):
+        if not isinstance(other, ResultSet):
+            return NotImplemented
+        result = ResultSet(self._backing._combine(other._backing, op),
+                           "(%s %s %s)" % (self._query, op, other._query))
+        if op == "-":
+            result._match_query = self._match_query
+        else:
+            result._match_query = self._match_query | other._match_query
+        return result
+
+    def __and__(self, other):
+        return self._combine(other, "&")
+
+    def __or__(self, other):
+        return self._combine(other, "|")
+
+    def __sub__(self, other):
+        return self._combine(other, "-")
+
+    def __xor__(self, other):
+        return self._combine(other, "^")
+
+    def symmetric_difference(self, other):
+        """Return the trees in exactly one of two result sets.
+
+        Args:
+            other (ResultSet): The other result set.
+
+        Returns:
+            ResultSet
+
+        """
+        if not isinstance(other, ResultSet):
+            raise TypeError("Can only combine a ResultSet with another ResultSet")
+        return self ^ other
+
+    def matching_trees(self, query, limit=None, offset=0, sample=None, seed=None):
+        return self._backing.matching_trees(query, limit, offset, sample, seed)
+
+    def matching_nodes(self, query):
+        return self._backing.matching_nodes(query)
+
+    def subtree(self, match):
+        return self._backing.subtree(match)
+
+    def to_db(self, filename=None):
+        """Return a `CorpusDb` object containing the trees of the result set.
+
+        If the results come from a `lovett.db.CorpusDb` and a filename is
+        given, the trees are copied straight from one database file to the
+        other (see `lovett.db.CorpusDb.extract`), which is much faster than
+        reconstituting and reinserting them.
+
+        Args:
+            filename (str): The file to store the new database in.  If
+                omitted, it is kept in memory.
+
+        """
+        import lovett.db as db
+        if isinstance(self._backing, db.CorpusDb) and filename is not None:
+            return self._backing.extract(filename)
+        return super().to_db(filename=filename)
+
+    def save(self, name):
+        """Save the matches of this result set under a name.
+
+        They can then be used in later queries with `lovett.query.in_result`.
+        See `lovett.db.CorpusDb.save_results`.
+
+        Args:
+            name (str): The name.
+
+        """
+        if isinstance(self._backing, ListCorpus):
+            raise TypeError("Only results from a CorpusDb can be saved")
+        self._backing.save_results(name, self._match_query)
+
+    def iter_matches(self, query):
+        return self._backing.iter_matches(query)
+
+    def count(self, query):
+        return self._backing.count(query)
+
+    def count_nodes(self, query):
+        return self._backing.count_nodes(query)
+
+    def group_counts(self, query, by="file", trees=False):
+        return self._backing.group_counts(query, by, trees)
 
     # TODO
     # @property
@@ -289,7 +588,7 @@ class ResultSet(CorpusBase):
     #     return self._backing.metadata
 
     def __repr__(self):
-        return "%d results of query \"%s\"" % (len(self._trees), self._query)
+        return "%d results of query \"%s\"" % (len(self), self._query)
 
     def __str__(self):
         return repr(self)
@@ -298,6 +597,14 @@ class ResultSet(CorpusBase):
     # node vs showing entire tree
 
 
+def _check_sample(sample, limit, offset):
+    """Check the arguments of a sampling `CorpusBase.matching_trees`."""
+    if sample < 0:
+        raise ValueError("sample must not be negative")
+    if limit is not None or offset != 0:
+        raise ValueError("sample cannot be combined with limit or offset")
+
+
 # TODO: rename to from_handle to better respect the working...or add
 # "from_path" fn for the other case
 def from_file(fin, fmt):
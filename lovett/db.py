@@ -6,7 +6,8 @@ as a regular `Corpus` object: a sequence of trees.  There are some differences
 however:
 
 * The corpus is immutable.  It is only possible to append new trees to the end
-  of the corpus (and in normal use even this should not be done).
+  of the corpus.  This also works for a corpus saved to a file, which can be
+  reopened later to add e.g. a newly parsed text without re-indexing the rest.
 * The `CorpusBase.matching_trees` method for searching by evaluating a
   `QueryFunction` against the corpus is significantly optimized by the
   database engine.
@@ -14,18 +15,452 @@ however:
 """
 
 import sqlalchemy
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, MetaData, Index
-from sqlalchemy.sql import select
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, MetaData, Index, LargeBinary, Float
+from sqlalchemy.sql import select, bindparam, text
+from sqlalchemy.schema import CreateIndex, DropIndex
 import sqlalchemy.event
+import sqlalchemy.util
+import array
+import bisect
+import collections
+import contextlib
+import hashlib
+import itertools
+import multiprocessing
+import os
 import pathlib
+import queue
+import random
+import re
+import threading
+import time
 
 import lovett.util as util
 import lovett.corpus as corpus
 import lovett.tree as tree
+import lovett.planner as planner
+import lovett.debug as debug
 
 
 def _sqlite_pragmas(dbapi_conn, conn_record):
     dbapi_conn.execute("PRAGMA case_sensitive_like=ON;")
+    dbapi_conn.create_function("REGEXP", 2, _regexp, deterministic=True)
+
+
+def _regexp(pattern, string):
+    """Implement SQLite's ``REGEXP`` operator.
+
+    SQLite evaluates ``X REGEXP Y`` as ``regexp(Y, X)``, so the pattern comes
+    first.  Compiled patterns are cached by the `re` module.
+
+    Args:
+        pattern (str): The regular expression.
+        string (str): The string to search.
+
+    Returns:
+        bool: Whether the pattern matches anywhere in the string.
+
+    """
+    if string is None:
+        return None
+    return re.search(pattern, string) is not None
+
+
+#: The default number of query results which a `CorpusDb` caches in memory.
+RESULT_CACHE_SIZE = 128
+
+#: The default number of query results which a file-backed `CorpusDb` caches
+#: in the database file.  Unlike the in-memory cache, this cache is first in,
+#: first out (see `CorpusDb._cached_roots`).
+RESULT_CACHE_DB_SIZE = 1024
+
+#: The default largest number of trees in a query result which a file-backed
+#: `CorpusDb` caches in the database file.
+RESULT_CACHE_MAX_ROOTS = 1000000
+
+#: The number of compiled statements which a `CorpusDb` keeps for reuse
+#: (shared by its connections and clones).
+COMPILED_CACHE_SIZE = 500
+
+#: The default number of trees whose rows a `CorpusDb` caches in memory.
+TREE_CACHE_SIZE = 256
+
+#: The default number of trees which `CorpusDb.iter_trees` fetches per query.
+ITER_BATCH_SIZE = 200
+
+#: `CorpusDb.matching_trees` samples by testing random trees only if the
+#: query is estimated to match at least this many times as many nodes as are
+#: sampled; otherwise it samples from all the matching trees.
+SAMPLE_MIN_RATIO = 10
+
+#: The version of the database schema, stored in the ``info`` table.  It must
+#: be increased whenever the tables change; `CorpusDb` refuses to open a file
+#: written with a different version.
+SCHEMA_VERSION = 2
+
+#: Statistics of the tree cache of a `CorpusDb`, returned by
+#: `CorpusDb.cache_info` (after `functools.lru_cache`).
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+#: Pragmas which `CorpusDb.bulk_loading` sets while loading, as (name, value)
+#: pairs.  Durability is traded for speed: the rollback journal is kept in
+#: memory and writes are not synced to disk, so a crash during a bulk load can
+#: leave the database file corrupt.
+_BULK_LOAD_PRAGMAS = (("journal_mode", "MEMORY"),
+                      ("synchronous", "OFF"),
+                      # Negative values are in KiB, i.e. a 128MiB page cache
+                      ("cache_size", "-131072"),
+                      ("temp_store", "MEMORY"))
+
+
+def _empty_rows():
+    """Return an empty set of rows for `_flatten_node`."""
+    return {"nodes": [], "dom": [], "sprec": [], "metadata": [], "roots": [],
+            "texts": [], "leaves": [], "leaf_fts": []}
+
+
+#: The positions of node ids in the row tuples of each table, for
+#: `_shift_rows`.
+_ID_COLUMNS = {"nodes": (0,),
+               "dom": (0, 1),
+               "sprec": (0, 1),
+               "metadata": (0,),
+               "roots": (0, 2),
+               "texts": (),
+               "leaves": (0, 1),
+               "leaf_fts": (0,)}
+
+#: The tokenizer of the full-text index of leaves.  Case is folded, but
+#: diacritics are kept, since they are distinctive in many languages.  The
+#: extra token characters keep words such as IcePaHC's ``$a`` whole.  (The
+#: same tokenization is approximated by `lovett.query._word_regex`.)
+FTS_TOKENIZE = "unicode61 remove_diacritics 0 tokenchars '-$@+'"
+
+#: The columns of the ``texts`` table, and the root metadata keys which they
+#: are filled from (see `_flatten_tree`).
+TEXT_COLUMNS = (("year", "YEAR"), ("author", "AUTHOR"), ("genre", "GENRE"))
+
+
+def _flatten_metadata(rows, node_id, dic, prefix=""):
+    """Convert the metadata of a node into rows for the database.
+
+    Metadata are represented in a table with columns ``id``, ``key``,
+    ``value``, and ``num``.  Nested metadata values are converted into a
+    string key for the database by joining their key path with ``:``.  The
+    `_metadata_py_to_str` function is used to translate metadata values into
+    strings.  Values which are integers are additionally stored in the
+    ``num`` column (see `_metadata_py_to_num`), so that they can be compared
+    numerically.
+
+    Args:
+        rows (dict): The rows being accumulated (see `_flatten_node`).
+        node_id (int): The database id of the node to which the metadata are
+            affiliated.
+        dic (Metadata): Metadata to insert.
+        prefix (str): The key path at which to insert this metadata.
+
+    """
+    for key, val in dic.items():
+        if key in util.INTERNAL_METADATA_KEYS:
+            continue
+        if isinstance(val, tree.Metadata):
+            _flatten_metadata(rows, node_id, val, prefix + key + ":")
+        else:
+            rows["metadata"].append((node_id, prefix + key,
+                                     util._metadata_py_to_str(val),
+                                     util._metadata_py_to_num(val)))
+
+
+def _flatten_node(rows, node, rowid, parents=(), lefts=()):
+    """Convert a node and its descendants into rows for the database.
+
+    Nodes are numbered consecutively in preorder, starting from ``rowid``.
+    This function does not touch the database, so that it can be run in a
+    worker process (see `CorpusDb.ingest`).
+
+    Args:
+        rows (dict): A mapping from table names to lists of row tuples, to
+            which the rows for this node are appended (see `_empty_rows`).
+            The tuples list the values in the order of the table's columns.
+        node (Tree): The node to be converted.
+        rowid (int): The database id to assign to the node.
+        parents (tuple): The database ids of the ancestor nodes, if any,
+            in ascending order (immediate parent = element 0)
+        lefts (tuple): The database ids of the left siblings, if any, in
+            right-to-left order (the immediate left sibling = element 0)
+
+    Returns:
+       int: the next database id not used by this node or its descendants.
+
+    """
+    rows["nodes"].append((rowid, node.label))
+    # Add it to the dominance_R table: a depth-0 self-dominance relation...
+    rows["dom"].append((rowid, rowid, 0))
+    # ...as well as dominance relations for all the node's parents (+1
+    # because enumerate counts from 0)
+    rows["dom"].extend((p, rowid, d + 1) for d, p in enumerate(parents))
+    # Add it to the sprecedes_R table; see comments above for explanation of
+    # the parts
+    rows["sprec"].append((rowid, rowid, 0))
+    rows["sprec"].extend((l, rowid, d + 1) for d, l in enumerate(lefts))
+    next_id = rowid + 1
+    if util.is_leaf(node):
+        # Add its text to the metadata db...
+        rows["metadata"].append((rowid, "text", node.text, None))
+    else:
+        # ...or add its children to the db, as applicable
+        p = (rowid,) + parents
+        lastchild_rowids = ()
+        for child in node:
+            child_id = next_id
+            next_id = _flatten_node(rows, child, child_id, p, lastchild_rowids)
+            lastchild_rowids = (child_id,) + lastchild_rowids
+    _flatten_metadata(rows, rowid, node.metadata)
+    return next_id
+
+
+def _flatten_tree(rows, t, rowid):
+    """Convert a tree into rows for the database.
+
+    In addition to the rows from `_flatten_node`, the tree's root is recorded
+    in the ``roots`` table along with its file and the id of its last node,
+    its words (leaves other than empty categories) are numbered for the
+    ``leaves`` table and the full-text index, and the text-level metadata of its file (see `TEXT_COLUMNS`) are recorded
+    in the ``texts`` table.
+
+    Args:
+        rows (dict): The rows being accumulated (see `_flatten_node`).
+        t (Tree): The tree to convert.
+        rowid (int): The database id to assign to its root.
+
+    Returns:
+       int: the next database id not used by the tree.
+
+    """
+    next_id = _flatten_node(rows, t, rowid)
+    rows["roots"].append((rowid, t.metadata.file, next_id - 1))
+    # Nodes are numbered in preorder, the order of Tree.nodes
+    position = 0
+    for node_id, node in enumerate(t.nodes(), rowid):
+        if util.means_leaf(node):
+            rows["leaves"].append((node_id, rowid, position))
+            rows["leaf_fts"].append((node_id, node.text, node.metadata.get("LEMMA")))
+            position += 1
+    if t.metadata.file is not None:
+        values = [t.metadata.get(key) for _, key in TEXT_COLUMNS]
+        values[0] = util._metadata_py_to_num(values[0])
+        rows["texts"].append((t.metadata.file,) + tuple(values))
+    return next_id
+
+
+def _shift_rows(rows, offset):
+    """Add an offset to all the node ids in some rows.
+
+    Args:
+        rows (dict): Rows as produced by `_flatten_node`.
+        offset (int): The amount to add to each id.
+
+    Returns:
+        dict: The shifted rows.
+
+    """
+    shifted = {}
+    for name, table_rows in rows.items():
+        ids = _ID_COLUMNS[name]
+        shifted[name] = [tuple(v + offset if i in ids else v
+                               for i, v in enumerate(row))
+                         for row in table_rows]
+    return shifted
+
+
+#: The loader used by `_flatten_file` in `CorpusDb.ingest` worker processes.
+_worker_loader = None
+
+
+def _init_worker(loader):
+    """Set up a worker process of `CorpusDb.ingest`."""
+    global _worker_loader
+    _worker_loader = loader
+
+
+def _flatten_file(filename):
+    """Parse a corpus file and convert its trees into rows for the database.
+
+    This function runs in the worker processes of `CorpusDb.ingest`.  The
+    trees are numbered starting from 0; the ids are made absolute with
+    `_shift_rows` when the rows are written.
+
+    Args:
+        filename (str): The file to parse, from the loader passed to
+            `_init_worker`.
+
+    Returns:
+        tuple: The file name, the hash of its content, the number of ids
+        used, and the rows.
+
+    """
+    contents = _worker_loader.file(filename)
+    rows = _empty_rows()
+    next_id = 0
+    for t in _worker_loader.file_trees(filename, contents):
+        next_id = _flatten_tree(rows, t, next_id)
+    return filename, _content_hash(contents), next_id, rows
+
+
+def _intersect_sorted(a, b):
+    """Return the common elements of two sorted arrays.
+
+    Each element of the shorter array is looked up in the longer one by
+    binary search, starting from the position of the previous element, so
+    this is fast when one array is much shorter than the other (e.g. a
+    result set and the roots of a corpus).
+
+    Args:
+        a (array.array): Integers, in ascending order and without duplicates.
+        b (array.array): Likewise.
+
+    Returns:
+        array.array: The integers in both arrays, in ascending order.
+
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    result = array.array("q")
+    lo = 0
+    for x in a:
+        lo = bisect.bisect_left(b, x, lo)
+        if lo == len(b):
+            break
+        if b[lo] == x:
+            result.append(x)
+    return result
+
+
+def _combine_sorted(a, b, left, both, right):
+    """Combine two sorted arrays like sets.
+
+    The arrays are merged in linear time.
+
+    Args:
+        a (array.array): Integers, in ascending order and without duplicates.
+        b (array.array): Likewise.
+        left (bool): Whether to keep the integers only in ``a``.
+        both (bool): Whether to keep the integers in both arrays.
+        right (bool): Whether to keep the integers only in ``b``.
+
+    Returns:
+        array.array: The integers kept, in ascending order.
+
+    """
+    result = array.array("q")
+    i = j = 0
+    while i < len(a) and j < len(b):
+        x, y = a[i], b[j]
+        if x < y:
+            if left:
+                result.append(x)
+            i += 1
+        elif y < x:
+            if right:
+                result.append(y)
+            j += 1
+        else:
+            if both:
+                result.append(x)
+            i += 1
+            j += 1
+    if left:
+        result.extend(a[i:])
+    if right:
+        result.extend(b[j:])
+    return result
+
+
+def _prefetch(fn, items, cleanup):
+    """Map a function over some items in a background thread.
+
+    The thread computes at most one result ahead of the consumer.  If the
+    consumer stops early, the thread stops too, and the generator waits for
+    it to finish.
+
+    Args:
+        fn (function): The function to apply.
+        items (iterable): The items to apply it to.
+        cleanup (function): A function which is called in the background
+            thread when it finishes.
+
+    Yields:
+        The results of ``fn``, in order.  An exception raised by ``fn`` is
+        raised to the consumer.
+
+    """
+    results = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put((fn(item), None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            cleanup()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, error = results.get()
+            if result is done:
+                if error is not None:
+                    raise error
+                return
+            yield result
+    finally:
+        stop.set()
+        # Wait for the thread to finish with (and clean up) its resources
+        thread.join()
+
+
+def _decompose_label(label):
+    """Split a node label into its base and dash tags.
+
+    Args:
+        label (str): The label, e.g. ``"NP-SBJ-X"``.
+
+    Returns:
+        tuple: The base label (``"NP"``) and a list of dash tags (``["SBJ",
+        "X"]``).
+
+    """
+    parts = label.split("-")
+    return parts[0], parts[1:]
+
+
+def _content_hash(contents):
+    """Return the hash of a corpus file's contents, as stored by `CorpusDb.sync`.
+
+    Args:
+        contents (str): The content of the file.
+
+    Returns:
+        str: The hex digest of the SHA-1 hash of ``contents``.
+
+    """
+    return hashlib.sha1(contents.encode("utf-8")).hexdigest()
 
 
 class CorpusDb(corpus.CorpusBase):
@@ -50,21 +485,78 @@ class CorpusDb(corpus.CorpusBase):
         engine (`sqlalchemy.engine.Engine`): the database engine (*private*)
         metadata (`sqlalchemy.schema.MetaData`): metadata (*private*)
         nodes (`sqlalchemy.schema.Table`): a table listing each node in
-            the corpus.  Columns: ``rowid``, ``label``.
+            the corpus.  Columns: ``rowid``, ``label_id``.
+        labels (`sqlalchemy.schema.Table`): the distinct node labels in the
+            corpus.  Columns: ``rowid``, ``label``.
+        label_dashtags (`sqlalchemy.schema.Table`): the decomposition of each
+            label into its base and dash tags, with one row per dash tag (or a
+            single row with a null tag for labels without dash tags).
+            Columns: ``label_id``, ``base``, ``tag``.
         dom (`sqlalchemy.schema.Table`): reflexive dominance.  Columns:
             ``parent``, ``child``, ``depth``
         sprec (`sqlalchemy.schema.Table`): reflexive sister-precedence.
             Columns: ``left``, ``right``, ``distance``.
-        roots (list): the root nodes in the corpus.
+        roots (array.array): the ids of the root nodes in the corpus, in
+            ascending order, as a compact array of 64-bit integers.  When a
+            corpus is opened, they are only read from the database when first
+            needed.
+        roots_db (`sqlalchemy.schema.Table`): the root nodes in the corpus,
+            with the source file and the id of the last node of each tree.
+            Columns: ``id``, ``file``, ``last``.
+        leaves (`sqlalchemy.schema.Table`): the position of each word (leaf
+            which is not an empty category) in its tree, counting from 0.
+            Columns: ``id``, ``root``, ``position``.
+        leaf_fts (`sqlalchemy.sql.expression.TableClause`): an FTS5
+            full-text index of the text and ``LEMMA`` of each word, whose
+            rowids are node ids.  Columns: ``text``, ``lemma``.  It is only
+            present if ``has_fts`` is true (SQLite may be compiled without
+            FTS5).
+        texts (`sqlalchemy.schema.Table`): text-level metadata of the source
+            files, taken from the root metadata of their trees (see
+            `lovett.query.in_text`).  Columns: ``name``, ``year``,
+            ``author``, ``genre``.
+        files (`sqlalchemy.schema.Table`): the source files which have been
+            indexed by `sync`.  Columns: ``name``, ``hash``.
+        saved_names (`sqlalchemy.schema.Table`): the names of the query
+            results saved by `save_results`, including those with no
+            matching nodes.  Columns: ``name``.
+        saved_results (`sqlalchemy.schema.Table`): the matching nodes of
+            query results saved by `save_results` (see
+            `lovett.query.in_result`).  Columns: ``name``, ``node_id``.
         tree_metadata (`sqlalchemy.schema.Table`): metadata for each node.
             Columns: ``id``, ``key``, ``value``.
         id (int): The next id available for inserting a node.  Methods which
             actually use this value to insert a node are responsible for
             incrementing this value.
 
+    A `CorpusDb` keeps one open database connection per thread (see
+    `_connection`), which is released by `close`.  It can also be used as a
+    context manager::
+
+        with CorpusDb(filename="corpus.db") as d:
+            d.matching_trees(...)
+
     """
     def __init__(self, other=None, roots=None, filename=None):
-        """TODO: document"""
+        """Create a corpus database.
+
+        If ``filename`` names an existing file, the corpus saved there is
+        reopened.  New trees can be appended to it; they receive ids following
+        the largest id already in the database.
+
+        Args:
+            other (CorpusDb): If given, create a read-only clone of this
+                corpus instead of opening a database (*private*).
+            roots (list): The roots of the clone; defaults to all the roots of
+                ``other`` (*private*).
+            filename (str): The file to store the database in.  If omitted,
+                the database is kept in memory.
+
+        Raises:
+            ValueError: If ``filename`` holds a corpus written with a
+                different `SCHEMA_VERSION`, which must be rebuilt.
+
+        """
         if other is None:
             preexisting = False
             if filename is None:
@@ -74,13 +566,28 @@ class CorpusDb(corpus.CorpusBase):
                 preexisting = pathlib.Path(filename).exists()
                 filename = "sqlite:///" + filename
             # Initialize an empty corpus, creating the db from scratch
-            self.engine = sqlalchemy.create_engine(filename)
+            # Each connection is only used by one thread at a time, but
+            # `close` closes the connections of all threads
+            self.engine = sqlalchemy.create_engine(
+                filename, connect_args={"check_same_thread": False})
             sqlalchemy.event.listen(self.engine, "connect", _sqlite_pragmas)
             self.metadata = MetaData()
+            self.labels = Table("labels", self.metadata,
+                                Column("rowid", Integer, primary_key=True),
+                                Column("label", String),
+                                # Needed for exact and prefix label matching
+                                Index("label_name", "label", unique=True))
+            self.label_dashtags = Table("label_dashtags", self.metadata,
+                                        Column("label_id", Integer, ForeignKey("labels.rowid")),
+                                        Column("base", String),
+                                        Column("tag", String),
+                                        # Needed for label and dash_tag
+                                        Index("dashtag_base", "base"),
+                                        Index("dashtag_tag", "tag"))
             self.nodes = Table("nodes", self.metadata,
                                Column("rowid", Integer, primary_key=True),
-                               Column("label", String),
-                               Index("label_idx", "label"))
+                               Column("label_id", Integer, ForeignKey("labels.rowid")),
+                               Index("label_idx", "label_id"))
             self.dom = Table("dom", self.metadata,
                              Column("parent", Integer, ForeignKey("nodes.rowid")),
                              Column("child", Integer, ForeignKey("nodes.rowid")),
@@ -99,38 +606,142 @@ class CorpusDb(corpus.CorpusBase):
                                        Column("id", Integer, ForeignKey("nodes.rowid")),
                                        Column("key", String),
                                        Column("value", String),
-                                       Index("id_key", "id", "key"))
+                                       Column("num", Integer),
+                                       Index("id_key", "id", "key"),
+                                       # Covering indexes for metadata
+                                       # queries: by value, and by
+                                       # numeric range
+                                       Index("key_value_id", "key", "value", "id"),
+                                       Index("key_num_id", "key", "num", "id"))
             self.roots_db = Table("roots", self.metadata,
-                                  Column("id", Integer, ForeignKey("nodes.rowid")))
-            if preexisting:
-                self._frozen = True
-                c = self.engine.connect()
-                self.roots = list(map(lambda x: x[0],
-                                      c.execute(select([self.roots_db.c.id])).fetchall()))
-                # Since this is a read-only corpus, we don't need to worry
-                # about setting the ID.
-                self.id = None
-            else:
-                self._initialize_db()
-                self._frozen = False
-                self.roots = []
-                self.id = 1
+                                  Column("id", Integer, ForeignKey("nodes.rowid")),
+                                  Column("file", String),
+                                  # The id of the last node of the tree
+                                  Column("last", Integer),
+                                  Index("root_id", "id", unique=True),
+                                  # Covering, for in_text range joins
+                                  Index("root_file", "file", "id", "last"))
+            # The position of each word in its tree, for phrase searches
+            self.leaves = Table("leaves", self.metadata,
+                                Column("id", Integer, primary_key=True),
+                                Column("root", Integer),
+                                Column("position", Integer),
+                                Index("leaf_position", "root", "position"))
+            # An FTS5 table, created by _initialize_db rather than by
+            # SQLAlchemy.  The hidden column named after the table is the
+            # left operand of MATCH
+            self.leaf_fts = sqlalchemy.table("leaf_fts",
+                                             sqlalchemy.column("rowid"),
+                                             sqlalchemy.column("text"),
+                                             sqlalchemy.column("lemma"),
+                                             sqlalchemy.column("leaf_fts"))
+            # Text-level metadata, with one row per source file
+            self.texts = Table("texts", self.metadata,
+                               Column("name", String, primary_key=True),
+                               Column("year", Integer),
+                               Column("author", String),
+                               Column("genre", String),
+                               Index("text_year", "year"),
+                               Index("text_author", "author"),
+                               Index("text_genre", "genre"))
+            self.files = Table("files", self.metadata,
+                               Column("name", String, primary_key=True),
+                               Column("hash", String))
+            self.saved_names = Table("saved_names", self.metadata,
+                                     Column("name", String, primary_key=True))
+            self.saved_results = Table("saved_results", self.metadata,
+                                       Column("name", String),
+                                       Column("node_id", Integer),
+                                       # Covering, for in_result
+                                       Index("saved_name_node", "name", "node_id", unique=True))
+            # Properties of the database as a whole.  The "version" is
+            # incremented whenever trees are inserted or deleted; the
+            # "schema" is the SCHEMA_VERSION the file was written with
+            self.info = Table("info", self.metadata,
+                              Column("key", String, primary_key=True),
+                              Column("value", Integer))
+            self.result_cache_db = Table("result_cache", self.metadata,
+                                         Column("query", String, primary_key=True),
+                                         Column("version", Integer),
+                                         Column("roots", LargeBinary),
+                                         # When the result was stored;
+                                         # hits do not update it
+                                         Column("last_used", Float),
+                                         Index("result_last_used", "last_used"))
+            self._file_backed = filename != "sqlite:///:memory:"
+            self._result_cache = collections.OrderedDict()
+            self._result_cache_lock = threading.Lock()
+            self.result_cache_size = RESULT_CACHE_SIZE
+            self.result_cache_db_size = RESULT_CACHE_DB_SIZE
+            self.result_cache_max_roots = RESULT_CACHE_MAX_ROOTS
+            self._tree_cache = collections.OrderedDict()
+            self._tree_cache_lock = threading.Lock()
+            self._tree_cache_stats = collections.Counter()
+            self.tree_cache_size = TREE_CACHE_SIZE
+            self._local = threading.local()
+            self._connections = []
+            self._connections_lock = threading.Lock()
+            self._compiled_cache = sqlalchemy.util.LRUCache(COMPILED_CACHE_SIZE)
+            self._statements = self._prepare_statements()
+            self._bulk_loading = False
+            # Creates the tables, unless the file already holds a corpus
+            self._initialize_db()
+            self._frozen = False
+            self._labels = {}
+            self._label_ids = {}
+            self._label_matches = {}
+            self._statistics = {}
+            self._base = self
+            self._load_state(self._connection)
         else:
             # Create a corpus that is a clone of another corpus
             # TODO: make this a class method, not a variant of init
             self.engine = other.engine
             self.metadata = other.metadata
             self.nodes = other.nodes
+            self.labels = other.labels
+            self.label_dashtags = other.label_dashtags
+            self._labels = other._labels
+            self._label_ids = other._label_ids
+            self._label_matches = other._label_matches
+            self._statistics = other._statistics
+            # The corpus which holds all the trees of the database
+            self._base = other._base
             self.dom = other.dom
             self.sprec = other.sprec
             self.tree_metadata = other.tree_metadata
+            self.roots_db = other.roots_db
+            self.texts = other.texts
+            self.leaves = other.leaves
+            self.leaf_fts = other.leaf_fts
+            self.has_fts = other.has_fts
+            self.files = other.files
+            self.saved_names = other.saved_names
+            self.saved_results = other.saved_results
+            self.info = other.info
+            self.result_cache_db = other.result_cache_db
+            self._file_backed = other._file_backed
+            self._result_cache = other._result_cache
+            self._result_cache_lock = other._result_cache_lock
+            self.result_cache_size = other.result_cache_size
+            self.result_cache_db_size = other.result_cache_db_size
+            self.result_cache_max_roots = other.result_cache_max_roots
+            self._tree_cache = other._tree_cache
+            self._tree_cache_lock = other._tree_cache_lock
+            self._tree_cache_stats = other._tree_cache_stats
+            self.tree_cache_size = other.tree_cache_size
+            self._local = other._local
+            self._connections = other._connections
+            self._connections_lock = other._connections_lock
+            self._compiled_cache = other._compiled_cache
+            self._statements = other._statements
+            self._bulk_loading = False
 
             if roots is None:
-                # Make a copy of the roots list, so the corpora can be treated
-                # differently.  TODO: requires filtering search results to be
-                # in the list of roots.  Would it be better to clone the DB
-                # backing this corpus, and then prune it according to roots??
-                self.roots = list(other.roots)
+                # Make a copy of the roots array, so the corpora can be
+                # treated differently.  Search results are filtered to be in
+                # the array of roots (see `_restrict_roots`).
+                self.roots = array.array("q", other.roots)
             else:
                 self.roots = roots
 
@@ -140,105 +751,393 @@ class CorpusDb(corpus.CorpusBase):
             self._frozen = True
 
     def _initialize_db(self):
+        conn = self._connection
+        tables = set(row[0] for row in conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")))
+        if tables:
+            # An existing corpus is only read here, so that it can be opened
+            # when it is read-only or another connection holds the write lock
+            schema = None
+            if "info" in tables:
+                schema = conn.execute(select([self.info.c.value]).
+                                      where(self.info.c.key == "schema")).scalar()
+            if schema != SCHEMA_VERSION:
+                self.close()
+                raise ValueError("%s was written with schema version %s, but this version "
+                                 "of lovett uses version %d; rebuild this corpus" %
+                                 (self.engine.url.database, schema, SCHEMA_VERSION))
+            self.has_fts = "leaf_fts" in tables
+            return
         self.metadata.create_all(self.engine)
+        with conn.begin():
+            conn.execute(self.info.insert(), [dict(key="version", value=0),
+                                              dict(key="schema", value=SCHEMA_VERSION)])
+        # SQLite may be compiled without FTS5, in which case text searches
+        # fall back to the metadata table
+        try:
+            self._connection.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS leaf_fts USING fts5(text, lemma, tokenize=\"%s\")"
+                % FTS_TOKENIZE))
+            self.has_fts = True
+        except sqlalchemy.exc.OperationalError:
+            self.has_fts = False
 
-    def _insert_metadata(self, c, node_id, dic, prefix=""):
-        """Inner function for inserting metadata into the database.
+    def _load_state(self, conn):
+        """Read the next free id and the label vocabulary from the database.
 
-        Metadata are represented in a table with columns ``id``, ``key``, and
-        ``value``.  Nested metadata values are converted into a string key for
-        the database by joining their key path with ``:``.  The
-        `_metadata_py_to_str` function is used to translate metadata values
-        into strings.
+        The roots are read lazily (see `roots`).
 
         Args:
-            c (sqlalchemy.engine.Connection): A connection to the database.
-            node_id (int): The database id of the node to which the metadata
-                are affiliated.
-            dic (Metadata): Metadata to insert.
-            prefix (str): The key path at which to insert this metadata.
+            conn (sqlalchemy.engine.Connection): A connection to the database.
 
         """
-        for key, val in dic.items():
-            if key in util.INTERNAL_METADATA_KEYS:
-                continue
-            if isinstance(val, tree.Metadata):
-                self._insert_metadata(node_id, val, prefix + key + ":")
-            else:
-                c.execute(self.tree_metadata.insert().values(
-                    id=node_id,
-                    key=prefix + key,
-                    value=util._metadata_py_to_str(val)))
+        self._roots = None
+        self.id = conn.execute(self._statements["max_id"]).scalar() + 1
+        # Update in place, since clones share these dicts
+        self._labels.clear()
+        self._labels.update(conn.execute(select([self.labels.c.rowid,
+                                                 self.labels.c.label])).fetchall())
+        self._label_ids.clear()
+        self._label_ids.update((label, i) for i, label in self._labels.items())
+        self._label_matches.clear()
+        self._statistics.clear()
+
+    @property
+    def roots(self):
+        if self._roots is None:
+            self._roots = array.array("q", (x for x, in self._connection.execute(
+                self._statements["roots"])))
+        return self._roots
+
+    @roots.setter
+    def roots(self, roots):
+        if not isinstance(roots, array.array):
+            roots = array.array("q", roots)
+        self._roots = roots
 
-    def _insert_node(self, c, node, parents=(), lefts=()):
+    def _has_root(self, root):
+        """Return whether a root id is one of the roots of this corpus."""
+        roots = self.roots
+        i = bisect.bisect_left(roots, root)
+        return i < len(roots) and roots[i] == root
 
-        """Insert a node into the database.
+    @contextlib.contextmanager
+    def _transaction(self):
+        """A context manager for a transaction which inserts or deletes trees.
+
+        Inserting trees updates the in-memory state of the corpus (`roots`,
+        `id` and the label vocabulary) along with the database.  If the
+        transaction is rolled back, this state is reloaded from the database.
+
+        Yields:
+            sqlalchemy.engine.Connection: The connection of the transaction.
+
+        """
+        conn = self._connection
+        try:
+            with conn.begin():
+                yield conn
+                self._bump_version(conn)
+        except BaseException:
+            self._load_state(conn)
+            raise
+        finally:
+            self._statistics.clear()
+
+    def _bump_version(self, conn):
+        """Record that the trees in the database have changed.
+
+        This invalidates the cached query results and trees (the ids of
+        deleted trees can be reused).
 
         Args:
-            c (sqlalchemy.engine.Connection): A connection to the database.
-            node (Tree): The node to be inserted.
-            parents (tuple): The database ids of the ancestor nodes, if any,
-                in ascending order (immediate parent = element 0)
-            left (int): The database ids of the left siblings, if any, in
-                right-to-left order (the immediate left sibling = element 0)
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+
+        """
+        conn.execute(self.info.update().where(self.info.c.key == "version").
+                     values(value=self.info.c.value + 1))
+        conn.execute(self.result_cache_db.delete())
+        with self._result_cache_lock:
+            self._result_cache.clear()
+        with self._tree_cache_lock:
+            self._tree_cache.clear()
+
+    def _prepare_statements(self):
+        """Build the fixed internal queries used by the corpus.
+
+        These queries are constructed once, with bound parameters in place of
+        the node ids, so that they can be compiled once and then served from
+        the `_compiled_cache` on each subsequent execution.
 
         Returns:
-           int: the database id of the inserted node.
-
-        """
-
-        # Insert this node's label into the db
-        rowid = self.id
-        self.id += 1
-        c.execute(self.nodes.insert(), label=node.label, rowid=rowid)
-        # Add it to the dominance_R table
-        c.execute(self.dom.insert(),
-                  # Insert a depth-0 self-dominance relation...
-                  {"parent": rowid, "child": rowid, "depth": 0},
-                  # ...as well as dominance relations for all the node's parents
-                  *[{"parent": p, "child": rowid,
-                     # +1 because enumerate counts from 0
-                     "depth": d + 1}
-                    for d, p
-                    in enumerate(parents)])
-        # Add it to the sprecedes_R table; see comments above for explanation
-        # of the parts
-        c.execute(self.sprec.insert(),
-                  {"left": rowid, "right": rowid, "distance": 0},
-                  *[{"left": l, "right": rowid, "distance": d + 1}
-                    for d, l
-                    in enumerate(lefts)])
-        if util.is_leaf(node):
-            # Add its text to the metadata db...
-            c.execute(self.tree_metadata.insert(), id=rowid, key="text", value=node.text)
+            dict: A mapping from statement names to SQLAlchemy expressions.
+
+        """
+        rowid = bindparam("rowid")
+        parent = self.dom.alias("parent_dom")
+        return {
+            # A node and its descendants, with their parents, in preorder
+            "subtree": select([self.dom.c.child, self.nodes.c.label_id, parent.c.parent]).
+            select_from(self.dom.join(self.nodes, self.nodes.c.rowid == self.dom.c.child).
+                        outerjoin(parent, (parent.c.child == self.dom.c.child) &
+                                  (parent.c.depth == 1))).
+            where(self.dom.c.parent == rowid).
+            order_by(self.dom.c.child),
+            # The descendants of a node have consecutive ids
+            "subtree_metadata": select([self.tree_metadata.c.id, self.tree_metadata.c.key,
+                                        self.tree_metadata.c.value]).
+            where(self.tree_metadata.c.id.between(bindparam("first"), bindparam("last"))).
+            order_by(self.tree_metadata.c.id, self.tree_metadata.c.key),
+            # The same for several trees at once, for iter_trees
+            "batch_nodes": select([self.roots_db.c.id, self.dom.c.child, self.nodes.c.label_id,
+                                   parent.c.parent]).
+            select_from(self.roots_db.join(self.dom, self.dom.c.parent == self.roots_db.c.id).
+                        join(self.nodes, self.nodes.c.rowid == self.dom.c.child).
+                        outerjoin(parent, (parent.c.child == self.dom.c.child) &
+                                  (parent.c.depth == 1))).
+            where(self.roots_db.c.id.in_(bindparam("roots", expanding=True))).
+            order_by(self.dom.c.child),
+            "batch_metadata": select([self.roots_db.c.id, self.tree_metadata.c.id,
+                                      self.tree_metadata.c.key, self.tree_metadata.c.value]).
+            select_from(self.roots_db.join(self.tree_metadata, self.tree_metadata.c.id.between(
+                self.roots_db.c.id, self.roots_db.c.last))).
+            where(self.roots_db.c.id.in_(bindparam("roots", expanding=True))).
+            order_by(self.tree_metadata.c.id, self.tree_metadata.c.key),
+            "roots": select([self.roots_db.c.id]).order_by(self.roots_db.c.id),
+            "root_count": select([sqlalchemy.func.count()]).select_from(self.roots_db),
+            "max_id": select([sqlalchemy.func.coalesce(sqlalchemy.func.max(self.nodes.c.rowid), 0)]),
+            "version": select([self.info.c.value]).where(self.info.c.key == "version"),
+            "cached_roots": select([self.result_cache_db.c.roots]).
+            where((self.result_cache_db.c.query == bindparam("key")) &
+                  (self.result_cache_db.c.version == bindparam("version")))
+        }
+
+    @property
+    def _connection(self):
+        """The database connection belonging to the current thread.
+
+        SQLite connections cannot be shared between threads, so each thread
+        which accesses the corpus gets its own connection.  It is opened on
+        first use and then kept open (and reused) until `close` is called.
+        Clones of a corpus (e.g. the backing of a `ResultSet`) share the
+        connections of the corpus they were cloned from.
+
+        """
+        conn = getattr(self._local, "connection", None)
+        if conn is None or conn.closed:
+            conn = self.engine.connect().execution_options(
+                compiled_cache=self._compiled_cache)
+            self._local.connection = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """Close all database connections held by the corpus.
+
+        A file-backed corpus can be reopened afterwards by creating a new
+        `CorpusDb` with the same filename.  An in-memory corpus is discarded.
+        The connections of other threads are closed too, so no other thread
+        may be using the corpus.
+
+        """
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            del self._connections[:]
+        self.engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def bulk_loading(self, defer_indexes=None):
+        """A context manager for loading many trees into the corpus quickly.
+
+        Within the ``with`` block, SQLite is configured according to
+        `_BULK_LOAD_PRAGMAS`, and the secondary indexes of the database may
+        be dropped.  On exit any dropped indexes are rebuilt in one pass,
+        ``ANALYZE`` is run to give the query planner fresh statistics, and
+        the previous pragma values are restored::
+
+            d = CorpusDb(filename="corpus.db")
+            with d.bulk_loading():
+                d.insert_trees(trees)
+
+        Rebuilding the indexes takes time proportional to the whole corpus,
+        so by default they are only dropped when the corpus is empty; a small
+        append to a large corpus updates them as it goes.  Unique indexes are
+        never dropped, so that they are enforced during the load.
+
+        Queries should not be run against the corpus inside the block, since
+        they may not have any indexes to use.  Nested uses are allowed; only
+        the outermost one has any effect.
+
+        Args:
+            defer_indexes (bool): Whether to drop the indexes during the
+                load.  Defaults to whether the corpus is empty.
+
+        """
+        if self._frozen:
+            raise ValueError("This CorpusDb is read-only")
+        if self._bulk_loading:
+            yield self
+            return
+        conn = self._connection
+        if defer_indexes is None:
+            # Ids are assigned consecutively from 1
+            defer_indexes = self.id == 1
+        if defer_indexes:
+            indexes = [index for table in self.metadata.sorted_tables
+                       for index in table.indexes if not index.unique]
         else:
-            # ...or add its children to the db, as applicable
-            p = (rowid,) + parents
-            lastchild_rowids = ()
-            for child in node:
-                tmp = self._insert_node(c, child, p, lastchild_rowids)
-                lastchild_rowids = (tmp,) + lastchild_rowids
-        self._insert_metadata(c, rowid, node.metadata)
-        return rowid
+            indexes = []
+        previous = []
+        for name, value in _BULK_LOAD_PRAGMAS:
+            previous.append((name, conn.execute(text("PRAGMA %s" % name)).scalar()))
+            conn.execute(text("PRAGMA %s=%s" % (name, value)))
+        for index in indexes:
+            conn.execute(DropIndex(index))
+        self._bulk_loading = True
+        try:
+            yield self
+        finally:
+            self._bulk_loading = False
+            for index in indexes:
+                conn.execute(CreateIndex(index))
+            if defer_indexes:
+                conn.execute(text("ANALYZE"))
+            else:
+                self._update_statistics(conn)
+            for name, value in previous:
+                conn.execute(text("PRAGMA %s=%s" % (name, value)))
+
+    def _insert_rows(self, conn, rows):
+        """Insert flattened trees into the database.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+            rows (dict): Rows to insert, as returned by `_flatten_tree`.
+
+        """
+        label_ids = self._label_ids
+        new_labels = set(label for _, label in rows["nodes"] if label not in label_ids)
+        if len(new_labels) > 0:
+            self._insert_labels(conn, sorted(new_labels))
+        rows = dict(rows)
+        rows["nodes"] = [(rowid, label_ids[label]) for rowid, label in rows["nodes"]]
+        for name, table in (("nodes", self.nodes),
+                            ("dom", self.dom),
+                            ("sprec", self.sprec),
+                            ("metadata", self.tree_metadata),
+                            ("roots", self.roots_db),
+                            ("leaves", self.leaves)):
+            if len(rows[name]) > 0:
+                columns = [c.name for c in table.columns]
+                conn.execute(table.insert(), [dict(zip(columns, row)) for row in rows[name]])
+        if self.has_fts and len(rows["leaf_fts"]) > 0:
+            conn.execute(self.leaf_fts.insert(),
+                         [{"rowid": rowid, "text": text, "lemma": lemma}
+                          for rowid, text, lemma in rows["leaf_fts"]])
+        if len(rows["texts"]) > 0:
+            # One row per file, from its last tree
+            texts = dict((row[0], row) for row in rows["texts"])
+            columns = [c.name for c in self.texts.columns]
+            conn.execute(self.texts.insert().prefix_with("OR REPLACE"),
+                         [dict(zip(columns, row)) for row in texts.values()])
+        if self._roots is not None:
+            self._roots.extend(map(lambda x: x[0], rows["roots"]))
+
+    def _insert_labels(self, conn, labels):
+        """Add new labels to the label vocabulary.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+            labels (list of str): Labels which are not yet in the vocabulary.
+
+        """
+        next_id = max(self._labels, default=0) + 1
+        label_rows = []
+        dashtag_rows = []
+        for label_id, label in enumerate(labels, next_id):
+            label_rows.append({"rowid": label_id, "label": label})
+            base, tags = _decompose_label(label)
+            dashtag_rows.extend({"label_id": label_id, "base": base, "tag": tag}
+                                for tag in tags or (None,))
+            self._labels[label_id] = label
+            self._label_ids[label] = label_id
+        # Cached regex expansions do not know about the new labels
+        self._label_matches.clear()
+        conn.execute(self.labels.insert(), label_rows)
+        conn.execute(self.label_dashtags.insert(), dashtag_rows)
+
+    def label_counts(self):
+        """Return the number of nodes with each label.
+
+        The counts are used by `lovett.planner.optimize` to estimate the
+        selectivity of label queries.  They are cached until trees are next
+        inserted or deleted.
+
+        Returns:
+            dict: A mapping from label ids to node counts.
+
+        """
+        counts = self._statistics.get("label_counts")
+        if counts is None:
+            counts = dict(self._connection.execute(
+                select([self.nodes.c.label_id, sqlalchemy.func.count()]).
+                group_by(self.nodes.c.label_id)).fetchall())
+            self._statistics["label_counts"] = counts
+        return counts
+
+    def matching_label_ids(self, rx):
+        """Return the ids of the labels in the vocabulary which match a regex.
+
+        The regex is matched in Python against the distinct labels of the
+        corpus, which are few compared to its nodes.  Results are cached, and
+        the cache is emptied whenever labels are added.
+
+        Args:
+            rx: A compiled regular expression, or any object with a
+                ``search`` method.
+
+        Returns:
+            frozenset of int: The ids of the matching labels.
+
+        """
+        try:
+            return self._label_matches[rx]
+        except KeyError:
+            pass
+        except TypeError:
+            # Not hashable, so not cacheable
+            return frozenset(i for i, label in self._labels.items() if rx.search(label))
+        ids = frozenset(i for i, label in self._labels.items() if rx.search(label))
+        self._label_matches[rx] = ids
+        return ids
 
     def _insert_tree(self, conn, t):
         """An inner function to perform insertion of a tree.
 
-        Should not be called directly.  In addition to calling `_insert_node`,
-        this function adds the tree's database id to the `roots` attribute of
-        the class.
+        Should not be called directly.  In addition to inserting the rows
+        computed by `_flatten_tree`, this function adds the tree's database id
+        to the `roots` attribute of the class.  The file the tree came from
+        (taken from its ``FILE`` metadata, which is set by `Loader` objects)
+        is recorded in the ``roots`` table.
 
         """
         if self._frozen:
             raise ValueError("This CorpusDb is read-only")
-        rowid = self._insert_node(conn, t)
-        self.roots.append(rowid)
+        rows = _empty_rows()
         # TODO: This redundnacy is not good.  We use it for getting the list
         # of roots from a corpus saved to a file (__init__ where preexisting =
         # True), but we could do away with it by using a query to find all
         # undominated nodes in the DB
-        conn.execute(self.roots_db.insert(),
-                     id=rowid)
+        self.id = _flatten_tree(rows, t, self.id)
+        self._insert_rows(conn, rows)
 
     def insert_tree(self, t):
         """Insert a single tree into the corpus.
@@ -246,8 +1145,9 @@ class CorpusDb(corpus.CorpusBase):
         This method wraps `_insert_tree`.
 
         """
-        with self.engine.begin() as conn:
+        with self._transaction() as conn:
             self._insert_tree(conn, t)
+        self._update_statistics(conn)
 
     def insert_trees(self, trees):
         """Insert a sequence of trees into the corpus.
@@ -257,19 +1157,341 @@ class CorpusDb(corpus.CorpusBase):
         whole insertion, rather than committing after each tree is inserted.
 
         """
-        with self.engine.begin() as conn:
+        with self._transaction() as conn:
             for t in trees:
                 self._insert_tree(conn, t)
+        self._update_statistics(conn)
+
+    def insert_files(self, loader, files=None, batch_size=1000):
+        """Insert the files of a loader, without keeping their trees in memory.
+
+        The trees of each file are parsed and inserted in batches of
+        ``batch_size``, and are discarded once inserted, so the memory needed
+        does not grow with the size of the corpus.  The content hashes of the
+        files are recorded, so that the corpus can later be updated with
+        `sync`.  See also `ingest`, which parses the files in parallel.
+
+        Args:
+            loader (Loader): The loader to read files from.
+            files (list of str): The files to insert.  Defaults to all the
+                files of the loader.
+            batch_size (int): The number of trees to insert per transaction.
+
+        """
+        if self._frozen:
+            raise ValueError("This CorpusDb is read-only")
+        if files is None:
+            files = loader.files()
+        conn = self._connection
+        with self.bulk_loading():
+            for filename in files:
+                contents = loader.file(filename)
+                trees = loader.file_trees(filename, contents)
+                while True:
+                    batch = list(itertools.islice(trees, batch_size))
+                    if len(batch) == 0:
+                        break
+                    self.insert_trees(batch)
+                with conn.begin():
+                    self._record_file(conn, filename, _content_hash(contents))
+
+    def ingest(self, loader, files=None, processes=None, queue_size=None):
+        """Insert the files of a loader, parsing them in parallel.
+
+        Parsing the corpus files and converting the trees into database rows
+        is done in a pool of worker processes, one file at a time.  The
+        calling thread is the only one which writes to the database: it
+        takes the results in the order of ``files`` and inserts each file in
+        its own transaction (within `bulk_loading`).  Because results are
+        written in order, the database ids assigned to the trees do not
+        depend on which worker finishes first: they are the same as if the
+        files had been inserted one after another with `insert_trees`.
+
+        At most ``queue_size`` files are parsed ahead of the writer, which
+        bounds the memory used when parsing outpaces SQLite.
+
+        The content hashes of the files are recorded, so that the corpus can
+        later be updated with `sync`.
+
+        Args:
+            loader (Loader): The loader to read files from.  It is copied to
+                each worker process, so it must be picklable.
+            files (list of str): The files to insert.  Defaults to all the
+                files of the loader.
+            processes (int): The number of worker processes.  Defaults to the
+                number of CPUs.
+            queue_size (int): The maximum number of parsed files waiting to be
+                written.  Defaults to twice the number of processes.
+
+        """
+        if self._frozen:
+            raise ValueError("This CorpusDb is read-only")
+        if files is None:
+            files = loader.files()
+        processes = processes or os.cpu_count() or 1
+        queue_size = queue_size or 2 * processes
+        conn = self._connection
+        pending = collections.deque()
+        with multiprocessing.Pool(processes, _init_worker, (loader,)) as pool, \
+                self.bulk_loading():
+            for filename in files:
+                pending.append(pool.apply_async(_flatten_file, (filename,)))
+                if len(pending) >= queue_size:
+                    self._write_file(conn, *pending.popleft().get())
+            while len(pending) > 0:
+                self._write_file(conn, *pending.popleft().get())
+
+    def extract(self, filename):
+        """Copy the trees of this corpus into a new database file.
+
+        This is mainly useful for a clone, such as the backing of a result
+        set (see `lovett.corpus.ResultSet.to_db`).  The rows of the trees are
+        copied by SQLite from this database into the new one, which is
+        attached to it, without reconstituting any trees.  The trees are
+        given consecutive ids in the new database, keeping their order.
+        Their texts and labels are copied too, but not the files recorded by
+        `sync` or saved results.
+
+        Args:
+            filename (str): The file to create.  It must not exist.
+
+        Returns:
+            CorpusDb: The new corpus.
+
+        """
+        if pathlib.Path(filename).exists():
+            raise ValueError("File already exists: %s" % filename)
+        target = CorpusDb(filename=filename)
+        conn = self._connection
+        # A map from the id range of each tree to the shift of its ids
+        shifts = Table("extract_shifts", MetaData(),
+                       Column("root", Integer, primary_key=True),
+                       Column("last", Integer),
+                       Column("shift", Integer),
+                       prefixes=["TEMPORARY"])
+        conn.execute(text("ATTACH DATABASE :filename AS extract"), filename=filename)
+        try:
+            with target.bulk_loading(), conn.begin():
+                shifts.create(conn)
+                conn.execute(shifts.insert(), [{"root": root} for root in self.roots])
+                rows = conn.execute(select([self.roots_db.c.id, self.roots_db.c.last]).
+                                    select_from(shifts.join(self.roots_db,
+                                                            self.roots_db.c.id == shifts.c.root)).
+                                    order_by(self.roots_db.c.id)).fetchall()
+                next_id = 1
+                updates = []
+                for root, last in rows:
+                    updates.append({"r": root, "l": last, "s": next_id - root})
+                    next_id += last - root + 1
+                conn.execute(shifts.update().where(shifts.c.root == bindparam("r")).
+                             values(last=bindparam("l"), shift=bindparam("s")), updates)
+                self._copy_rows(conn, shifts, target.has_fts)
+                shifts.drop(conn)
+        except BaseException:
+            conn.execute(text("DETACH DATABASE extract"))
+            target.close()
+            os.remove(filename)
+            raise
+        conn.execute(text("DETACH DATABASE extract"))
+        target._load_state(target._connection)
+        return target
+
+    def _copy_rows(self, conn, shifts, fts):
+        """Copy the rows of some trees into the attached ``extract`` database.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): The connection to which the
+                database is attached.
+            shifts (sqlalchemy.schema.Table): The id range of each tree, and
+                the amount to shift its ids by.
+            fts (bool): Whether to copy the full-text index.
+
+        """
+        def attached(table, *columns):
+            return sqlalchemy.table(table, *map(sqlalchemy.column, columns), schema="extract")
+
+        def copy(table, columns, source, id_column):
+            # Each tree is an id range, so the rows of each tree are found by
+            # a range search on an index of ``id_column``
+            in_tree = id_column.between(shifts.c.root, shifts.c.last)
+            conn.execute(attached(table, *columns).insert().from_select(
+                columns, select(source).select_from(shifts.join(id_column.table, in_tree))))
+
+        shift = shifts.c.shift
+        nodes = self.nodes
+        copy("nodes", ["rowid", "label_id"], [nodes.c.rowid + shift, nodes.c.label_id], nodes.c.rowid)
+        dom = self.dom
+        copy("dom", ["parent", "child", "depth"],
+             [dom.c.parent + shift, dom.c.child + shift, dom.c.depth], dom.c.parent)
+        sprec = self.sprec
+        copy("sprec", ["left", "right", "distance"],
+             [sprec.c.left + shift, sprec.c.right + shift, sprec.c.distance], sprec.c.right)
+        md = self.tree_metadata
+        copy("metadata", ["id", "key", "value", "num"],
+             [md.c.id + shift, md.c.key, md.c.value, md.c.num], md.c.id)
+        roots = self.roots_db
+        copy("roots", ["id", "file", "last"],
+             [roots.c.id + shift, roots.c.file, roots.c.last + shift], roots.c.id)
+        leaves = self.leaves
+        copy("leaves", ["id", "root", "position"],
+             [leaves.c.id + shift, leaves.c.root + shift, leaves.c.position], leaves.c.id)
+        if fts:
+            # An FTS5 table cannot be range-joined efficiently, so its rows
+            # are rebuilt from the words and their metadata, as they were
+            # inserted (see _flatten_tree)
+            words = md.alias()
+            lemmas = md.alias()
+            conn.execute(attached("leaf_fts", "rowid", "text", "lemma").insert().from_select(
+                ["rowid", "text", "lemma"],
+                select([leaves.c.id + shift, words.c.value, lemmas.c.value]).select_from(
+                    shifts.join(leaves, leaves.c.id.between(shifts.c.root, shifts.c.last)).
+                    outerjoin(words, (words.c.id == leaves.c.id) & (words.c.key == "text")).
+                    outerjoin(lemmas, (lemmas.c.id == leaves.c.id) & (lemmas.c.key == "LEMMA")))))
+        texts = self.texts
+        conn.execute(attached("texts", "name", "year", "author", "genre").insert().from_select(
+            ["name", "year", "author", "genre"],
+            select([texts]).where(texts.c.name.in_(
+                select([attached("roots", "file").c.file])))))
+        used = select([attached("nodes", "label_id").c.label_id])
+        conn.execute(attached("labels", "rowid", "label").insert().from_select(
+            ["rowid", "label"], select([self.labels]).where(self.labels.c.rowid.in_(used))))
+        dashtags = self.label_dashtags
+        conn.execute(attached("label_dashtags", "label_id", "base", "tag").insert().from_select(
+            ["label_id", "base", "tag"], select([dashtags]).where(dashtags.c.label_id.in_(used))))
+
+    def _write_file(self, conn, filename, h, count, rows):
+        """Insert the rows of a file returned by `_flatten_file`.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+            filename (str): The name of the file.
+            h (str): The hash of the file's content.
+            count (int): The number of ids used by the rows.
+            rows (dict): The rows, with ids starting from 0.
+
+        """
+        with self._transaction():
+            self._insert_rows(conn, _shift_rows(rows, self.id))
+            self.id += count
+            self._record_file(conn, filename, h)
+
+    def sync(self, loader):
+        """Bring the corpus up to date with the files of a loader.
+
+        For each file of the loader, a hash of its content is compared with
+        the hash recorded when the file was last indexed.  The trees from
+        files which have changed or been removed from the loader are deleted
+        from the database, and the trees from new or changed files are
+        inserted.  Unchanged files are not parsed at all, so updating a large
+        corpus after correcting a few files is quick::
+
+            d = CorpusDb(filename="corpus.db")
+            d.sync(FileLoader("psd/"))
+
+        Trees which were inserted without a recorded hash (e.g. via
+        `insert_trees`) but carry ``FILE`` metadata are treated as coming from
+        a changed file, and so are replaced on the first sync.
+
+        Args:
+            loader (Loader): The loader providing the current corpus files.
+
+        Returns:
+            tuple: Two lists of file names: the files which were (re)indexed,
+            and the files whose trees were removed without replacement.
+
+        """
+        if self._frozen:
+            raise ValueError("This CorpusDb is read-only")
+        conn = self._connection
+        hashes = dict(conn.execute(select([self.files.c.name, self.files.c.hash])).fetchall())
+        indexed = set(map(lambda x: x[0],
+                          conn.execute(select([self.roots_db.c.file]).
+                                       where(self.roots_db.c.file.isnot(None)).
+                                       distinct()).fetchall()))
+        indexed.update(hashes.keys())
+        current = set()
+        changed = []
+        for filename in loader.files():
+            current.add(filename)
+            contents = loader.file(filename)
+            h = _content_hash(contents)
+            if hashes.get(filename) != h:
+                changed.append((filename, contents, h))
+        removed = [f for f in indexed if f not in current]
+        with self._transaction():
+            self._delete_files(conn, removed + [f for f, _, _ in changed if f in indexed])
+            for filename, contents, h in changed:
+                for t in loader.file_trees(filename, contents):
+                    self._insert_tree(conn, t)
+                self._record_file(conn, filename, h)
+        self._update_statistics(conn)
+        return [f for f, _, _ in changed], sorted(removed)
+
+    def _record_file(self, conn, filename, h):
+        """Record the content hash of an indexed file.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+            filename (str): The name of the file.
+            h (str): The hash of its content, from `_content_hash`.
+
+        """
+        conn.execute(self.files.delete().where(self.files.c.name == filename))
+        conn.execute(self.files.insert(), name=filename, hash=h)
 
-    def _reconstitute_metadata(self, rowid):
+    def _delete_files(self, conn, filenames):
+        """Delete all the trees which came from some files.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+            filenames (list of str): The names of the files.
+
+        """
+        if len(filenames) == 0:
+            return
+        root_ids = select([self.roots_db.c.id]).where(self.roots_db.c.file.in_(filenames))
+        deleted = set(map(lambda x: x[0], conn.execute(root_ids).fetchall()))
+        node_ids = select([self.dom.c.child]).where(self.dom.c.parent.in_(root_ids))
+        conn.execute(self.tree_metadata.delete().where(self.tree_metadata.c.id.in_(node_ids)))
+        conn.execute(self.sprec.delete().where(self.sprec.c.right.in_(node_ids)))
+        conn.execute(self.nodes.delete().where(self.nodes.c.rowid.in_(node_ids)))
+        conn.execute(self.leaves.delete().where(self.leaves.c.root.in_(root_ids)))
+        if self.has_fts:
+            conn.execute(self.leaf_fts.delete().where(self.leaf_fts.c.rowid.in_(node_ids)))
+        # The ids may be reused by new trees
+        conn.execute(self.saved_results.delete().where(self.saved_results.c.node_id.in_(node_ids)))
+        # Every ancestor of a node belongs to the same tree, so this catches
+        # all the dominance relations.  It must come after the other
+        # deletions, since node_ids is computed from this table.
+        conn.execute(self.dom.delete().where(self.dom.c.child.in_(node_ids)))
+        conn.execute(self.roots_db.delete().where(self.roots_db.c.file.in_(filenames)))
+        conn.execute(self.texts.delete().where(self.texts.c.name.in_(filenames)))
+        conn.execute(self.files.delete().where(self.files.c.name.in_(filenames)))
+        if self._roots is not None:
+            self.roots = [r for r in self._roots if r not in deleted]
+
+    def _update_statistics(self, conn):
+        """Keep the query planner statistics current after an insertion.
+
+        ``PRAGMA optimize`` only reruns ``ANALYZE`` on tables whose contents
+        have changed significantly since the statistics were gathered, so it
+        is cheap to call after every insertion.  Within `bulk_loading` this is
+        skipped until the end of the load.
+
+        """
+        if not self._bulk_loading:
+            conn.execute(text("PRAGMA optimize"))
+
+    @staticmethod
+    def _reconstitute_metadata(metadata):
         """TODO: document this function.
 
-        And how it is riddled with inelegant hacks."""
-        c = self.engine.connect()
-        metadata = c.execute(
-            select([self.tree_metadata.c.key, self.tree_metadata.c.value]).
-            where(self.tree_metadata.c.id == rowid)
-        ).fetchall()
+        And how it is riddled with inelegant hacks.
+
+        Args:
+            metadata (iterable): The (key, value) rows of a node's metadata.
+
+        """
         m = tree.Metadata({})
         for k, v in metadata:
             if k in util.INTERNAL_METADATA_KEYS:
@@ -283,11 +1505,72 @@ class CorpusDb(corpus.CorpusBase):
             _m[ks[-1]] = util._metadata_str_to_py(v)
         return m
 
+    def _tree_rows(self, rowid):
+        """Fetch the rows from which a tree is reconstituted.
+
+        The rows of the most recently used trees are kept in an LRU cache of
+        `tree_cache_size` entries, which is shared with the clones of the
+        corpus (e.g. `ResultSet` backings).  The rows rather than the trees
+        are cached, so that each call of `_reconstitute` returns a new tree
+        which can be modified (e.g. colorized) without affecting the cache.
+
+        Args:
+            rowid (int): The database id of the root of the tree.
+
+        Returns:
+            tuple: The (id, label id, parent id) rows of the nodes of the
+            tree, in preorder, and the (id, key, value) rows of their
+            metadata.
+
+        """
+        with self._tree_cache_lock:
+            rows = self._tree_cache.get(rowid)
+            if rows is not None:
+                self._tree_cache.move_to_end(rowid)
+                self._tree_cache_stats["hits"] += 1
+                return rows
+            self._tree_cache_stats["misses"] += 1
+        c = self._connection
+        nodes = tuple(map(tuple, c.execute(self._statements["subtree"], rowid=rowid)))
+        if len(nodes) == 0:
+            raise IndexError("No node with id %s" % rowid)
+        metadata = tuple(map(tuple, c.execute(self._statements["subtree_metadata"],
+                                              first=rowid, last=nodes[-1][0])))
+        rows = (nodes, metadata)
+        if self.tree_cache_size > 0:
+            with self._tree_cache_lock:
+                self._tree_cache[rowid] = rows
+                while len(self._tree_cache) > self.tree_cache_size:
+                    self._tree_cache.popitem(last=False)
+        return rows
+
+    def cache_info(self):
+        """Return statistics of the tree cache (see `_tree_rows`).
+
+        The cache is shared by a corpus and its clones, so the statistics
+        are too.
+
+        Returns:
+            CacheInfo: The numbers of cache hits and misses, the maximum size
+            of the cache, and its current size.
+
+        """
+        with self._tree_cache_lock:
+            return CacheInfo(self._tree_cache_stats["hits"], self._tree_cache_stats["misses"],
+                             self.tree_cache_size, len(self._tree_cache))
+
+    def clear_tree_cache(self):
+        """Empty the tree cache, and reset its statistics."""
+        with self._tree_cache_lock:
+            self._tree_cache.clear()
+            self._tree_cache_stats.clear()
+
     def _reconstitute(self, rowid):
         """Create a `Tree` from the database.
 
         This function takes an entry in the database and constructs a Python
-        object containing its structure.
+        object containing its structure.  The whole tree is fetched with two
+        queries (see `_tree_rows`), and built bottom-up.
 
         .. note:: TODO
 
@@ -303,39 +1586,762 @@ class CorpusDb(corpus.CorpusBase):
            raise an exception on attempted modifications.
 
         """
-        c = self.engine.connect()
-        label = c.execute(
-            select([self.nodes.c.label]).where(self.nodes.c.rowid == rowid)
-        ).fetchone()[0]
-        children = c.execute(
-            select([self.dom.c.child]).
-            where((self.dom.c.depth == 1) & (self.dom.c.parent == rowid)).
-            order_by(self.dom.c.child)
-        ).fetchall()
-        if len(children) > 0:
-            child_trees = [self._reconstitute(child[0]) for child in children]
-            return tree.NonTerminal(label, child_trees, self._reconstitute_metadata(rowid))
+        return self._build_tree(self._tree_rows(rowid))
+
+    def _build_tree(self, rows):
+        """Build a tree from the rows returned by `_tree_rows`."""
+        nodes, metadata = rows
+        node_metadata = collections.defaultdict(list)
+        for node, key, value in metadata:
+            node_metadata[node].append((key, value))
+        children = collections.defaultdict(list)
+        # In reverse preorder, each node comes after all its descendants
+        for node, label_id, parent in reversed(nodes):
+            label = self._labels[label_id]
+            md = node_metadata.get(node, ())
+            if node in children:
+                node_children = children.pop(node)
+                node_children.reverse()
+                t = tree.NonTerminal(label, node_children, self._reconstitute_metadata(md))
+            else:
+                text = next((v for k, v in md if k == "text"), None)
+                t = tree.Leaf(label, text, self._reconstitute_metadata(md))
+            children[parent].append(t)
+        return t
+
+    def _batch_rows(self, roots):
+        """Fetch the rows from which several trees are reconstituted.
+
+        The rows of all the trees are fetched with two queries.  Trees whose
+        rows are in the tree cache are taken from it, but the fetched rows
+        are not added to it, so that iterating over a corpus does not evict
+        the trees which are being browsed.
+
+        Args:
+            roots (sequence of int): The ids of the roots of the trees.
+
+        Returns:
+            list: The rows of each tree (see `_tree_rows`), in the order of
+            ``roots``.
+
+        """
+        rows = {}
+        with self._tree_cache_lock:
+            for root in roots:
+                cached = self._tree_cache.get(root)
+                if cached is not None:
+                    self._tree_cache_stats["hits"] += 1
+                    rows[root] = cached
+        missing = [root for root in roots if root not in rows]
+        if len(missing) > 0:
+            c = self._connection
+            nodes = collections.defaultdict(list)
+            for root, *row in c.execute(self._statements["batch_nodes"], roots=missing):
+                nodes[root].append(tuple(row))
+            metadata = collections.defaultdict(list)
+            for root, *row in c.execute(self._statements["batch_metadata"], roots=missing):
+                metadata[root].append(tuple(row))
+            for root in missing:
+                rows[root] = (tuple(nodes[root]), tuple(metadata[root]))
+        return [rows[root] for root in roots]
+
+    def iter_trees(self, batch_size=ITER_BATCH_SIZE, background=False):
+        """Iterate over the trees of the corpus, fetching them in batches.
+
+        This is much faster than accessing the trees one at a time, since the
+        trees of a batch are fetched with two queries (see `_batch_rows`).  It
+        is used by ``iter(corpus)``.
+
+        Args:
+            batch_size (int): The number of trees to fetch at a time.
+            background (bool): Whether to fetch the next batch in a background
+                thread while the trees of the current one are being built.
+                This is only possible for a file-backed corpus, since an
+                in-memory database cannot be opened from another thread; it
+                is ignored otherwise.
+
+        Yields:
+            Tree: The trees, in order.
+
+        """
+        return self._iter_batches(self.roots, batch_size, background)
+
+    def _iter_batches(self, roots, batch_size, background):
+        """Reconstitute trees in batches.
+
+        Args:
+            roots (iterable of int): The roots of the trees.
+            batch_size (int): The number of trees to fetch at a time.
+            background (bool): Whether to fetch in a background thread (see
+                `iter_trees`).
+
+        Yields:
+            Tree: The trees, in the order of ``roots``.
+
+        """
+        roots = iter(roots)
+        batches = iter(lambda: list(itertools.islice(roots, batch_size)), [])
+        if background and self._file_backed:
+            batch_rows = _prefetch(self._batch_rows, batches, self._close_thread_connection)
         else:
-            text = c.execute(
-                select([self.tree_metadata.c.value]).
-                where((self.tree_metadata.c.id == rowid) & (self.tree_metadata.c.key == "text"))
-            ).fetchone()[0]
-            return tree.Leaf(label, text, self._reconstitute_metadata(rowid))
+            batch_rows = map(self._batch_rows, batches)
+        for batch in batch_rows:
+            for rows in batch:
+                yield self._build_tree(rows)
+
+    def _close_thread_connection(self):
+        """Close the database connection of the current thread, if any."""
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            with self._connections_lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+            self._local.connection = None
 
     # Corpus abstract methods
     def __getitem__(self, i):
         return self._reconstitute(self.roots[i])
 
+    def __iter__(self):
+        return self.iter_trees()
+
     def __len__(self):
-        return len(self.roots)
-
-    def matching_trees(self, query):
-        c = self.engine.connect()
-        s = query.sql(self)
-        # TODO: still need to benchmark/examine query plan here to make sure
-        # we don't need another index
-        roots_query = select([self.dom.c.parent]).where(
-            self.dom.c.child.in_(s) &
-            self.dom.c.parent.in_(select([self.roots_db.c.id]))).distinct()
-        r = list(map(lambda x: x[0], c.execute(roots_query).fetchall()))
-        return corpus.ResultSet(CorpusDb(self, r), query)
+        if self._roots is None:
+            # Not worth reading all the roots for
+            count = self._statistics.get("root_count")
+            if count is None:
+                count = self._connection.execute(self._statements["root_count"]).scalar()
+                self._statistics["root_count"] = count
+            return count
+        return len(self._roots)
+
+    def matching_trees(self, query, limit=None, offset=0, sample=None, seed=None):
+        if sample is not None:
+            corpus._check_sample(sample, limit, offset)
+            return corpus.ResultSet(CorpusDb(self, self._sample_roots(query, sample, seed)), query)
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("limit and offset must not be negative")
+        if limit is None:
+            roots = self._matching_roots(query)[offset:]
+        else:
+            roots = array.array("q", itertools.islice(self._stream_roots(query),
+                                                      offset, offset + limit))
+        return corpus.ResultSet(CorpusDb(self, roots), query)
+
+    def matching_nodes(self, query):
+        """Return the nodes which match a query.
+
+        No trees are reconstituted; `subtree` fetches just the subtree of a
+        match from the database.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            list of lovett.corpus.NodeMatch: The database ids of the roots
+            and the matching nodes, in order.
+
+        """
+        all_roots = self._base.roots
+        result = []
+        i = 0
+        for node in sorted(self._matching_nodes(query)):
+            # The nodes are sorted, so their roots only move forward
+            i = bisect.bisect_right(all_roots, node, i) - 1
+            root = all_roots[i]
+            if self._base is self or self._has_root(root):
+                result.append(corpus.NodeMatch(root, node))
+        return result
+
+    def subtree(self, match):
+        return self._reconstitute(match.node)
+
+    def iter_matches(self, query, batch_size=ITER_BATCH_SIZE, background=False):
+        """Iterate over the trees which match a query, as they are found.
+
+        Unless the result of the query is cached, the matching roots are
+        streamed from the database (see `_stream_roots`) rather than all
+        collected first, so that the first trees are available long before
+        the last ones have been found.  This only applies to queries whose
+        matches SQLite finds in order, such as text and metadata queries;
+        for others (e.g. structural conjunctions) all the matches are found
+        before the first tree is returned.
+
+        Args:
+            query (QueryFunction): The query.
+            batch_size (int): The number of trees to fetch at a time (see
+                `iter_trees`).
+            background (bool): Whether to search and fetch in a background
+                thread (see `iter_trees`).
+
+        Yields:
+            Tree: The matching trees, in order.
+
+        """
+        return self._iter_batches(self._stream_roots(query), batch_size, background)
+
+    def count(self, query):
+        """Return the number of trees which match a query.
+
+        No trees are reconstituted.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            int
+
+        """
+        return len(self._matching_roots(query))
+
+    def count_nodes(self, query):
+        """Return the number of nodes which match a query.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            int
+
+        """
+        if self._base is self:
+            s = planner.optimize(query, self).sql(self).alias()
+            return self._connection.execute(
+                select([sqlalchemy.func.count()]).select_from(s)).scalar()
+        return sum(n for (root, _), n in self._group_counts_by_root(query, None).items()
+                   if self._has_root(root))
+
+    def group_counts(self, query, by="file", trees=False):
+        """Count the matches of a query in groups.
+
+        The counting is done by the database, without reconstituting any
+        trees.
+
+        Args:
+            query (QueryFunction): The query.
+            by (str): What to group the matches by:
+
+                - ``"file"``: the file of the tree containing the match
+                - ``"label"``: the label of the matching node
+                - a metadata key: the value of that key on the matching node
+                  or, if it has none, on the root of its tree (so that e.g.
+                  ``by="year"`` works for IcePaHC corpora processed with
+                  `lovett.transform.icepahc_year`).  Matches without the key
+                  are counted under ``None``.
+
+            trees (bool): If true, count the trees containing matches in
+                each group rather than the matching nodes.
+
+        Returns:
+            collections.Counter: A mapping from groups to counts.
+
+        """
+        if self._base is not self:
+            # Restrict the matches to the trees of this corpus in python,
+            # rather than sending all our roots to the database
+            counts = collections.Counter()
+            for (root, group), n in self._group_counts_by_root(query, by).items():
+                if self._has_root(root):
+                    counts[group] += 1 if trees else n
+            return counts
+        group, joined = self._group_column(query, by, roots=trees)
+        root = self.dom.c.parent
+        count = sqlalchemy.func.count(root.distinct()) if trees else sqlalchemy.func.count()
+        rows = self._connection.execute(select([group, count]).select_from(joined).group_by(group))
+        return collections.Counter(dict((self._group_value(by, g), n) for g, n in rows))
+
+    def _group_counts_by_root(self, query, by):
+        """Count the matches of a query by tree and group.
+
+        Args:
+            query (QueryFunction): The query.
+            by (str): What to group the matches by (see `group_counts`), or
+                ``None`` to group them only by tree.
+
+        Returns:
+            collections.Counter: A mapping from (root id, group) pairs to
+            counts of matching nodes.
+
+        """
+        group, joined = self._group_column(query, by)
+        root = self.dom.c.parent
+        rows = self._connection.execute(
+            select([root, group, sqlalchemy.func.count()]).select_from(joined).group_by(root, group))
+        return collections.Counter(dict(((r, self._group_value(by, g)), n) for r, g, n in rows))
+
+    def _group_column(self, query, by, roots=True):
+        """Build the SQL for grouping the matches of a query.
+
+        The matching nodes are joined to the roots of their trees (as
+        ``self.dom.c.parent``) and to whatever is needed to compute their
+        group.
+
+        Args:
+            query (QueryFunction): The query.
+            by (str): What to group the matches by (see `group_counts`), or
+                ``None``.
+            roots (bool): Whether the roots are needed even if the group
+                does not depend on them.
+
+        Returns:
+            tuple: The column holding the group of each match, and the join
+            to select it from.
+
+        """
+        matches = planner.optimize(query, self).sql(self).alias()
+        node = list(matches.columns)[0]
+        if by == "label" and not roots:
+            joined = matches.join(self.nodes, self.nodes.c.rowid == node). \
+                join(self.labels, self.labels.c.rowid == self.nodes.c.label_id)
+            return self.labels.c.label, joined
+        dom = self.dom
+        roots = self.roots_db
+        joined = matches.join(dom, (dom.c.child == node)).join(roots, roots.c.id == dom.c.parent)
+        if by is None:
+            return sqlalchemy.literal(None), joined
+        elif by == "file":
+            return roots.c.file, joined
+        elif by == "label":
+            joined = joined.join(self.nodes, self.nodes.c.rowid == node). \
+                join(self.labels, self.labels.c.rowid == self.nodes.c.label_id)
+            return self.labels.c.label, joined
+        else:
+            key = ":".join(tree._check_metadata_name(k) for k in by.split(":"))
+            own = self.tree_metadata.alias()
+            root = self.tree_metadata.alias()
+            joined = joined.outerjoin(own, (own.c.id == node) & (own.c.key == key)). \
+                outerjoin(root, (root.c.id == dom.c.parent) & (root.c.key == key))
+            return sqlalchemy.func.coalesce(own.c.value, root.c.value), joined
+
+    @staticmethod
+    def _group_value(by, value):
+        """Convert a group from the database into its python value."""
+        if by in (None, "file", "label") or value is None:
+            return value
+        return util._metadata_str_to_py(value)
+
+    def _cached_roots(self, query):
+        """Return the roots of all the trees in the database which match a query.
+
+        Results are cached, keyed by the canonical form of the query (see
+        `lovett.planner.canonical`) and the version of the database, which
+        changes whenever trees are inserted or deleted.  The
+        `result_cache_size` most recently used results are cached in memory.
+        A file-backed database also caches the `result_cache_db_size` most
+        recently stored results of at most `result_cache_max_roots` trees in
+        the database file, so that they persist across sessions.  The
+        database cache is best-effort: reading it never writes to the file,
+        and a result is not stored if the file is read-only or locked by
+        another connection.  So unlike the in-memory cache it is first in,
+        first out: a hit does not save a result from eviction.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            list of int: The root ids, in ascending order.  The list must not
+            be modified.
+
+        """
+        key = planner.canonical(query)
+        conn = self._connection
+        version = conn.execute(self._statements["version"]).scalar()
+        with self._result_cache_lock:
+            entry = self._result_cache.get(key)
+            if entry is not None and entry[0] == version:
+                self._result_cache.move_to_end(key)
+                return entry[1]
+        roots = None
+        if self._file_backed:
+            blob = conn.execute(self._statements["cached_roots"],
+                                key=key, version=version).scalar()
+            if blob is not None:
+                roots = array.array("q")
+                roots.frombytes(blob)
+        if roots is None:
+            roots = self._roots_of(self._matching_nodes(query))
+            if self._file_backed and len(roots) <= self.result_cache_max_roots:
+                try:
+                    self._store_cached_roots(conn, key, version, roots)
+                except sqlalchemy.exc.OperationalError:
+                    # Read-only or locked by another connection: the
+                    # result is still cached in memory.
+                    pass
+        with self._result_cache_lock:
+            self._result_cache[key] = (version, roots)
+            self._result_cache.move_to_end(key)
+            while len(self._result_cache) > self.result_cache_size:
+                self._result_cache.popitem(last=False)
+        return roots
+
+    def _store_cached_roots(self, conn, key, version, roots):
+        """Store a query result in the database file.
+
+        The least recently stored results are evicted to keep at most
+        `result_cache_db_size` results.
+
+        Args:
+            conn (sqlalchemy.engine.Connection): A connection to the database.
+            key (str): The canonical form of the query.
+            version (int): The version of the database.
+            roots (array.array): The roots of the matching trees.
+
+        """
+        cache = self.result_cache_db
+        with conn.begin():
+            conn.execute(cache.insert().prefix_with("OR REPLACE"),
+                         query=key, version=version,
+                         roots=roots.tobytes(),
+                         last_used=time.time())
+            excess = conn.execute(select([sqlalchemy.func.count()]).select_from(cache)).scalar() - \
+                self.result_cache_db_size
+            if excess > 0:
+                conn.execute(cache.delete().where(cache.c.query.in_(
+                    select([cache.c.query]).order_by(cache.c.last_used).limit(excess))))
+
+    def clear_result_cache(self):
+        """Empty the cache of query results, in memory and in the database."""
+        with self._result_cache_lock:
+            self._result_cache.clear()
+        with self._connection.begin():
+            self._connection.execute(self.result_cache_db.delete())
+
+    def _restrict_roots(self, roots):
+        """Restrict roots of the whole database to those of this corpus.
+
+        Args:
+            roots (array.array): Root ids, in ascending order.
+
+        Returns:
+            array.array: The root ids which are also roots of this corpus.
+
+        """
+        if self._base is self:
+            return array.array("q", roots)
+        return _intersect_sorted(roots, self.roots)
+
+    def _matching_nodes(self, query):
+        """Return the ids of the nodes which match a query.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            list of int: The ids, in no particular order.
+
+        """
+        s = planner.optimize(query, self).sql(self)
+        return [x for x, in self._connection.execute(s)]
+
+    def _roots_of(self, nodes):
+        """Return the roots of the trees in the database containing some nodes.
+
+        The nodes of each tree have consecutive ids, starting from the id of
+        its root, so the root of a node is the greatest root id not greater
+        than its own id.
+
+        Args:
+            nodes (iterable of int): The ids of the nodes.
+
+        Returns:
+            array.array: The root ids, in ascending order and without
+            duplicates.
+
+        """
+        # The roots of the whole database, since a clone's roots need not
+        # include the root of every node (see `_restrict_roots`)
+        all_roots = self._base.roots
+        result = array.array("q")
+        limit = None
+        for node in sorted(nodes):
+            if limit is not None and node < limit:
+                # In the same tree as the previous node
+                continue
+            i = bisect.bisect_right(all_roots, node)
+            result.append(all_roots[i - 1])
+            limit = all_roots[i] if i < len(all_roots) else float("inf")
+        return result
+
+    def _stream_roots(self, query):
+        """Generate the roots of the trees which match a query.
+
+        If the result of the query is cached, the roots are taken from the
+        cache.  Otherwise, the matching nodes are read from the database in
+        order, each with the root of its tree, so that the roots can be
+        generated while the database is still searching.  This is only
+        possible if SQLite finds the nodes in order, as it does for a query
+        driven by a single index lookup (e.g. a text or metadata query).  If
+        it would have to sort the nodes (e.g. for a structural conjunction,
+        or labels matching several label ids) it finds all of them before
+        returning the first, so the whole result is found and cached instead,
+        and the following pages are read from the cache.  The result of a
+        streamed search is not cached.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Yields:
+            int: The root ids, in ascending order.
+
+        """
+        cached = self._memory_cached_roots(query)
+        if cached is not None:
+            yield from self._restrict_roots(cached)
+            return
+        matches = planner.optimize(query, self).sql(self).alias()
+        node = list(matches.columns)[0]
+        roots = self.roots_db
+        root = select([sqlalchemy.func.max(roots.c.id)]).where(roots.c.id <= node).scalar_subquery()
+        s = select([root]).select_from(matches).order_by(node)
+        if self._sorted_plan(s):
+            yield from self._restrict_roots(self._cached_roots(query))
+            return
+        result = self._connection.execute(s)
+        try:
+            previous = None
+            for root, in result:
+                if root != previous and (self._base is self or self._has_root(root)):
+                    yield root
+                previous = root
+        finally:
+            result.close()
+
+    def _combine(self, other, op):
+        """Combine the trees of two clones of the same database like sets.
+
+        This is used by the set operations of `lovett.corpus.ResultSet`.
+
+        Args:
+            other (CorpusDb): The other clone.
+            op (str): The operation: ``"&"``, ``"|"``, ``"-"`` or ``"^"``.
+
+        Returns:
+            CorpusDb: A clone with the trees of the result, in order.
+
+        """
+        if not isinstance(other, CorpusDb) or other._base is not self._base:
+            raise ValueError("Only results from the same corpus can be combined")
+        if op == "&":
+            roots = _intersect_sorted(self.roots, other.roots)
+        else:
+            keep = {"|": (True, True, True), "-": (True, False, False), "^": (True, False, True)}
+            roots = _combine_sorted(self.roots, other.roots, *keep[op])
+        return CorpusDb(self, roots)
+
+    def save_results(self, name, query):
+        """Save the nodes which match a query under a name.
+
+        The saved nodes can then be matched in later queries with
+        `lovett.query.in_result`, without evaluating the query again.  In a
+        file-backed corpus they persist across sessions.  Any results
+        already saved under the name are replaced.  If this corpus is a
+        clone (e.g. a result set), only the matches in its trees are saved.
+
+        Args:
+            name (str): The name to save the results under.
+            query (QueryFunction): The query.
+
+        """
+        s = planner.optimize(query, self).sql(self).alias()
+        node = list(s.columns)[0]
+        saved = self.saved_results
+        conn = self._connection
+        if self._base is self:
+            nodes = None
+        else:
+            nodes = [match.node for match in self.matching_nodes(query)]
+        with conn.begin():
+            conn.execute(self.saved_names.insert().prefix_with("OR IGNORE"), name=name)
+            conn.execute(saved.delete().where(saved.c.name == name))
+            if nodes is None:
+                conn.execute(saved.insert().from_select(
+                    ["name", "node_id"],
+                    select([sqlalchemy.literal(name), node]).select_from(s).distinct()))
+            elif len(nodes) > 0:
+                conn.execute(saved.insert(), [{"name": name, "node_id": x} for x in nodes])
+            # Results of queries using the name are now stale
+            self._bump_version(conn)
+        self._statistics.clear()
+
+    def drop_results(self, name):
+        """Delete the results saved under a name by `save_results`.
+
+        Args:
+            name (str): The name.
+
+        """
+        conn = self._connection
+        with conn.begin():
+            conn.execute(self.saved_names.delete().where(self.saved_names.c.name == name))
+            conn.execute(self.saved_results.delete().where(self.saved_results.c.name == name))
+            self._bump_version(conn)
+        self._statistics.clear()
+
+    def saved_result_names(self):
+        """Return the names of the results saved by `save_results`.
+
+        A name is listed even if no nodes are saved under it, because the
+        query matched nothing or the matching trees have since been deleted.
+
+        Returns:
+            list of str: The names, in alphabetical order.
+
+        """
+        names = self.saved_names
+        return [name for name, in self._connection.execute(
+            select([names.c.name]).order_by(names.c.name))]
+
+    def _memory_cached_roots(self, query):
+        """Return the roots of the trees matching a query, if they are cached.
+
+        Only the in-memory result cache is consulted (see `_cached_roots`).
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            array.array: The root ids of the whole database, in ascending
+            order, or ``None``.
+
+        """
+        key = planner.canonical(query)
+        version = self._connection.execute(self._statements["version"]).scalar()
+        with self._result_cache_lock:
+            entry = self._result_cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        return None
+
+    def _sample_roots(self, query, n, seed):
+        """Return the roots of a random sample of the trees matching a query.
+
+        If the query matches many trees, the trees of the corpus are tested
+        in a random order, in batches, until enough matches are found, so
+        that the cost is proportional to the size of the sample.  Testing
+        them needs the SQL for the query restricted to a tree to use
+        indexes; if it cannot (e.g. because part of the query has to be
+        computed for the whole database), or the query matches few trees, or
+        its result is cached, the sample is drawn from all the matches
+        instead.
+
+        Args:
+            query (QueryFunction): The query.
+            n (int): The size of the sample.
+            seed: The seed of the random number generator.
+
+        Returns:
+            array.array: The root ids of the sample, in ascending order.
+
+        """
+        rng = random.Random(seed)
+        roots = self._memory_cached_roots(query)
+        if roots is not None:
+            roots = self._restrict_roots(roots)
+        elif planner.estimate(query, self) < SAMPLE_MIN_RATIO * n or \
+                not self._indexed_plan(self._sample_sql(query, [0])):
+            roots = self._matching_roots(query)
+        if roots is not None:
+            indices = rng.sample(range(len(roots)), min(n, len(roots)))
+            return array.array("q", sorted(roots[i] for i in indices))
+        s = self._sample_sql(query, bindparam("candidates", expanding=True))
+        order = (self.roots[i] for i in util._random_order(len(self), rng))
+        sample = []
+        batch_size = 2 * n
+        while len(sample) < n:
+            batch = list(itertools.islice(order, batch_size))
+            if len(batch) == 0:
+                break
+            hits = set(x for x, in self._connection.execute(s, candidates=batch))
+            # The first hits in the random order, rather than those with the
+            # lowest ids, to keep the sample uniform
+            sample.extend(itertools.islice((x for x in batch if x in hits), n - len(sample)))
+            batch_size *= 2
+        return array.array("q", sorted(sample))
+
+    def _sample_sql(self, query, candidates):
+        """Build the SQL selecting which of some trees match a query.
+
+        Args:
+            query (QueryFunction): The query.
+            candidates: The root ids of the trees, or a bind parameter.
+
+        Returns:
+            sqlalchemy.sql.Select: The SQL, which selects the root ids of the
+            matching trees.
+
+        """
+        matches = planner.optimize(query, self).sql(self).alias()
+        node = list(matches.columns)[0]
+        roots = self.roots_db
+        return select([roots.c.id]).where(roots.c.id.in_(candidates)).where(
+            sqlalchemy.exists(select([node]).select_from(matches).
+                              where(node.between(roots.c.id, roots.c.last))))
+
+    def _indexed_plan(self, s):
+        """Return whether SQLite evaluates some SQL using only index searches."""
+        return not any(row[-1].startswith(("SCAN", "CO-ROUTINE", "MATERIALIZE"))
+                       for row in debug.xqp_sa(self, s))
+
+    def _sorted_plan(self, s):
+        """Return whether SQLite sorts the result of some SQL before returning it."""
+        return any(row[-1].startswith("USE TEMP B-TREE FOR ORDER BY")
+                   for row in debug.xqp_sa(self, s))
+
+    def _matching_roots(self, query):
+        """Return the roots of the trees which match a query.
+
+        Args:
+            query (QueryFunction): The query.
+
+        Returns:
+            list of int: The root ids, in ascending order.
+
+        """
+        return self._restrict_roots(self._cached_roots(query))
+
+    def explain(self, query, reconstitute=True):
+        """Explain how a query is evaluated against this corpus.
+
+        The query is run, and a report is returned showing the SQL generated
+        for it (after `lovett.planner.optimize`), SQLite's plan for the SQL
+        annotated with the lovett indexes it uses and the tables it scans
+        without an index, the estimated and actual number of matches of each
+        subquery, and the time taken by each stage of `matching_trees`:
+
+        - ``sql``: running the SQL which finds the matching nodes
+        - ``roots``: finding the trees which contain the matching nodes
+        - ``reconstitution``: building the matching trees from the database
+
+        Args:
+            query (QueryFunction): The query to explain.
+            reconstitute (bool): Whether to reconstitute the matching trees
+                (which can take a long time if there are many).
+
+        Returns:
+            lovett.debug.QueryReport: The report.  Its string representation
+            is human-readable.
+
+        """
+        optimized = planner.optimize(query, self)
+        s = optimized.sql(self)
+        report = debug.QueryReport(query, optimized, debug.compile_sql(self, s),
+                                   debug.xqp_sa(self, s),
+                                   set(index.name for table in self.metadata.sorted_tables
+                                       for index in table.indexes))
+        for subquery in debug.subqueries(optimized):
+            count = self._connection.execute(
+                select([sqlalchemy.func.count()]).select_from(subquery.sql(self).alias())
+            ).scalar()
+            report.subqueries.append((str(subquery), planner.estimate(subquery, self), count))
+        with report.stage("sql"):
+            nodes = [x for x, in self._connection.execute(s)]
+        with report.stage("roots"):
+            roots = self._restrict_roots(self._roots_of(nodes))
+        report.nodes = len(nodes)
+        report.trees = len(roots)
+        if reconstitute:
+            with report.stage("reconstitution"):
+                for root in roots:
+                    self._reconstitute(root)
+        return report
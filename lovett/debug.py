@@ -3,19 +3,153 @@ import cProfile
 import io
 import pstats
 import contextlib
+import re
+import time
+
+import lovett.query as Q
+import lovett.planner as planner
+
+
+#: A line of a query plan which scans a table without an index.  SQLite
+#: before 3.36 writes "SCAN TABLE x", later versions "SCAN x".
+_FULL_SCAN = re.compile(r"SCAN (?:TABLE )?(\w+)$")
 
 
 def xqp(corpusdb, query_text):
-    c = corpusdb.engine.connect()
+    c = corpusdb._connection
     return c.execute(sqlalchemy.sql.text("EXPLAIN QUERY PLAN " + query_text)).fetchall()
 
 
+def compile_sql(corpusdb, query_obj):
+    """Return the SQL text of a SQLAlchemy query, with its parameters inlined."""
+    return str(query_obj.compile(corpusdb.engine, compile_kwargs={"literal_binds": True}))
+
+
 def xqp_sa(corpusdb, query_obj):
-    c = corpusdb.engine.connect()
-    return c.execute(sqlalchemy.sql.text("EXPLAIN QUERY PLAN " +
-                                         str(query_obj.compile(corpusdb.engine,
-                                                               compile_kwargs={"literal_binds": True})))
-    ).fetchall()
+    return xqp(corpusdb, compile_sql(corpusdb, query_obj))
+
+
+def subqueries(query):
+    """Return a query and its subqueries, in preorder.
+
+    Args:
+        query (QueryFunction): The query.
+
+    Returns:
+        list of QueryFunction
+
+    """
+    if isinstance(query, Q.BinaryQueryFunction):
+        children = [query.left, query.right]
+    elif isinstance(query, (Q.Conjunction, Q.Disjunction)):
+        children = query.queries
+    elif isinstance(query, Q.Not):
+        children = [query.fn]
+    elif isinstance(query, Q.WrapperQueryFunction):
+        children = [query.query]
+    else:
+        children = []
+    return [query] + [x for child in children for x in subqueries(child)]
+
+
+class QueryReport(object):
+    """A report on the evaluation of a query, made by `CorpusDb.explain`.
+
+    Attributes:
+        query (QueryFunction): The query.
+        optimized (QueryFunction): The query as rewritten by
+            `lovett.planner.optimize`.
+        sql (str): The SQL run for the optimized query.
+        plan (list): The rows of SQLite's ``EXPLAIN QUERY PLAN`` for the
+            SQL: tuples of (id, parent id, unused, detail).
+        indexes (set of str): The names of the indexes of the database.
+        subqueries (list): For each subquery of the optimized query, a tuple
+            of its string representation, its estimated number of matches,
+            and its actual number of matches.
+        timings (list): For each stage of the evaluation, a tuple of its
+            name and the time it took (in seconds).
+        nodes (int): The number of matching nodes.
+        trees (int): The number of matching trees.
+
+    """
+    def __init__(self, query, optimized, sql, plan, indexes):
+        self.query = query
+        self.optimized = optimized
+        self.sql = sql
+        self.plan = plan
+        self.indexes = indexes
+        self.subqueries = []
+        self.timings = []
+        self.nodes = None
+        self.trees = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """A context manager which records the time taken by a stage."""
+        start = time.perf_counter()
+        yield
+        self.timings.append((name, time.perf_counter() - start))
+
+    def _annotate(self, detail):
+        """Explain a line of the query plan in terms of lovett's indexes."""
+        m = re.search(r"USING (COVERING )?INDEX (\w+)", detail)
+        if m is not None:
+            if m.group(2) in self.indexes:
+                return "index %s%s" % (m.group(2), " (covering)" if m.group(1) else "")
+            return "temporary index %s" % m.group(2)
+        if "USING INTEGER PRIMARY KEY" in detail:
+            return "primary key"
+        m = _FULL_SCAN.match(detail)
+        if m is not None and not m.group(1).startswith("anon_"):
+            return "full scan: no index used"
+        if "TEMP B-TREE" in detail:
+            return "sorted in a temporary b-tree"
+        return ""
+
+    @property
+    def indexes_used(self):
+        """set of str: The indexes of the database used by the plan."""
+        return set(m.group(1) for row in self.plan
+                   for m in [re.search(r"INDEX (\w+)", row[-1])]
+                   if m is not None and m.group(1) in self.indexes)
+
+    @property
+    def full_scans(self):
+        """list of str: The tables which the plan scans without an index."""
+        return [m.group(1) for row in self.plan
+                for m in [_FULL_SCAN.match(row[-1])]
+                if m is not None and not m.group(1).startswith("anon_")]
+
+    def __str__(self):
+        lines = ["Query: %s" % self.query,
+                 "Optimized: %s" % self.optimized,
+                 "",
+                 "SQL:",
+                 self.sql,
+                 "",
+                 "Plan:"]
+        depths = {0: -1}
+        for row in self.plan:
+            depth = depths.get(row[1], -1) + 1
+            depths[row[0]] = depth
+            note = self._annotate(row[-1])
+            lines.append("%s%s%s" % ("  " * depth, row[-1], "  <- " + note if note else ""))
+        unused = sorted(self.indexes - self.indexes_used)
+        lines.append("Indexes used: %s" % (", ".join(sorted(self.indexes_used)) or "none"))
+        lines.append("Indexes not used: %s" % (", ".join(unused) or "none"))
+        lines.append("")
+        lines.append("Subqueries (estimated / actual matches):")
+        for text, estimate, actual in self.subqueries:
+            lines.append("  %8d / %-8d %s" % (estimate, actual, text))
+        lines.append("")
+        lines.append("Stages:")
+        for name, seconds in self.timings:
+            lines.append("  %-15s %9.2f ms" % (name, seconds * 1000))
+        lines.append("Matched %s nodes in %s trees" % (self.nodes, self.trees))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return str(self)
 
 
 @contextlib.contextmanager
@@ -28,3 +162,48 @@ def profiled():
     ps = pstats.Stats(pr, stream=s).sort_stats("cumulative")
     ps.print_stats()
     print (s.getvalue())
+
+
+#: Query shapes which are common in practice, for use with `benchmark`.
+BENCHMARK_QUERIES = (
+    Q.label("NP"),
+    Q.dash_tag("SBJ"),
+    Q.label("IP") & Q.idoms(Q.label("NP-SBJ")),
+    Q.label("IP") & ~Q.idoms(Q.label("NP-SBJ")),
+    Q.label("IP") & Q.idoms(~Q.label("NP")),
+    Q.label("NP") & ~Q.doms(Q.label("CP")),
+)
+
+
+def benchmark(corpusdb, queries=BENCHMARK_QUERIES, repeat=3, optimize=True):
+    """Time the SQL of some queries against an indexed corpus.
+
+    Args:
+        corpusdb (CorpusDb): The corpus to query.
+        queries (list of QueryFunction): The queries to time.
+        repeat (int): How many times to run each query.
+        optimize (bool): Whether to time the SQL of the optimized query (see
+            `lovett.planner.optimize`), which is what
+            `CorpusDb.matching_trees` runs.
+
+    Returns:
+        list of tuple: For each query, its string representation, the number
+        of matching nodes, and the best time (in seconds) over the runs.
+
+    """
+    c = corpusdb._connection
+    results = []
+    for query in queries:
+        if optimize:
+            sql = planner.optimize(query, corpusdb).sql(corpusdb)
+        else:
+            sql = query.sql(corpusdb)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            count = len(c.execute(sql).fetchall())
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((str(query), count, best))
+    return results
@@ -22,6 +22,7 @@ import os.path
 
 import lovett.format as format
 import lovett.corpus as corpus
+import lovett.transform as transform
 
 # TODO: new classes in the hierarchy: CachingLoader, MutableLoader
 # The latter should implement a with: method to iterate through and modify its
@@ -40,16 +41,26 @@ class Loader(object):
 
     .. note:: TODO
 
-       * For speed/memory reasons , should this class have a method that
-         converts directly to a `CorpusDb` object, without passing through a
-         `Corpus` first?
        * Is there a way to use the superclass to implement the caching?  Perhaps
          it's too much hassle.
 
     """
 
-    def __init__(self, format=format.Penn):
+    def __init__(self, format=format.Penn, text_metadata=None):
+        """Initialize a Loader.
+
+        Args:
+            format: The format of the corpus files.
+            text_metadata (function): A function which receives the name of a
+                file and returns a dict of its text-level metadata (e.g.
+                ``YEAR``, ``AUTHOR``, ``GENRE``), which is added to the root
+                metadata of each of its trees.  `CorpusDb` indexes these keys
+                in its ``texts`` table (see `lovett.query.in_text`).  It must
+                be picklable to be used with `CorpusDb.ingest`.
+
+        """
         self._format = format
+        self._text_metadata = text_metadata
 
     @abc.abstractmethod
     def file(self, filename):
@@ -101,18 +112,67 @@ class Loader(object):
         if isinstance(files, str):
             files = (files,)
         for file in files or self.files():
-            contents = self.file(file)
-            fin = StringIO(contents)
-            try:
-                while True:
-                    tree = self._format.read(fin)
-                    tree.metadata.file = file
-                    c.append(tree)
-            except format.ParseEOF:  # TODO: potentially bogus if errors encountered?
-                pass
+            for tree in self.file_trees(file):
+                c.append(tree)
 
         return c
 
+    def to_db(self, files=None, batch_size=1000, **kwargs):
+        """Load files into a `CorpusDb`, without passing through a `Corpus`.
+
+        Trees are inserted into the database in batches as they are parsed,
+        so the memory needed stays flat regardless of the size of the corpus.
+        See `CorpusDb.insert_files`.
+
+        Args:
+            files (str or list of str): The files to include in the corpus.
+                Default is to include all available files.
+            batch_size (int): The number of trees to insert at a time.
+            **kwargs: Passed to the `CorpusDb` constructor (e.g.
+                ``filename``).
+
+        Returns:
+            CorpusDb: The corpus composed of all trees in all files.
+
+        """
+        import lovett.db as db
+        if isinstance(files, str):
+            files = (files,)
+        d = db.CorpusDb(**kwargs)
+        d.insert_files(self, files, batch_size)
+        return d
+
+    def file_trees(self, filename, contents=None):
+        """Parse the trees from one of the files of a corpus.
+
+        Args:
+            filename (str): The name of the file.
+            contents (str): The file's content, if it has already been
+                fetched with `file`.
+
+        Yields:
+            Tree: The trees of the file, in order.  The name of the file is
+            recorded in the ``FILE`` metadata key of each tree, along with
+            the text-level metadata of the file, if the loader has a
+            ``text_metadata`` function.
+
+        """
+        if contents is None:
+            contents = self.file(filename)
+        text_metadata = {}
+        if self._text_metadata is not None:
+            text_metadata = self._text_metadata(filename)
+        fin = StringIO(contents)
+        try:
+            while True:
+                tree = self._format.read(fin)
+                tree.metadata.file = filename
+                for key, value in text_metadata.items():
+                    tree.metadata[key] = value
+                yield tree
+        except format.ParseEOF:  # TODO: potentially bogus if errors encountered?
+            pass
+
 
 # TODO: add a method to allow authentication, for private repos
 _GITHUB = Github()
@@ -120,7 +180,7 @@ _GITHUB = Github()
 
 class GithubLoader(Loader):
     """A generic interface for fetching corpus files from a Github repo."""
-    def __init__(self, user, repo, ref="master", directory="", extension=".psd"):
+    def __init__(self, user, repo, ref="master", directory="", extension=".psd", **kwargs):
         """Initialize a GithubLoader.
 
         .. note:: TODO
@@ -138,8 +198,10 @@ class GithubLoader(Loader):
                 revision.
             directory (str): Path to the directory containing parsed files.
             extension (str): File extension of corpus files. Defaults to ".psd".
+            **kwargs: Passed to `Loader` (e.g. ``text_metadata``).
 
         """
+        super().__init__(**kwargs)
         self._user = user
         self._repo = repo
         self._tag = ref
@@ -189,7 +251,8 @@ class GithubLoader(Loader):
 ICEPAHC = GithubLoader(user="antonkarl",
                        repo="icecorpus",
                        ref="master",
-                       directory="finished")
+                       directory="finished",
+                       text_metadata=transform.icepahc_text_metadata)
 
 
 class FileLoader(Loader):
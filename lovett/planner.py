@@ -0,0 +1,438 @@
+"""Optimizing queries before they are evaluated against a `CorpusDb`.
+
+Queries are written as trees of binary operators, but the SQL generated
+directly from such a tree is not what SQLite plans best: ``And.sql`` joins two
+aliased subqueries at every level, and ``Or.sql`` nests unions pairwise.  The
+`optimize` function rewrites a query into an equivalent one whose SQL is
+flatter:
+
+* Chains of ``&`` and ``|`` are flattened into a single `Conjunction` or
+  `Disjunction`, and duplicate operands are removed.
+* Label queries (`label`, `dash_tag` and `label_set`) which are combined with
+  each other are merged into a single `label_set`, which is one indexed
+  ``IN`` lookup.  This works for disjunctions (the union of the labels),
+  conjunctions (the intersection) and negated labels in a conjunction (the
+  difference).  A regular expression matching more than
+  `MAX_LABEL_EXPANSION` labels is not merged, but evaluated by SQLite.
+* The operands of a conjunction are ordered by their estimated number of
+  matches, so that the most selective one drives the search.  Label queries
+  are estimated from the label frequencies of the corpus
+  (`CorpusDb.label_counts`), and other simple queries (texts, metadata) by a
+  bounded count.  Negated operands are merged into one anti-join and applied
+  last.
+* Text-level conditions (`in_text`) in a conjunction are merged, and pushed
+  down into the label queries at the leaves of the most selective operand,
+  which then only search the trees of the matching texts (see
+  `label_set`).  Structural relations never cross trees, so this is done
+  before any structural joins.  The conditions are also applied to the
+  results, as an indexed lookup of each result's root, before the other
+  operands.
+
+The optimized query is only used to generate SQL; `matching_trees` still
+reports (and colorizes) the query as the user wrote it.
+
+"""
+
+import copy
+import re
+
+from sqlalchemy.sql import select, func
+
+import lovett.query as Q
+
+
+#: Counts of matches of simple queries, which are used to estimate their
+#: selectivity, stop at this number.
+ESTIMATE_LIMIT = 10000
+
+
+def optimize(query, corpus):
+    """Rewrite a query into an equivalent one which is faster to evaluate.
+
+    Args:
+        query (QueryFunction): The query to optimize.
+        corpus (CorpusDb): The corpus which the query will be evaluated
+            against, whose statistics guide the optimization.
+
+    Returns:
+        QueryFunction: The optimized query.
+
+    """
+    if isinstance(query, (Q.And, Q.Conjunction)):
+        return _conjunction(_flatten(query, (Q.And, Q.Conjunction)), corpus)
+    elif isinstance(query, (Q.Or, Q.Disjunction)):
+        return _disjunction(_flatten(query, (Q.Or, Q.Disjunction)), corpus)
+    elif isinstance(query, Q.Not):
+        inner = optimize(query.fn, corpus)
+        if isinstance(inner, Q.Not):
+            return inner.fn
+        return Q.Not(inner)
+    elif isinstance(query, Q.WrapperQueryFunction):
+        wrapper = copy.copy(query)
+        wrapper.query = optimize(query.query, corpus)
+        return wrapper
+    else:
+        return query
+
+
+#: The attributes which `QueryFunction.colorize` sets on a query for
+#: display, which are not part of its meaning.
+_DISPLAY_ATTRIBUTES = frozenset(("idx", "color"))
+
+
+def canonical(query):
+    """Return a canonical string representation of a query.
+
+    Queries which differ only in the order, grouping or repetition of the
+    operands of ``&`` and ``|``, or in double negation, have the same
+    canonical representation.  It is used as the key of the result cache of
+    `CorpusDb`.
+
+    Args:
+        query (QueryFunction): The query.
+
+    Returns:
+        str
+
+    """
+    if isinstance(query, (Q.And, Q.Conjunction)):
+        operands = _flatten(query, (Q.And, Q.Conjunction))
+        return "(" + " & ".join(sorted(set(map(canonical, operands)))) + ")"
+    elif isinstance(query, (Q.Or, Q.Disjunction)):
+        operands = _flatten(query, (Q.Or, Q.Disjunction))
+        return "(" + " | ".join(sorted(set(map(canonical, operands)))) + ")"
+    elif isinstance(query, Q.Not):
+        if isinstance(query.fn, Q.Not):
+            return canonical(query.fn.fn)
+        return "~" + canonical(query.fn)
+    elif isinstance(query, Q.WrapperQueryFunction):
+        return "%s(%s)" % (query.name, canonical(query.query))
+    else:
+        # The string representation of a query does not escape its
+        # arguments, so distinct queries could share it
+        args = sorted((name, _canonical_value(value)) for name, value in vars(query).items()
+                      if not name.startswith("_") and name not in _DISPLAY_ATTRIBUTES)
+        return "%s(%s)" % (type(query).__name__,
+                           ", ".join("%s=%r" % arg for arg in args))
+
+
+def _canonical_value(value):
+    """Return a value of a query argument in a form with a stable `repr`.
+
+    Args:
+        value: The value.
+
+    Returns:
+        The value, with queries replaced by their canonical representation,
+        sets sorted and regular expressions by their pattern and flags.
+
+    """
+    if isinstance(value, Q.QueryFunction):
+        return canonical(value)
+    elif isinstance(value, (set, frozenset)):
+        return tuple(sorted(map(_canonical_value, value), key=repr))
+    elif isinstance(value, (list, tuple)):
+        return tuple(map(_canonical_value, value))
+    elif isinstance(value, re.Pattern):
+        return (value.pattern, value.flags)
+    return value
+
+
+def _flatten(query, types):
+    """Return the operands of a chain of boolean operators.
+
+    Args:
+        query (QueryFunction): The query.
+        types (tuple): The classes of the operators in the chain.
+
+    Returns:
+        list of QueryFunction
+
+    """
+    if not isinstance(query, types):
+        return [query]
+    elif isinstance(query, (Q.And, Q.Or)):
+        return _flatten(query.left, types) + _flatten(query.right, types)
+    else:
+        return [x for q in query.queries for x in _flatten(q, types)]
+
+
+def _optimize_operands(queries, types, corpus):
+    """Optimize the operands of a boolean operator.
+
+    The operands are optimized, flattened again (since optimizing an operand
+    can produce a chain of the same operator), and deduplicated.
+
+    Args:
+        queries (list of QueryFunction): The operands.
+        types (tuple): The classes of the operator.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        list of QueryFunction
+
+    """
+    result = []
+    seen = set()
+    for query in queries:
+        for operand in _flatten(optimize(query, corpus), types):
+            key = canonical(operand)
+            if key not in seen:
+                seen.add(key)
+                result.append(operand)
+    return result
+
+
+def _is_label(query):
+    if isinstance(query, Q.label_set):
+        return query.texts is None
+    return isinstance(query, Q.label)
+
+
+def _is_mergeable_label(query, corpus):
+    """Return whether a query is a label query which can be merged.
+
+    A regular expression which matches more than `MAX_LABEL_EXPANSION`
+    labels is not merged into a `label_set`, so that SQLite evaluates it
+    instead of receiving a long list of label ids (see `lovett.query.label`).
+
+    Args:
+        query (QueryFunction): The query.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        bool
+
+    """
+    if not _is_label(query):
+        return False
+    if isinstance(query, Q.label) and isinstance(query.label, re.Pattern):
+        return len(corpus.matching_label_ids(query.label)) <= Q.MAX_LABEL_EXPANSION
+    return True
+
+
+def _label_ids(query, corpus):
+    """Return the ids of the labels matched by a label query.
+
+    Args:
+        query (label or label_set): The query.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        frozenset of int
+
+    """
+    if isinstance(query, Q.label_set):
+        return frozenset(corpus._label_ids[label] for label in query.labels
+                         if label in corpus._label_ids)
+    return corpus.matching_label_ids(query._regex())
+
+
+def _label_set(ids, corpus):
+    """Return a `label_set` matching the labels with some ids."""
+    return Q.label_set(corpus._labels[i] for i in ids)
+
+
+def _conjunction(queries, corpus):
+    """Build an optimized conjunction.
+
+    Args:
+        queries (list of QueryFunction): The conjuncts.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        QueryFunction
+
+    """
+    queries = _optimize_operands(queries, (Q.And, Q.Conjunction), corpus)
+    texts = [q for q in queries if isinstance(q, Q.in_text)]
+    positives = [q for q in queries if not isinstance(q, (Q.Not, Q.in_text))]
+    negatives = [q.fn for q in queries if isinstance(q, Q.Not)]
+
+    labels = [q for q in positives if _is_mergeable_label(q, corpus)]
+    if len(labels) > 0:
+        ids = frozenset.intersection(*(_label_ids(q, corpus) for q in labels))
+        negative_labels = [q for q in negatives if _is_mergeable_label(q, corpus)]
+        for q in negative_labels:
+            ids -= _label_ids(q, corpus)
+        positives = [q for q in positives if q not in labels] + [_label_set(ids, corpus)]
+        negatives = [q for q in negatives if q not in negative_labels]
+
+    if len(negatives) == 0:
+        negative = None
+    elif len(negatives) == 1:
+        negative = Q.Not(negatives[0])
+    else:
+        # ~a & ~b is ~(a | b): one anti-join instead of several
+        negative = Q.Not(_disjunction(negatives, corpus))
+
+    if len(texts) == 0:
+        texts = None
+    elif len(texts) == 1:
+        texts = texts[0]
+    else:
+        texts = Q.in_text._merge(texts)
+
+    if len(positives) == 0:
+        if texts is None:
+            return negative
+        positives = [texts]
+    else:
+        positives.sort(key=lambda q: estimate(q, corpus))
+        if texts is not None:
+            positives[0] = _push_texts(positives[0], texts, corpus)
+            positives.insert(1, texts)
+    if negative is not None:
+        positives.append(negative)
+    if len(positives) == 1:
+        return positives[0]
+    return Q.Conjunction(positives)
+
+
+def _push_texts(query, texts, corpus):
+    """Restrict the label queries at the leaves of a query to some texts.
+
+    The label queries which are less selective than the texts are replaced
+    by a `label_set` which only searches the trees of the texts.  Other
+    queries are left alone, so the result may still match nodes outside the
+    texts.
+
+    Args:
+        query (QueryFunction): The query.
+        texts (in_text): The texts.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        QueryFunction: The restricted query.
+
+    """
+    if _is_label(query):
+        if _is_mergeable_label(query, corpus) and \
+                estimate(texts, corpus) < estimate(query, corpus):
+            return Q.label_set((corpus._labels[i] for i in _label_ids(query, corpus)),
+                               texts=texts)
+        return query
+    elif isinstance(query, Q.WrapperQueryFunction):
+        wrapper = copy.copy(query)
+        wrapper.query = _push_texts(query.query, texts, corpus)
+        return wrapper
+    elif isinstance(query, Q.Conjunction):
+        # Only the first conjunct drives the search
+        return Q.Conjunction([_push_texts(query.queries[0], texts, corpus)] +
+                             query.queries[1:])
+    elif isinstance(query, Q.Disjunction):
+        return Q.Disjunction([_push_texts(q, texts, corpus) for q in query.queries])
+    else:
+        return query
+
+
+def _disjunction(queries, corpus):
+    """Build an optimized disjunction.
+
+    Args:
+        queries (list of QueryFunction): The disjuncts.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        QueryFunction
+
+    """
+    queries = _optimize_operands(queries, (Q.Or, Q.Disjunction), corpus)
+    labels = [q for q in queries if _is_mergeable_label(q, corpus)]
+    if len(labels) > 1:
+        ids = frozenset.union(*(_label_ids(q, corpus) for q in labels))
+        queries = [q for q in queries if q not in labels] + [_label_set(ids, corpus)]
+    if len(queries) == 1:
+        return queries[0]
+    return Q.Disjunction(queries)
+
+
+def estimate(query, corpus):
+    """Estimate the number of nodes which match a query.
+
+    Args:
+        query (QueryFunction): The query.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        int
+
+    """
+    if _is_label(query):
+        counts = corpus.label_counts()
+        return sum(counts.get(i, 0) for i in _label_ids(query, corpus))
+    elif isinstance(query, Q.in_text):
+        return _text_node_count(query, corpus)
+    elif isinstance(query, Q.label_set):
+        # Restricted to some texts: assume the labels are spread evenly
+        # through the corpus
+        labels = estimate(Q.label_set(query.labels), corpus)
+        return labels * estimate(query.texts, corpus) // max(_node_count(corpus), 1)
+    elif isinstance(query, Q.Not):
+        return max(_node_count(corpus) - estimate(query.fn, corpus), 0)
+    elif isinstance(query, Q.WrapperQueryFunction):
+        # Each match of the wrapped query has at most a few parents or
+        # preceding sisters which match the wrapper, so this is only a rough
+        # estimate
+        return estimate(query.query, corpus)
+    elif isinstance(query, (Q.And, Q.Conjunction)):
+        return min(estimate(q, corpus) for q in _flatten(query, (Q.And, Q.Conjunction)))
+    elif isinstance(query, (Q.Or, Q.Disjunction)):
+        return min(sum(estimate(q, corpus) for q in _flatten(query, (Q.Or, Q.Disjunction))),
+                   _node_count(corpus))
+    else:
+        return _bounded_count(query, corpus)
+
+
+def _node_count(corpus):
+    """Return the number of nodes in the corpus."""
+    # Ids are assigned consecutively from 1
+    return corpus.id - 1
+
+
+def _text_node_count(query, corpus):
+    """Count the nodes in the trees of the texts matched by an `in_text` query.
+
+    This is computed from the id ranges of the trees, without touching the
+    nodes, and cached with the other statistics of the corpus.
+
+    Args:
+        query (in_text): The query.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        int
+
+    """
+    key = ("count", canonical(query))
+    count = corpus._statistics.get(key)
+    if count is None:
+        roots = query.roots_sql(corpus).alias()
+        count = corpus._connection.execute(
+            select([func.coalesce(func.sum(roots.c.last - roots.c.id + 1), 0)])
+        ).scalar()
+        corpus._statistics[key] = count
+    return count
+
+
+def _bounded_count(query, corpus):
+    """Count the matches of a query, up to `ESTIMATE_LIMIT`.
+
+    Counts are cached with the other statistics of the corpus.
+
+    Args:
+        query (QueryFunction): The query.
+        corpus (CorpusDb): The corpus.
+
+    Returns:
+        int
+
+    """
+    key = ("count", canonical(query))
+    count = corpus._statistics.get(key)
+    if count is None:
+        matches = query.sql(corpus).limit(ESTIMATE_LIMIT).alias()
+        count = corpus._connection.execute(
+            select([func.count()]).select_from(matches)).scalar()
+        corpus._statistics[key] = count
+    return count
@@ -41,13 +41,41 @@ import unicodedata
 import itertools
 import functools
 
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, and_, func
 from sqlalchemy.sql.expression import union
 
 from yattag import Doc
 import palettable.colorbrewer.qualitative as Colors
 
 import lovett.util as util
+import lovett.tree
+
+
+#: The largest number of label ids which a regular expression label query
+#: will list in its SQL.  Regular expressions matching more labels than this
+#: are evaluated by SQLite instead.
+MAX_LABEL_EXPANSION = 500
+
+
+def _regexp_source(rx):
+    """Return the source of a compiled regex, with its flags inlined.
+
+    Args:
+        rx (re.Pattern): A compiled regular expression.
+
+    Returns:
+        str: A pattern which `re.search` interprets like ``rx``.
+
+    """
+    flags = "".join(char for flag, char in ((re.IGNORECASE, "i"),
+                                            (re.MULTILINE, "m"),
+                                            (re.DOTALL, "s"),
+                                            (re.VERBOSE, "x"),
+                                            (re.ASCII, "a"))
+                    if rx.flags & flag)
+    if flags:
+        return "(?%s)%s" % (flags, rx.pattern)
+    return rx.pattern
 
 
 # Node colorization helpers
@@ -153,6 +181,58 @@ def match_function(fn):
     return _match_function
 
 
+def _in_query(column, query, corpus):
+    """Return a SQL condition that a column holds the id of a matching node.
+
+    Negations are peeled off the query and turned into a ``NOT IN`` anti-join
+    against the negated query, so that the complement of the negated query
+    (which would contain most of the nodes in the corpus) is never
+    materialized.
+
+    Args:
+        column (sqlalchemy.sql.expression.ColumnElement): The column of node
+            ids.
+        query (QueryFunction): The query the nodes must match.
+        corpus (CorpusDb): The corpus against which the query will be
+            evaluated.
+
+    Returns:
+        sqlalchemy.sql.expression.ColumnElement
+
+    """
+    negated = False
+    while isinstance(query, Not):
+        query = query.fn
+        negated = not negated
+    if isinstance(query, in_text):
+        # A lookup of the node's root, rather than a list of all the nodes
+        # in the matching texts
+        condition = query.filter_sql(column, corpus)
+        return ~condition if negated else condition
+    if negated:
+        return column.notin_(query.sql(corpus))
+    return column.in_(query.sql(corpus))
+
+
+def _id_column(s):
+    """Return the column of node ids of an aliased query.
+
+    Args:
+        s (sqlalchemy.sql.expression.Alias): The query.
+
+    Returns:
+        sqlalchemy.sql.expression.ColumnElement
+
+    """
+    # FIXME: this is a really stupid way of getting the right column to
+    # join on.
+    for name in ("id", "left", "parent"):
+        c = s.columns.get(name)
+        if c is not None:
+            return c
+    return s.columns.get("rowid")
+
+
 class QueryFunction(metaclass=abc.ABCMeta):
     """Parent for all query functions in the Lovett query language.
 
@@ -500,28 +580,28 @@ class And(BinaryQueryFunction):
             return result
 
     def sql(self, corpus):
+        if isinstance(self.left, Not) and isinstance(self.right, Not):
+            # De Morgan: one anti-join instead of two
+            return Not(Or(self.left.fn, self.right.fn)).sql(corpus)
+        if isinstance(self.left, Not) or isinstance(self.right, Not):
+            # Filter the positive side with an anti-join against the negated
+            # side, rather than joining it with the complement of the negated
+            # side
+            if isinstance(self.left, Not):
+                positive, negative = self.right, self.left
+            else:
+                positive, negative = self.left, self.right
+            p = positive.sql(corpus).alias()
+            pc = _id_column(p)
+            return select([pc]).where(_in_query(pc, negative, corpus))
         # We need aliases here so we get the two subqueries as anon_1 and
         # anon_2.  Then our ON clause is "ON anon_1.rowid = anon_2.rowid".  If
         # we didn't do this, we could get "ON rowid = rowid", which SQLite
         # doesn't like.
         l = self.left.sql(corpus).alias()
-        # FIXME: this is a really stupid way of getting the right column to
-        # join on.
-        lc = l.columns.get("id")
-        if lc is None:
-            lc = l.columns.get("left")
-        if lc is None:
-            lc = l.columns.get("parent")
-        if lc is None:
-            lc = l.columns.get("rowid")
+        lc = _id_column(l)
         r = self.right.sql(corpus).alias()
-        rc = r.columns.get("id")
-        if rc is None:
-            rc = r.columns.get("left")
-        if rc is None:
-            rc = r.columns.get("parent")
-        if rc is None:
-            rc = r.columns.get("rowid")
+        rc = _id_column(r)
         # Select the left column arbitrarily, since it doesn't matter which we
         # use.  One might think we could use l.join(r).select(lc), but that
         # gives an incorrect result, per the SQLAlchemy API.
@@ -575,6 +655,97 @@ class Or(BinaryQueryFunction):
         return self.left._get_match_nodes() + self.right._get_match_nodes()
 
 
+class _NaryQueryFunction(QueryFunction):
+    """Common functionality for n-ary boolean combinations of queries.
+
+    These are produced by `lovett.planner.optimize` from chains of binary
+    ``&`` and ``|``, so that the SQL for the chain is flat.
+
+    """
+    def __init__(self, symbol, name, queries):
+        self._symbol = symbol
+        self._name = name
+        self.queries = list(queries)
+
+    def __str__(self):
+        return "(" + (" " + self._symbol + " ").join(map(str, self.queries)) + ")"
+
+    def _to_html(self, doc, idx):
+        doc, tag, txt = doc.tagtext()
+        with tag("span", klass="searchnode searchnode-%s" % self._name):
+            self._try_color(doc)
+            txt("(")
+            for i, query in enumerate(self.queries):
+                if i > 0:
+                    txt(" " + self._symbol + " ")
+                idx = query._to_html(doc, idx)
+            txt(")")
+        return idx
+
+    def freduce(self, fn, *args):
+        for query in self.queries:
+            args = query.freduce(fn, *args)
+        return _freduce_result(fn(self, *args))
+
+    @property
+    def is_marking(self):
+        return all(query.is_marking for query in self.queries)
+
+
+class Conjunction(_NaryQueryFunction):
+    """This class implements conjunction of several query functions.
+
+    In indexed mode, the first query drives the search, and the others filter
+    its results (with ``IN`` or, for negated queries, ``NOT IN``).  The first
+    query should therefore be the most selective one, and it must not be
+    negated.
+
+    """
+    def __init__(self, queries):
+        super().__init__("&", "and", queries)
+
+    @match_function
+    def match_tree(self, tree, mark=False):
+        result = all(query.match_tree(tree, mark=False) for query in self.queries)
+        if result and mark:
+            for query in self.queries:
+                query.match_tree(tree, mark=True)
+        return result
+
+    def sql(self, corpus):
+        first = self.queries[0].sql(corpus).alias()
+        c = _id_column(first)
+        return select([c]).where(and_(*(_in_query(c, query, corpus)
+                                        for query in self.queries[1:])))
+
+    def _get_match_nodes(self):
+        if self.is_marking:
+            return (self.idx,)
+        return tuple(itertools.chain.from_iterable(query._get_match_nodes()
+                                                   for query in self.queries))
+
+
+class Disjunction(_NaryQueryFunction):
+    """This class implements disjunction of several query functions."""
+    def __init__(self, queries):
+        super().__init__("|", "or", queries)
+
+    @match_function
+    def match_tree(self, tree, mark=False):
+        if not mark:
+            return any(query.match_tree(tree, mark) for query in self.queries)
+        # Evaluate all the queries for their side-effects
+        results = [query.match_tree(tree, mark) for query in self.queries]
+        return any(results)
+
+    def sql(self, corpus):
+        return union(*(query.sql(corpus) for query in self.queries))
+
+    def _get_match_nodes(self):
+        return tuple(itertools.chain.from_iterable(query._get_match_nodes()
+                                                   for query in self.queries))
+
+
 class Not(QueryFunction):
     """This class implements negation of query functions."""
     def __init__(self, fn):
@@ -585,8 +756,10 @@ class Not(QueryFunction):
         return not self.fn.match_tree(tree, mark)
 
     def sql(self, corpus):
+        # An anti-join: SQLite materializes the negated query once, and then
+        # probes it for each node
         return select([corpus.nodes.c.rowid]).where(
-            corpus.nodes.c.rowid != self.fn.sql(corpus)
+            _in_query(corpus.nodes.c.rowid, self, corpus)
         )
 
     def __str__(self):
@@ -741,10 +914,9 @@ class idoms(WrapperQueryFunction):
         return False
 
     def sql(self, corpus):
-        s = self.query.sql(corpus)
         return select([corpus.dom.c.parent]).where(
             (corpus.dom.c.depth == 1) &
-            (corpus.dom.c.child.in_(s))
+            _in_query(corpus.dom.c.child, self.query, corpus)
         ).distinct()
 
 
@@ -777,10 +949,9 @@ class doms(WrapperQueryFunction):
         return False
 
     def sql(self, corpus):
-        s = self.query.sql(corpus)
         return select([corpus.dom.c.parent]).where(
             (corpus.dom.c.depth > 0) &
-            (corpus.dom.c.child.in_(s))
+            _in_query(corpus.dom.c.child, self.query, corpus)
         ).distinct()
 
 
@@ -842,14 +1013,16 @@ class label(MarkingQueryFunction):
     expression is matched against the label.  In this case the ``exact``
     parameter is ignored.
 
-    .. caution:: Indexed mode operation
+    .. note:: Indexed mode operation
 
-       Note that regular expression matching is not yet implemented in indexed
-       (SQL) mode.  It might be possible to implement this, but it will be
-       slow.  It is better to use one of the specialized label matching
-       functions.  If you find a common use case for which a label matching
-       function does not exist, please open an issue report.  (TODO: link to
-       github issues page)
+       In indexed (SQL) mode, a regular expression is matched in python
+       against the corpus's vocabulary of distinct labels (see
+       `CorpusDb.matching_label_ids`), and the matching nodes are found by an
+       indexed lookup on the resulting label ids.  If a compiled regular
+       expression matches more than `MAX_LABEL_EXPANSION` distinct labels,
+       it is instead evaluated by SQLite's ``REGEXP`` operator against the
+       label table.  Objects with a ``search`` method which are not compiled
+       regular expressions are always expanded.
 
     Attributes:
         label: the label to match
@@ -869,37 +1042,64 @@ class label(MarkingQueryFunction):
         self.label = label
         self.exact = exact
 
-    @match_function
-    def match_tree(self, tree, mark=False):
+    def _regex(self):
+        """Return a regular expression (or other object with a ``search``
+        method) which matches the same labels as this query."""
         if hasattr(self.label, "search"):
-            rx = self.label
+            return self.label
+        label = re.escape(self.label)
+        if self.exact:
+            return re.compile("^" + label + "$")
         else:
-            label = re.escape(self.label)
-            if self.exact:
-                rx = re.compile("^" + label + "$")
-            else:
-                rx = re.compile("^" + label + "(-|$)")
-        if rx.search(tree.label):
+            return re.compile("^" + label + "(-|$)")
+
+    @match_function
+    def match_tree(self, tree, mark=False):
+        if self._regex().search(tree.label):
             return True
         else:
             return False
 
     def sql(self, corpus):
+        return select([corpus.nodes.c.rowid]).where(
+            corpus.nodes.c.label_id.in_(self._label_ids_sql(corpus))
+        )
+
+    def _label_ids_sql(self, corpus):
+        """Return the ids of the matching labels.
+
+        Labels are matched against the (small) table of distinct labels, so
+        that the nodes themselves can then be found by an indexed lookup on
+        their label id.
+
+        Returns:
+            A SQLAlchemy select of label ids, or a list of label ids.
+
+        """
+        labels = corpus.labels
         if hasattr(self.label, "search"):
-            raise Exception("Regular expression label matching not implemented for indexed corpora")
+            ids = corpus.matching_label_ids(self.label)
+            if len(ids) > MAX_LABEL_EXPANSION and isinstance(self.label, re.Pattern):
+                return select([labels.c.rowid]).where(
+                    labels.c.label.regexp_match(_regexp_source(self.label))
+                )
+            return sorted(ids)
         if "%" in self.label or "_" in self.label:
             # TODO: fix this, ideally by enforcing labels to fall in [A-Z0-9+-]
             raise Exception("Illegal characters in label")
         if self.exact:
-            return select([corpus.nodes.c.rowid]).where(
-                corpus.nodes.c.label == self.label
-            )
+            return select([labels.c.rowid]).where(labels.c.label == self.label)
+        elif "-" not in self.label:
+            # The label matches exactly or with one or more dash tags, which
+            # is to say that it is the base of the label.
+            dashtags = corpus.label_dashtags
+            return select([dashtags.c.label_id]).where(dashtags.c.base == self.label)
         else:
             # Either we match the label exactly, or the label plus one or more
             # dash tags
-            return select([corpus.nodes.c.rowid]).where(
-                (corpus.nodes.c.label == self.label) |
-                corpus.nodes.c.label.like(self.label + "-%")
+            return select([labels.c.rowid]).where(
+                (labels.c.label == self.label) |
+                labels.c.label.like(self.label + "-%")
             )
 
     def _args(self):
@@ -907,6 +1107,49 @@ class label(MarkingQueryFunction):
                              ", exact=True" if self.exact else "")
 
 
+class label_set(MarkingQueryFunction):
+    """This class implements matching a node label against a set of labels.
+
+    Labels are matched exactly.  In indexed mode, this is a single indexed
+    ``IN`` lookup on the ids of the labels, so it is the fastest way to match
+    several labels at once.  (`lovett.planner.optimize` rewrites
+    combinations of label queries into this form.)
+
+    The search can also be restricted to the trees of some texts, given as
+    an `in_text` query.  In indexed mode, the nodes are then looked up by
+    id range within the roots of those texts.  (`lovett.planner.optimize`
+    pushes `in_text` conjuncts down into label queries in this way, when the
+    texts are more selective than the labels.)
+
+    Attributes:
+        labels (frozenset of str): the labels to match.
+        texts (in_text): the texts to search, or ``None`` for all of them.
+
+    """
+    def __init__(self, labels, texts=None):
+        super().__init__("label_set")
+        self.labels = frozenset(labels)
+        self.texts = texts
+
+    def _args(self):
+        args = "{%s}" % ", ".join("\"%s\"" % label for label in sorted(self.labels))
+        if self.texts is not None:
+            args += ", texts=%s" % self.texts
+        return args
+
+    @match_function
+    def match_tree(self, tree, mark=False):
+        return tree.label in self.labels and \
+            (self.texts is None or self.texts.match_tree(tree))
+
+    def sql(self, corpus):
+        ids = sorted(corpus._label_ids[label] for label in self.labels
+                     if label in corpus._label_ids)
+        if self.texts is None:
+            return select([corpus.nodes.c.rowid]).where(corpus.nodes.c.label_id.in_(ids))
+        return self.texts.sql(corpus).where(corpus.nodes.c.label_id.in_(ids))
+
+
 class dash_tag(label):
     """This class implements matching a dash tag against a node label.
 
@@ -927,11 +1170,17 @@ class dash_tag(label):
     def _args(self):
         return "\"%s\"" % self.tag
 
-    def sql(self, corpus):
-        return select([corpus.nodes.c.rowid]).where(
-            corpus.nodes.c.label.like("%-" + self.tag + "-%") |
-            corpus.nodes.c.label.like("%-" + self.tag)
-        )
+    def _label_ids_sql(self, corpus):
+        if "-" in self.tag:
+            # Spans several dash tags, so it can't be found in the
+            # decomposition table
+            labels = corpus.labels
+            return select([labels.c.rowid]).where(
+                labels.c.label.like("%-" + self.tag + "-%") |
+                labels.c.label.like("%-" + self.tag)
+            )
+        dashtags = corpus.label_dashtags
+        return select([dashtags.c.label_id]).where(dashtags.c.tag == self.tag)
 
 
 class sprec(WrapperQueryFunction):
@@ -960,7 +1209,7 @@ class sprec(WrapperQueryFunction):
     def sql(self, corpus):
         return select([corpus.sprec.c.left]).where(
             (corpus.sprec.c.distance > 0) &
-            (corpus.sprec.c.right.in_(self.query.sql(corpus)))
+            _in_query(corpus.sprec.c.right, self.query, corpus)
         ).distinct()
 
 
@@ -988,63 +1237,592 @@ class isprec(WrapperQueryFunction):
     def sql(self, corpus):
         return select([corpus.sprec.c.left]).where(
             (corpus.sprec.c.distance == 1) &
-            (corpus.sprec.c.right.in_(self.query.sql(corpus)))
+            _in_query(corpus.sprec.c.right, self.query, corpus)
         ).distinct()
 
 # TODO: convenience fns sprec_multiple and sprec_multiple_ordered like for
 # doms
 
 
+#: A regex for the characters of a word in the full-text index of a
+#: `CorpusDb` (see `lovett.db.FTS_TOKENIZE`): letters, digits, combining
+#: diacritics, and some corpus-specific characters.
+_WORD_CHAR = r"(?:[^\W_]|[\u0300-\u036f\-$@+])"
+
+
+def _word_regex(word, prefix=False):
+    """Return a regex matching a word (or a prefix of one) in a string.
+
+    The match is case-insensitive, and must begin (and, unless ``prefix`` is
+    true, end) at a word boundary, as in the full-text index of a `CorpusDb`.
+
+    Args:
+        word (str): The word.
+        prefix (bool): Whether the word is only a prefix.
+
+    Returns:
+        str
+
+    """
+    rx = "(?i)(?<!%s)%s" % (_WORD_CHAR, re.escape(word))
+    if not prefix:
+        rx += "(?!%s)" % _WORD_CHAR
+    return rx
+
+
 class text(MarkingQueryFunction):
     """This class implements matching text of leaf nodes.
 
+    The text is matched in one of three modes:
+
+    - ``"exact"`` (the default): the text of the leaf is equal to ``text``
+    - ``"prefix"``: the text of the leaf contains a word beginning with
+      ``text``, ignoring case
+    - ``"fts"``: the text of the leaf contains the word ``text``, ignoring
+      case; a word ending in ``*`` is a prefix, as in the full-text search
+      syntax of SQLite
+
+    In every mode, a ``text`` with several space-separated words matches a
+    phrase: the first of a sequence of adjacent words (leaves other than
+    empty categories) in a tree, each of which matches the corresponding
+    word.  In the ``"prefix"`` and ``"fts"`` modes, a word can be preceded
+    by ``lemma:`` to match the ``LEMMA`` metadata of the leaf instead of its
+    text.  For example, ``text("lemma:hafa a*", mode="fts")`` matches a form
+    of *hafa* followed by a word beginning with *a*.  In these modes, words
+    may only contain letters, digits and the characters ``-$@+``, since
+    punctuation is not indexed.
+
+    In indexed mode, exact single words are looked up in the metadata table,
+    and other words in the full-text index of the corpus, which makes prefix
+    searches fast.  (If SQLite lacks FTS5, the metadata table is scanned
+    with a regular expression instead.)  The words of a phrase are joined on
+    their positions.
+
     .. note:: TODO
 
        matching regexp, set
     """
-    def __init__(self, text):
+    MODES = ("exact", "prefix", "fts")
+
+    def __init__(self, text, mode="exact"):
+        """Initializer.
+
+        Args:
+            text (str): The text to match.
+            mode (str): How to match it; see the class docstring.
+
+        """
         super().__init__("text")
+        if mode not in self.MODES:
+            raise ValueError("Unknown text mode: %s" % mode)
         self.text = text
+        self.mode = mode
+        if mode != "exact":
+            for _, word, _ in self._words():
+                if re.fullmatch("%s+" % _WORD_CHAR, word) is None:
+                    raise ValueError("Not a searchable word: %s" % word)
 
     def _args(self):
-        return "\"%s\"" % self.text
+        if self.mode == "exact":
+            return "\"%s\"" % self.text
+        return "\"%s\", mode=\"%s\"" % (self.text, self.mode)
+
+    def _words(self):
+        """Return the words of the text.
+
+        Returns:
+            list of tuple: The field to match (``"text"`` or ``"lemma"``),
+            the word, and whether it is a prefix, for each word.
+
+        """
+        if self.mode == "exact":
+            return [("text", word, False) for word in self.text.split()]
+        words = []
+        for word in self.text.split():
+            field = "text"
+            if word.startswith("lemma:"):
+                field, word = "lemma", word[len("lemma:"):]
+            if self.mode == "prefix":
+                words.append((field, word, True))
+            else:
+                words.append((field, word.rstrip("*"), word.endswith("*")))
+        return words
+
+    def _match_word(self, leaf, field, word, prefix):
+        """Return whether a leaf matches one word of the text."""
+        value = leaf.text if field == "text" else leaf.metadata.get("LEMMA")
+        if value is None:
+            return False
+        if self.mode == "exact":
+            return value == word
+        return re.search(_word_regex(word, prefix), value) is not None
 
     @match_function
     def match_tree(self, tree, mark=False):
-        return util.is_leaf(tree) and tree.text == self.text
+        if not util.is_leaf(tree):
+            return False
+        words = self._words()
+        if self.mode == "exact" and len(words) == 1:
+            return tree.text == self.text
+        if not util.means_leaf(tree):
+            return False
+        leaves = [node for node in tree.root.nodes() if util.means_leaf(node)]
+        i = next(i for i, leaf in enumerate(leaves) if leaf is tree)
+        if i + len(words) > len(leaves):
+            return False
+        return all(self._match_word(leaf, *word) for leaf, word in zip(leaves[i:], words))
+
+    def _word_sql(self, corpus, field, word, prefix):
+        """Return a SQLAlchemy select of the ids of the leaves matching a word.
+
+        Args:
+            corpus (CorpusDb): The corpus.
+            field (str): ``"text"`` or ``"lemma"``.
+            word (str): The word.
+            prefix (bool): Whether the word is a prefix.
+
+        Returns:
+            sqlalchemy.sql.expression.Select
+
+        """
+        md = corpus.tree_metadata
+        key = "text" if field == "text" else "LEMMA"
+        if self.mode == "exact":
+            return select([md.c.id]).where((md.c.key == key) & (md.c.value == word))
+        if corpus.has_fts:
+            fts = corpus.leaf_fts
+            expression = "%s : \"%s\"%s" % (field, word.replace("\"", "\"\""),
+                                              " *" if prefix else "")
+            return select([fts.c.rowid]).where(fts.c.leaf_fts.match(expression))
+        return select([md.c.id]).where((md.c.key == key) &
+                                       md.c.value.regexp_match(_word_regex(word, prefix)))
 
     def sql(self, corpus):
-        return select([corpus.tree_metadata.c.id]).where(
-            (corpus.tree_metadata.c.key == "text") &
-            (corpus.tree_metadata.c.value == self.text)
-        )
+        words = self._words()
+        if self.mode == "exact" and len(words) == 1:
+            return select([corpus.tree_metadata.c.id]).where(
+                (corpus.tree_metadata.c.key == "text") &
+                (corpus.tree_metadata.c.value == self.text)
+            )
+        if len(words) == 1 and corpus.has_fts:
+            return self._word_sql(corpus, *words[0])
+        leaves = [corpus.leaves.alias() for _ in words]
+        first = leaves[0]
+        conditions = []
+        for i, (leaf, word) in enumerate(zip(leaves, words)):
+            leaf_id = leaf.c.id
+            if i > 0:
+                conditions.append(leaf.c.root == first.c.root)
+                conditions.append(leaf.c.position == first.c.position + i)
+                # Otherwise SQLite looks the later leaves up by each id
+                # matching their word, for every match of the first word,
+                # rather than by position and then checking their word
+                leaf_id = leaf_id + 0
+            conditions.append(leaf_id.in_(self._word_sql(corpus, *word)))
+        return select([first.c.id]).where(and_(*conditions))
 
 
 class has_metadata(MarkingQueryFunction):
     """Metadata queries.
 
+    With only a ``key``, this matches nodes which have that metadata key at
+    all.  Otherwise, the value of the key is matched in one of the following
+    ways:
+
+    - if ``value`` is a string, integer, or boolean, the value must be equal
+      to it
+    - if ``value`` is a set (or other collection), the value must be equal
+      to one of its members
+    - if ``prefix`` is true, ``value`` must be a string, and the value must
+      begin with it
+    - if ``between`` is given, it must be a ``(low, high)`` pair, and the
+      value must be an integer between ``low`` and ``high`` (inclusive).
+      Either bound can be ``None``, to leave the range open on that side.
+
+    Values are compared as they are written in a corpus file, so that
+    ``has_metadata("year", 1150)`` and ``has_metadata("year", "1150")`` are
+    equivalent.  Keys are normalized as in `lovett.tree.Metadata`, and nested
+    keys are written with a colon, as in ``"ALT-ORTHO:FOO"``.
+
+    In indexed mode, the queries are answered from covering indexes on the
+    ``(key, value, id)`` and ``(key, num, id)`` columns of the metadata table.
+
     .. note:: TODO
 
-        - blocked on properly handling metadata in `CorpusDb._insert_node` (can now complete)
         - Should it be marking? Probably yes
     """
-    def __init__(self, key, value):
+    def __init__(self, key, value=None, prefix=False, between=None):
+        """Initializer.
+
+        Args:
+            key (str): The metadata key.
+            value: The value to match; see the class docstring for details.
+            prefix (bool): Whether ``value`` is a prefix of the value.
+            between (tuple): Bounds for an integer value.
+
+        """
         super().__init__("has_metadata")
-        self.key = key
+        self.key = ":".join(lovett.tree._check_metadata_name(k) for k in key.split(":"))
+        if isinstance(value, collections.abc.Iterable) and not isinstance(value, str):
+            value = frozenset(value)
+        if prefix and not isinstance(value, str):
+            raise ValueError("A prefix must be a string: %s" % (value,))
+        if between is not None and value is not None:
+            raise ValueError("Cannot match both a value and a range")
         self.value = value
+        self.prefix = prefix
+        self.between = between
 
     def _args(self):
-        return "\"%s\", \"%s\"" % (self.key, self.value)
+        args = ["\"%s\"" % self.key]
+        if isinstance(self.value, frozenset):
+            args.append("{%s}" % ", ".join(sorted(map(repr, self.value))))
+        elif self.value is not None:
+            args.append(repr(self.value).replace("'", "\""))
+        if self.prefix:
+            args.append("prefix=True")
+        if self.between is not None:
+            args.append("between=%r" % (tuple(self.between),))
+        return ", ".join(args)
+
+    def _values(self):
+        """Return the strings which the value must equal.
+
+        Returns:
+            set of str
+
+        """
+        if isinstance(self.value, frozenset):
+            return set(map(util._metadata_py_to_str, self.value))
+        return {util._metadata_py_to_str(self.value)}
 
     @match_function
     def match_tree(self, tree, mark=False):
-        return self.key.upper() in tree.metadata and tree.metadata[self.key.upper()] == self.value
+        value = tree.metadata
+        for k in self.key.split(":"):
+            if not isinstance(value, lovett.tree.Metadata) or k not in value:
+                return False
+            value = value[k]
+        if self.between is not None:
+            num = util._metadata_py_to_num(value)
+            low, high = self.between
+            return num is not None and \
+                (low is None or low <= num) and \
+                (high is None or num <= high)
+        if self.value is None:
+            return True
+        if isinstance(value, lovett.tree.Metadata):
+            return False
+        value = util._metadata_py_to_str(value)
+        if self.prefix:
+            return value.startswith(self.value)
+        return value in self._values()
 
     def sql(self, corpus):
-        raise NotImplemented()
+        md = corpus.tree_metadata
+        cond = md.c.key == self.key
+        if self.between is not None:
+            low, high = self.between
+            cond &= md.c.num.isnot(None)
+            if low is not None:
+                cond &= md.c.num >= low
+            if high is not None:
+                cond &= md.c.num <= high
+        elif self.prefix:
+            # A range rather than LIKE, so that the index can be used without
+            # escaping the prefix
+            cond &= (md.c.value >= self.value) & (md.c.value < self.value + "\U0010ffff")
+        elif self.value is not None:
+            values = self._values()
+            if len(values) == 1:
+                cond &= md.c.value == values.pop()
+            else:
+                cond &= md.c.value.in_(sorted(values))
+        return select([md.c.id]).where(cond)
+
 
 class lemma(has_metadata):
-    def __init__(self, lemma):
-        super().__init__("lemma", unicodedata.normalize("NFD", lemma))
-        # TODO: how to get this to print as lemma("foo") and not
-        # has_metadata("lemma", "foo")
+    """Lemma queries.
+
+    Matches nodes with the given ``LEMMA`` metadata, such as that added by
+    `lovett.transform.icepahc_lemma`.  Lemmata are compared in Unicode NFD
+    normal form, as they are stored.
+
+    """
+    def __init__(self, lemma, prefix=False):
+        """Initializer.
+
+        Args:
+            lemma (str): The lemma to match.
+            prefix (bool): Whether ``lemma`` is only a prefix of the lemma.
+
+        """
+        super().__init__("lemma", unicodedata.normalize("NFD", lemma), prefix=prefix)
+        self._name = "lemma"
+
+    def _args(self):
+        return "\"%s\"%s" % (self.value, ", prefix=True" if self.prefix else "")
+
+
+class in_text(MarkingQueryFunction):
+    """Text-level metadata queries.
+
+    Matches all the nodes of the trees from texts whose metadata satisfy some
+    conditions.  The conditions are given as keyword arguments, whose names
+    are a field of the text, optionally followed by a lookup:
+
+    - ``field=value``: the field is equal to ``value``
+    - ``field__in=values``: the field is equal to one of ``values``
+    - ``field__between=(low, high)``: the field is between ``low`` and
+      ``high`` (inclusive)
+    - ``field__lt``, ``field__lte``, ``field__gt``, ``field__gte``: the field
+      is less than (or equal to), or greater than (or equal to), the value
+
+    The fields are ``file``, ``year``, ``author`` and ``genre``.  For
+    example, ``in_text(year__between=(1300, 1500), genre="nar")`` matches
+    the narrative texts written between 1300 and 1500.  Texts which lack a
+    field do not satisfy any condition on it.
+
+    In direct mode, the fields are read from the ``FILE``, ``YEAR``,
+    ``AUTHOR`` and ``GENRE`` metadata of the root of the tree (see the
+    ``text_metadata`` argument of `lovett.loader.Loader`).  In indexed mode,
+    they are read from the ``texts`` table of the `CorpusDb`, which is filled
+    from the same metadata.
+
+    This is not a marking query: it describes the text a node is in, not the
+    node itself.
+
+    """
+    #: The fields of a text, and the root metadata keys they are read from in
+    #: direct mode.
+    FIELDS = {"file": "FILE", "year": "YEAR", "author": "AUTHOR", "genre": "GENRE"}
+
+    #: The lookups which a condition can use.
+    LOOKUPS = ("exact", "in", "between", "lt", "lte", "gt", "gte")
+
+    def __init__(self, **conditions):
+        """Initializer.
+
+        Args:
+            **conditions: The conditions which the texts must satisfy; see
+                the class docstring for details.
+
+        """
+        super().__init__("in_text")
+        parsed = []
+        for name, value in conditions.items():
+            field, _, lookup = name.partition("__")
+            lookup = lookup or "exact"
+            if field not in self.FIELDS:
+                raise ValueError("Unknown text field: %s" % field)
+            if lookup not in self.LOOKUPS:
+                raise ValueError("Unknown lookup: %s" % lookup)
+            if lookup == "in":
+                value = frozenset(value)
+            elif lookup == "between":
+                value = tuple(value)
+                if len(value) != 2:
+                    raise ValueError("A range must be a (low, high) pair: %s" % (value,))
+            parsed.append((field, lookup, value))
+        self.conditions = tuple(sorted(parsed, key=lambda c: (c[0], c[1], repr(c[2]))))
+
+    @classmethod
+    def _merge(cls, queries):
+        """Return a query for the texts matched by all of some queries.
+
+        Args:
+            queries (list of in_text): The queries.
+
+        Returns:
+            in_text
+
+        """
+        result = cls()
+        conditions = set(c for query in queries for c in query.conditions)
+        result.conditions = tuple(sorted(conditions, key=lambda c: (c[0], c[1], repr(c[2]))))
+        return result
+
+    def _args(self):
+        args = []
+        for field, lookup, value in self.conditions:
+            if isinstance(value, frozenset):
+                value = "{%s}" % ", ".join(sorted(map(repr, value)))
+            else:
+                value = repr(value)
+            name = field if lookup == "exact" else "%s__%s" % (field, lookup)
+            args.append("%s=%s" % (name, value.replace("'", "\"")))
+        return ", ".join(args)
+
+    @property
+    def is_marking(self):
+        return False
+
+    def _get_match_nodes(self):
+        return ()
+
+    @staticmethod
+    def _satisfies(value, lookup, operand):
+        """Return whether a value satisfies a condition.
+
+        Args:
+            value: The value of the field, or ``None`` if it is missing.
+            lookup (str): The lookup of the condition.
+            operand: The value of the condition.
+
+        Returns:
+            bool
+
+        """
+        if value is None:
+            return False
+        if lookup == "exact":
+            return value == operand
+        elif lookup == "in":
+            return value in operand
+        elif lookup == "between":
+            low, high = operand
+            return (low is None or low <= value) and (high is None or value <= high)
+        elif lookup == "lt":
+            return value < operand
+        elif lookup == "lte":
+            return value <= operand
+        elif lookup == "gt":
+            return value > operand
+        else:
+            return value >= operand
+
+    @match_function
+    def match_tree(self, tree, mark=False):
+        metadata = tree.root.metadata
+        for field, lookup, operand in self.conditions:
+            value = metadata.get(self.FIELDS[field])
+            if field == "year":
+                value = util._metadata_py_to_num(value)
+            try:
+                if not self._satisfies(value, lookup, operand):
+                    return False
+            except TypeError:
+                # E.g. an author compared with a number
+                return False
+        return True
+
+    def _condition(self, corpus):
+        """Return the SQL condition on the texts table."""
+        texts = corpus.texts
+        conditions = [texts.c.name.isnot(None)]
+        for field, lookup, operand in self.conditions:
+            column = texts.c.name if field == "file" else texts.c[field]
+            if lookup == "exact":
+                conditions.append(column == operand)
+            elif lookup == "in":
+                conditions.append(column.in_(sorted(operand)))
+            elif lookup == "between":
+                low, high = operand
+                if low is not None:
+                    conditions.append(column >= low)
+                if high is not None:
+                    conditions.append(column <= high)
+            elif lookup == "lt":
+                conditions.append(column < operand)
+            elif lookup == "lte":
+                conditions.append(column <= operand)
+            elif lookup == "gt":
+                conditions.append(column > operand)
+            else:
+                conditions.append(column >= operand)
+        return and_(*conditions)
+
+    def _roots_join(self, corpus):
+        # A join rather than an IN, so that SQLite can look up the texts
+        # through their indexes, and then their roots through root_file
+        return corpus.roots_db.join(corpus.texts,
+                                    corpus.roots_db.c.file == corpus.texts.c.name)
+
+    def roots_sql(self, corpus):
+        """Return a SQLAlchemy select of the trees of the matching texts.
+
+        Args:
+            corpus (CorpusDb): The corpus.
+
+        Returns:
+            sqlalchemy.sql.expression.Select: The ``id`` and ``last`` columns
+            of the roots table, for each tree.
+
+        """
+        roots = corpus.roots_db
+        return select([roots.c.id, roots.c.last]).select_from(
+            self._roots_join(corpus)).where(self._condition(corpus))
+
+    def sql(self, corpus):
+        roots = corpus.roots_db
+        nodes = corpus.nodes
+        # Each tree is a range of node ids, so this is an indexed lookup of
+        # the roots followed by range scans of the nodes
+        return select([nodes.c.rowid]).select_from(
+            self._roots_join(corpus).join(nodes, nodes.c.rowid.between(roots.c.id, roots.c.last))
+        ).where(self._condition(corpus))
+
+    def filter_sql(self, column, corpus):
+        """Return a SQL condition that a node is in one of the matching texts.
+
+        The text of the node is found from its root, which is the root with
+        the greatest id not greater than its own (a single index lookup).
+        `_in_query` uses this instead of `sql` to filter the results of
+        another query.
+
+        Args:
+            column (sqlalchemy.sql.expression.ColumnElement): The column of
+                node ids.
+            corpus (CorpusDb): The corpus.
+
+        Returns:
+            sqlalchemy.sql.expression.ColumnElement
+
+        """
+        roots = corpus.roots_db
+        text = select([roots.c.file]).where(roots.c.id <= column).\
+            order_by(roots.c.id.desc()).limit(1).scalar_subquery()
+        names = select([corpus.texts.c.name]).where(self._condition(corpus))
+        return func.coalesce(text, "").in_(names)
+
+
+class in_result(MarkingQueryFunction):
+    """Matches the nodes saved under a name in a `CorpusDb`.
+
+    Results are saved with `lovett.db.CorpusDb.save_results` or
+    `lovett.corpus.ResultSet.save`.  An expensive query can thus be
+    evaluated once and reused as a building block of later ones::
+
+        corpus.save_results("finite", label("IP-MAT") & idoms(label("VBD")))
+        corpus.matching_trees(in_result("finite") & idoms(label("NP-OB1")))
+
+    This query only works in indexed mode, since the saved nodes are
+    identified by their database ids.
+
+    """
+    def __init__(self, name):
+        """Initializer.
+
+        Args:
+            name (str): The name the results were saved under.
+
+        """
+        super().__init__("in_result")
+        self.name = name
+
+    def _args(self):
+        return "\"%s\"" % self.name
+
+    @match_function
+    def match_tree(self, tree, mark=False):
+        raise TypeError("in_result(\"%s\") can only be matched against a CorpusDb" % self.name)
+
+    def sql(self, corpus):
+        names = corpus.saved_names
+        if corpus._connection.execute(select([names.c.name]).
+                                      where(names.c.name == self.name)).first() is None:
+            raise ValueError("No results are saved as \"%s\"" % self.name)
+        saved = corpus.saved_results
+        # Covered by the saved_name_node index; a name with no saved nodes
+        # matches nothing
+        return select([saved.c.node_id]).where(saved.c.name == self.name)
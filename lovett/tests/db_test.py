@@ -1,5 +1,9 @@
 from __future__ import unicode_literals
 
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest
 import sqlalchemy
 # import textwrap
@@ -7,7 +11,12 @@ from nose.plugins.skip import SkipTest
 
 import lovett.tree as T
 
+import lovett.corpus as corpus
 import lovett.db as db
+import lovett.query as Q
+import lovett.planner as planner
+import lovett.debug as debug
+import lovett.loader as loader
 import lovett.transform as transform
 
 
@@ -27,15 +36,15 @@ class CorpusTest(unittest.TestCase):
         return self.d.engine.connect().execute(sqlalchemy.sql.text(query), **kwargs).fetchall()
 
     def test_basic(self):
-        ip = self.fetch("SELECT rowid FROM nodes WHERE label = 'IP'")
+        ip = self.fetch("SELECT nodes.rowid FROM nodes JOIN labels ON labels.rowid = nodes.label_id WHERE label = 'IP'")
         assert isinstance(ip, int)
         assert ip > 0
-        nps = self.fetch_all("SELECT rowid FROM nodes WHERE label = 'NP'")
+        nps = self.fetch_all("SELECT nodes.rowid FROM nodes JOIN labels ON labels.rowid = nodes.label_id WHERE label = 'NP'")
         assert len(nps) == 2
 
     def test_dom(self):
-        ip = self.fetch("SELECT rowid FROM nodes WHERE label = 'IP'")
-        nps = self.fetch_all("SELECT rowid FROM nodes WHERE label = 'NP'")
+        ip = self.fetch("SELECT nodes.rowid FROM nodes JOIN labels ON labels.rowid = nodes.label_id WHERE label = 'IP'")
+        nps = self.fetch_all("SELECT nodes.rowid FROM nodes JOIN labels ON labels.rowid = nodes.label_id WHERE label = 'NP'")
         dom = self.fetch("SELECT depth FROM dom WHERE parent = :parent AND child = :child",
                          parent=ip,
                          child=nps[0][0])
@@ -46,13 +55,28 @@ class CorpusTest(unittest.TestCase):
         assert dom == 1
 
     def test_sprec(self):
-        adj = self.fetch("SELECT rowid FROM nodes WHERE label = 'ADJ'")
-        nn = self.fetch("SELECT rowid FROM nodes WHERE label = 'N+N'")
+        adj = self.fetch("SELECT nodes.rowid FROM nodes JOIN labels ON labels.rowid = nodes.label_id WHERE label = 'ADJ'")
+        nn = self.fetch("SELECT nodes.rowid FROM nodes JOIN labels ON labels.rowid = nodes.label_id WHERE label = 'N+N'")
         sprec = self.fetch("SELECT distance FROM sprec WHERE left = :left AND right = :right",
                            left=adj,
                            right=nn)
         assert sprec == 1
 
+    def test_labels(self):
+        self.assertEqual(self.fetch("SELECT count(*) FROM labels"), 7)
+        self.assertEqual(self.fetch("SELECT count(*) FROM nodes"), 9)
+        d = db.CorpusDb()
+        d.insert_tree(T.parse("(IP (NP-SBJ-X (PRO it)) (VBD rained))"))
+        c = d._connection
+        rows = c.execute(sqlalchemy.sql.text(
+            "SELECT base, tag FROM label_dashtags JOIN labels ON labels.rowid = label_id "
+            "WHERE label = 'NP-SBJ-X' ORDER BY tag")).fetchall()
+        self.assertEqual(rows, [("NP", "SBJ"), ("NP", "X")])
+        rows = c.execute(sqlalchemy.sql.text(
+            "SELECT base, tag FROM label_dashtags JOIN labels ON labels.rowid = label_id "
+            "WHERE label = 'IP'")).fetchall()
+        self.assertEqual(rows, [("IP", None)])
+
     def test_reconstitute(self):
         t = T.parse("(IP (NP (D a) (N dog)) (VBD chased) (NP (D the) (ADJ speedy) (N+N mailman)))")
         self.assertEqual(self.d[0], t)
@@ -67,3 +91,653 @@ class CorpusTest(unittest.TestCase):
 
     def test_recursive_metadata(self):
         raise SkipTest
+
+    def test_connection_reuse(self):
+        self.assertIs(self.d._connection, self.d._connection)
+        self.d[0]
+        self.assertEqual(len(self.d._connections), 1)
+
+    def test_compiled_cache_size(self):
+        size = db.COMPILED_CACHE_SIZE
+        db.COMPILED_CACHE_SIZE = 4
+        try:
+            d = db.CorpusDb()
+        finally:
+            db.COMPILED_CACHE_SIZE = size
+        d.insert_tree(T.parse("(IP (NP (D a) (N dog)) (VBD barked))"))
+        for i in range(20):
+            d.count_nodes(Q.label("N") & Q.idoms(Q.label("X%d" % i)))
+        self.assertLessEqual(len(d._compiled_cache), 6)
+        d.close()
+
+    def test_close(self):
+        with db.CorpusDb() as d:
+            d.insert_tree(T.parse("(IP (NP (D a) (N dog)) (VBD barked))"))
+            conn = d._connection
+        self.assertTrue(conn.closed)
+        self.assertEqual(d._connections, [])
+
+    def test_close_other_thread(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            d = db.CorpusDb(filename=os.path.join(tmp, "corpus.db"))
+            d.insert_tree(T.parse("(IP (NP (D a) (N dog)) (VBD barked))"))
+            raw = []
+
+            def query():
+                d[0]
+                raw.append(d._connection.connection.connection)
+            thread = threading.Thread(target=query)
+            thread.start()
+            thread.join()
+            d.close()
+            self.assertEqual(d._connections, [])
+            with self.assertRaisesRegex(sqlite3.ProgrammingError, "closed"):
+                raw[0].execute("SELECT 1")
+
+    def test_bulk_loading(self):
+        d = db.CorpusDb()
+        t = T.parse("(IP (NP (D a) (N dog)) (VBD barked))")
+        c = d._connection
+        index_query = sqlalchemy.sql.text("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                          "AND name NOT LIKE 'sqlite_%'")
+        all_indexes = set(index.name for table in d.metadata.sorted_tables
+                          for index in table.indexes)
+        unique = set(index.name for table in d.metadata.sorted_tables
+                     for index in table.indexes if index.unique)
+        self.assertTrue({"label_name", "root_id", "saved_name_node"} <= unique)
+        with d.bulk_loading():
+            # The unique indexes are kept
+            self.assertEqual(set(x[0] for x in c.execute(index_query).fetchall()), unique)
+            d.insert_trees([t, t])
+        names = set(x[0] for x in c.execute(index_query).fetchall())
+        self.assertTrue({"label_idx", "child_depth", "parent_depth",
+                         "right_distance", "id_key"} <= names)
+        self.assertEqual(names, all_indexes)
+        # Appending to a corpus which is not empty keeps the indexes
+        with d.bulk_loading():
+            self.assertEqual(set(x[0] for x in c.execute(index_query).fetchall()), all_indexes)
+            d.insert_tree(t)
+        with d.bulk_loading(defer_indexes=True):
+            self.assertEqual(set(x[0] for x in c.execute(index_query).fetchall()), unique)
+        self.assertEqual(set(x[0] for x in c.execute(index_query).fetchall()), all_indexes)
+        self.assertEqual(c.execute(sqlalchemy.sql.text("PRAGMA synchronous")).scalar(), 2)
+        self.assertTrue(c.execute(sqlalchemy.sql.text("SELECT count(*) FROM sqlite_stat1")).scalar() > 0)
+        self.assertEqual(len(d), 3)
+        self.assertEqual(d[1], t)
+
+    def test_append_to_file(self):
+        t1 = T.parse("(IP (NP (D a) (N dog)) (VBD barked))")
+        t2 = T.parse("(IP (NP (D the) (N cat)) (VBD meowed))")
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "corpus.db")
+            with db.CorpusDb(filename=filename) as d:
+                d.insert_tree(t1)
+            with db.CorpusDb(filename=filename) as d:
+                self.assertEqual(d.id, 6)
+                d.insert_tree(t2)
+            with db.CorpusDb(filename=filename) as d:
+                self.assertEqual(len(d), 2)
+                self.assertEqual(d[0], t1)
+                self.assertEqual(d[1], t2)
+            with db.CorpusDb(filename=filename) as d:
+                # The roots are read lazily
+                self.assertEqual(len(d), 2)
+                self.assertIsNone(d._roots)
+                d.insert_tree(t1)
+                self.assertIsNone(d._roots)
+                self.assertEqual(list(d.roots), [1, 6, 11])
+                self.assertEqual(d.roots.typecode, "q")
+
+    def test_schema_version(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "corpus.db")
+            # A file written before the schema was versioned
+            conn = sqlite3.connect(filename)
+            conn.execute("CREATE TABLE nodes (rowid INTEGER PRIMARY KEY, label VARCHAR)")
+            conn.close()
+            with self.assertRaisesRegex(ValueError, "rebuild this corpus"):
+                db.CorpusDb(filename=filename)
+            os.remove(filename)
+            with db.CorpusDb(filename=filename) as d:
+                d.insert_tree(T.parse("(IP (VBD ran))"))
+                with d._connection.begin():
+                    d._connection.execute(d.info.update().where(d.info.c.key == "schema").
+                                          values(value=db.SCHEMA_VERSION + 1))
+            with self.assertRaisesRegex(ValueError, "schema version %d" % (db.SCHEMA_VERSION + 1)):
+                db.CorpusDb(filename=filename)
+
+    def test_matching_trees_clone(self):
+        d = db.CorpusDb()
+        d.insert_trees([T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                        T.parse("(IP (VBD ran))"),
+                        T.parse("(IP (NP (D the) (N cat)) (VBD meowed))")])
+        res = d.matching_trees(Q.label("NP"))
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[1], d[2])
+        clone = db.CorpusDb(d, d.roots[1:])
+        res = clone.matching_trees(Q.label("NP"))
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0], d[2])
+        self.assertEqual(list(res._backing.roots), [d.roots[2]])
+
+    def test_paging(self):
+        trees = [T.parse("(IP (NP (D a) (N dog%d)) (VBD barked))" % i) for i in range(5)] + \
+            [T.parse("(IP (VBD ran))")]
+        d = db.CorpusDb()
+        d.insert_trees(trees)
+        q = Q.label("NP") | Q.label("VBD") | Q.text("dog1")
+        for c in (d, corpus.ListCorpus(trees)):
+            self.assertEqual(list(c.iter_matches(q)), trees)
+            self.assertEqual(list(c.matching_trees(q, limit=2)), trees[:2])
+            self.assertEqual(list(c.matching_trees(q, limit=4, offset=3)), trees[3:])
+            self.assertEqual(list(c.matching_trees(q, offset=5)), trees[5:])
+            self.assertEqual(len(c.matching_trees(q, limit=0)), 0)
+            res = c.matching_trees(Q.label("NP"), offset=1)
+            self.assertEqual(list(res.iter_matches(Q.text("dog3"))), [trees[3]])
+            self.assertEqual(list(res.matching_trees(Q.label("N"), limit=1, offset=1)),
+                             [trees[2]])
+        # Streamed from the result cache
+        d.count(q)
+        self.assertEqual(list(d.matching_trees(q, limit=4, offset=3)), trees[3:])
+        self.assertEqual(list(d.iter_matches(q, batch_size=2)), trees)
+        with self.assertRaises(ValueError):
+            d.matching_trees(q, offset=-1)
+        # Matches which SQLite finds in order are streamed without caching;
+        # others are found and cached by the first page
+        d.clear_result_cache()
+        self.assertEqual(list(d.matching_trees(Q.text("dog2"), limit=1)), [trees[2]])
+        self.assertEqual(len(d._result_cache), 0)
+        q = Q.label("IP") & Q.idoms(Q.label("NP"))
+        self.assertEqual(list(d.matching_trees(q, limit=1)), trees[:1])
+        self.assertEqual(list(d._result_cache), [planner.canonical(q)])
+
+    def test_sample(self):
+        trees = [T.parse("(IP (NP (D a) (N dog%d)) (VBD barked))" % i) for i in range(30)] + \
+            [T.parse("(IP (VBD ran))")] * 10
+        d = db.CorpusDb()
+        d.insert_trees(trees)
+        db.SAMPLE_MIN_RATIO, ratio = 1, db.SAMPLE_MIN_RATIO
+        try:
+            for c in (d, corpus.ListCorpus(trees)):
+                for q in (Q.label("NP"), Q.label("NP") | Q.text("dog1")):
+                    res = c.matching_trees(q, sample=5, seed=1)
+                    self.assertEqual(len(res), 5)
+                    self.assertEqual(list(res), list(c.matching_trees(q, sample=5, seed=1)))
+                    indices = [trees.index(t) for t in res]
+                    self.assertEqual(indices, sorted(indices))
+                    self.assertTrue(all(i < 30 for i in indices))
+                self.assertEqual(len(c.matching_trees(Q.text("dog1"), sample=5)), 1)
+                self.assertEqual(len(c.matching_trees(Q.label("NP"), sample=0)), 0)
+                with self.assertRaises(ValueError):
+                    c.matching_trees(Q.label("NP"), sample=5, limit=2)
+        finally:
+            db.SAMPLE_MIN_RATIO = ratio
+
+    def test_matching_nodes(self):
+        trees = [T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                 T.parse("(IP (VBD ran))"),
+                 T.parse("(IP (NP (D the) (N cat)) (VBD meowed) (NP (N Mary)))")]
+        d = db.CorpusDb()
+        d.insert_trees(trees)
+        c = corpus.ListCorpus(trees)
+        q = Q.label("NP")
+        self.assertEqual(c.matching_nodes(q), [(0, (0,)), (2, (0,)), (2, (2,))])
+        matches = d.matching_nodes(q)
+        self.assertEqual([m.root for m in matches], [d.roots[0], d.roots[2], d.roots[2]])
+        self.assertEqual([d.subtree(m) for m in matches], [c.subtree(m) for m in c.matching_nodes(q)])
+        self.assertEqual(d.subtree(matches[2]), T.parse("(NP (N Mary))"))
+        self.assertIs(c.subtree(c.matching_nodes(q)[2]), trees[2][2])
+        # Restricted to the trees of a result set
+        res = d.matching_trees(Q.text("Mary"))
+        self.assertEqual(res.matching_nodes(q), matches[1:])
+        self.assertEqual(res.subtree(res.matching_nodes(Q.label("N"))[1]),
+                         T.parse("(N Mary)"))
+        res = c.matching_trees(Q.text("Mary"))
+        self.assertEqual(res.matching_nodes(Q.label("N")), [(0, (0, 1)), (0, (2, 0))])
+
+    def test_set_operations(self):
+        trees = [T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                 T.parse("(IP (VBD ran))"),
+                 T.parse("(IP (NP (D the) (N cat)) (VBD meowed))"),
+                 T.parse("(IP (NP (N Mary)) (VBD ran))")]
+        d = db.CorpusDb()
+        d.insert_trees(trees)
+        for c in (d, corpus.ListCorpus(trees)):
+            np = c.matching_trees(Q.label("NP"))
+            d_ = c.matching_trees(Q.label("D"))
+            ran = c.matching_trees(Q.text("ran"))
+            self.assertEqual(list(np & ran), [trees[3]])
+            # Database results are in corpus order, others are ordered by
+            # result set
+            in_order = c is d
+            self.assertEqual(list(d_ | ran),
+                             trees if in_order else [trees[0], trees[2], trees[1], trees[3]])
+            self.assertEqual(list(np - d_), [trees[3]])
+            self.assertEqual(list(np.symmetric_difference(ran)),
+                             trees[:3] if in_order else [trees[0], trees[2], trees[1]])
+            self.assertEqual(list(np ^ ran), list(np.symmetric_difference(ran)))
+            self.assertEqual(list((np - d_) | (np & ran)), [trees[3]])
+            self.assertEqual(str(np & ran), '1 results of query "(label("NP") & text("ran"))"')
+        with self.assertRaises(ValueError):
+            d.matching_trees(Q.label("NP")) & corpus.ListCorpus(trees).matching_trees(Q.label("NP"))
+        with self.assertRaises(TypeError):
+            d.matching_trees(Q.label("NP")) & d
+
+    def test_explain(self):
+        report = self.d.explain(Q.label("NP") & Q.idoms(Q.label("ADJ")))
+        self.assertEqual([name for name, _ in report.timings], ["sql", "roots", "reconstitution"])
+        self.assertEqual(report.nodes, 1)
+        self.assertEqual(report.trees, 1)
+        self.assertIn("label_idx", report.indexes_used)
+        self.assertEqual(report.full_scans, [])
+        self.assertEqual([actual for _, _, actual in report.subqueries], [1, 1, 1, 2])
+        self.assertIn("index label_idx", str(report))
+
+    def test_explain_full_scans(self):
+        # Plan rows as written by SQLite before and after 3.36
+        for scan in ("SCAN TABLE", "SCAN"):
+            plan = [(2, 0, 0, "%s nodes" % scan),
+                    (5, 0, 0, "%s anon_1" % scan),
+                    (7, 0, 0, "SEARCH dom USING INDEX child_depth (child=?)")]
+            report = debug.QueryReport(Q.label("NP"), Q.label("NP"), "", plan,
+                                       {"child_depth"})
+            self.assertEqual(report.full_scans, ["nodes"])
+            self.assertEqual(report._annotate(plan[0][-1]), "full scan: no index used")
+            self.assertEqual(report._annotate(plan[1][-1]), "")
+            self.assertEqual(report.indexes_used, {"child_depth"})
+
+
+class CountTest(unittest.TestCase):
+    def setUp(self):
+        trees = [T.parse("(IP (NP-SBJ (D a-a) (N dog-dog)) (VBD barked-bark))"),
+                 T.parse("(IP (NP-SBJ (PRO it-it)) (VBD ran-run) (NP (N dog-dog)))"),
+                 T.parse("(IP (VBD ran-run))")]
+        for t, f, year in zip(trees, ("a.psd", "a.psd", "b.psd"), (1150, 1150, 1300)):
+            transform.icepahc_lemma(t)
+            t.metadata.file = f
+            t.metadata.year = year
+        self.corpus = corpus.Corpus(trees)
+        self.d = db.CorpusDb()
+        self.d.insert_trees(trees)
+
+    def check(self, method, *args, **kwargs):
+        want = getattr(self.corpus, method)(*args, **kwargs)
+        self.assertEqual(getattr(self.d, method)(*args, **kwargs), want)
+        return want
+
+    def test_count(self):
+        self.assertEqual(self.check("count", Q.label("NP")), 2)
+        self.assertEqual(self.check("count_nodes", Q.label("NP")), 3)
+        self.assertEqual(self.check("count_nodes", Q.label("XP")), 0)
+
+    def test_group_counts(self):
+        self.assertEqual(self.check("group_counts", Q.label("NP")),
+                         {"a.psd": 3})
+        self.assertEqual(self.check("group_counts", Q.label("NP"), trees=True),
+                         {"a.psd": 2})
+        self.assertEqual(self.check("group_counts", Q.label("NP"), by="label"),
+                         {"NP-SBJ": 2, "NP": 1})
+        self.assertEqual(self.check("group_counts", Q.label("VBD"), by="year"),
+                         {1150: 2, 1300: 1})
+        self.assertEqual(self.check("group_counts", Q.label("N") | Q.label("VBD"), by="lemma"),
+                         {"dog": 2, "bark": 1, "run": 2})
+        self.assertEqual(self.check("group_counts", Q.label("NP"), by="lemma"),
+                         {None: 3})
+
+    def test_result_set(self):
+        res = self.d.matching_trees(Q.lemma("run"))
+        self.assertEqual(res.count(Q.label("NP")), 1)
+        self.assertEqual(res.count_nodes(Q.label("NP")), 2)
+        self.assertEqual(res.group_counts(Q.label("NP"), by="file"), {"a.psd": 2})
+        self.assertEqual(res.group_counts(Q.label("VBD"), by="file", trees=True),
+                         {"a.psd": 1, "b.psd": 1})
+        res = self.corpus.matching_trees(Q.lemma("run"))
+        self.assertEqual(res.count_nodes(Q.label("NP")), 2)
+        self.assertEqual(repr(res), "2 results of query \"lemma(\"run\")\"")
+
+
+class TreeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.trees = [T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                      T.parse("(IP (NP (D the) (N cat)) (VBD meowed))"),
+                      T.parse("(IP (VBD ran))")]
+        self.d = db.CorpusDb()
+        self.d.insert_trees(self.trees)
+        self.d.tree_cache_size = 2
+
+    def test_cache(self):
+        self.assertEqual(self.d[0], self.trees[0])
+        self.assertEqual(self.d[0], self.trees[0])
+        self.assertEqual(self.d.cache_info(), db.CacheInfo(1, 1, 2, 1))
+        # Shared with result sets
+        res = self.d.matching_trees(Q.label("NP"))
+        self.assertEqual(res[0], self.trees[0])
+        self.assertEqual(res[1], self.trees[1])
+        self.assertEqual(self.d.cache_info(), db.CacheInfo(2, 2, 2, 2))
+        # The least recently used tree is evicted
+        self.d[2]
+        self.d[0]
+        self.assertEqual(self.d.cache_info(), db.CacheInfo(2, 4, 2, 2))
+
+    def test_copies(self):
+        t = self.d[0]
+        t[0][0].text = "one"
+        self.assertEqual(self.d[0], self.trees[0])
+
+    def test_invalidate(self):
+        self.d[2]
+        self.d.insert_tree(T.parse("(IP (VBD sat))"))
+        self.assertEqual(self.d.cache_info().currsize, 0)
+        self.d.tree_cache_size = 0
+        self.d[3]
+        self.assertEqual(self.d.cache_info().currsize, 0)
+
+
+class IterTreesTest(unittest.TestCase):
+    def setUp(self):
+        self.trees = [T.parse("(IP (NP (D a) (N dog%d)) (VBD barked))" % i) for i in range(7)]
+        self.trees[3].metadata.ID = "three"
+
+    def test_batches(self):
+        d = db.CorpusDb()
+        d.insert_trees(self.trees)
+        self.assertEqual(list(d), self.trees)
+        for batch_size in (1, 3, 7, 10):
+            self.assertEqual(list(d.iter_trees(batch_size=batch_size)), self.trees)
+        # Cached trees are used, but the cache is not filled
+        d[1]
+        self.assertEqual(list(d.iter_trees(batch_size=3)), self.trees)
+        self.assertEqual(d.cache_info(), db.CacheInfo(1, 1, d.tree_cache_size, 1))
+        res = d.matching_trees(Q.text("dog2") | Q.text("dog5"))
+        self.assertEqual(list(res), [self.trees[2], self.trees[5]])
+
+    def test_background(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            d = db.CorpusDb(filename=os.path.join(tmp, "corpus.db"))
+            d.insert_trees(self.trees)
+            self.assertEqual(list(d.iter_trees(batch_size=2, background=True)),
+                             self.trees)
+            # Stopping early
+            it = d.iter_trees(batch_size=2, background=True)
+            self.assertEqual(next(it), self.trees[0])
+            it.close()
+            d.close()
+        # In-memory corpora fall back to fetching in the same thread
+        d = db.CorpusDb()
+        d.insert_trees(self.trees)
+        self.assertEqual(list(d.iter_trees(batch_size=2, background=True)), self.trees)
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "corpus.db")
+        self.trees = [T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                      T.parse("(IP (VBD ran))")]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def count_searches(self, d):
+        d.searches = 0
+        matching_nodes = d._matching_nodes
+
+        def counting(query):
+            d.searches += 1
+            return matching_nodes(query)
+        d._matching_nodes = counting
+
+    def test_memory(self):
+        d = db.CorpusDb()
+        d.insert_trees(self.trees)
+        self.count_searches(d)
+        q = Q.label("VBD") & Q.idoms(Q.label("N"))
+        self.assertEqual(len(d.matching_trees(q)), 0)
+        self.assertEqual(len(d.matching_trees(Q.idoms(Q.label("N")) & Q.label("VBD"))), 0)
+        self.assertEqual(d.searches, 1)
+        self.assertEqual(len(d.matching_trees(Q.label("VBD"))), 2)
+        self.assertEqual(d.searches, 2)
+        # Appending invalidates the cache
+        d.insert_tree(T.parse("(VBD (N barked))"))
+        self.assertEqual(len(d.matching_trees(q)), 1)
+        self.assertEqual(d.searches, 3)
+
+    def test_lru(self):
+        d = db.CorpusDb()
+        d.insert_trees(self.trees)
+        d.result_cache_size = 2
+        self.count_searches(d)
+        for label in ("NP", "VBD", "NP", "IP", "VBD", "NP"):
+            d.matching_trees(Q.label(label))
+        # The second "NP" is a hit; the rest are misses
+        self.assertEqual(d.searches, 5)
+        self.assertEqual(list(d._result_cache),
+                         [planner.canonical(Q.label("VBD")), planner.canonical(Q.label("NP"))])
+
+    def test_file(self):
+        with db.CorpusDb(filename=self.filename) as d:
+            d.insert_trees(self.trees)
+            self.assertEqual(len(d.matching_trees(Q.label("NP"))), 1)
+        with db.CorpusDb(filename=self.filename) as d:
+            self.count_searches(d)
+            res = d.matching_trees(Q.label("NP"))
+            self.assertEqual(d.searches, 0)
+            self.assertEqual(len(res), 1)
+            self.assertEqual(res[0], self.trees[0])
+            d.insert_tree(T.parse("(IP (NP (PRO it)))"))
+            self.assertEqual(len(d.matching_trees(Q.label("NP"))), 2)
+            self.assertEqual(d.searches, 1)
+
+    def test_file_size(self):
+        with db.CorpusDb(filename=self.filename) as d:
+            d.insert_trees(self.trees)
+            d.result_cache_db_size = 1
+            d.matching_trees(Q.label("NP"))
+            d.matching_trees(Q.label("VBD"))
+            rows = d._connection.execute(sqlalchemy.sql.text(
+                "SELECT query FROM result_cache")).fetchall()
+            self.assertEqual(rows, [(planner.canonical(Q.label("VBD")),)])
+            d.clear_result_cache()
+            self.assertEqual(len(d._result_cache), 0)
+
+    def test_read_only(self):
+        with db.CorpusDb(filename=self.filename) as d:
+            d.insert_trees(self.trees)
+        uri = "file:%s?mode=ro&uri=true" % self.filename
+        with db.CorpusDb(filename=uri) as d:
+            self.assertEqual(len(d), len(self.trees))
+            res = d.matching_trees(Q.label("NP"))
+            self.assertEqual(len(res), 1)
+            self.assertEqual(res[0], self.trees[0])
+
+    def test_locked(self):
+        with db.CorpusDb(filename=self.filename) as d:
+            d.insert_trees(self.trees)
+        with db.CorpusDb(filename=self.filename) as d:
+            d._connection.execute(sqlalchemy.sql.text("PRAGMA busy_timeout = 0"))
+            other = sqlite3.connect(self.filename, isolation_level=None)
+            try:
+                other.execute("BEGIN IMMEDIATE")
+                res = d.matching_trees(Q.label("NP"))
+                self.assertEqual(len(res), 1)
+                self.assertEqual(res[0], self.trees[0])
+            finally:
+                other.execute("ROLLBACK")
+                other.close()
+            rows = d._connection.execute(sqlalchemy.sql.text(
+                "SELECT query FROM result_cache")).fetchall()
+            self.assertEqual(rows, [])
+
+
+class SavedResultsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "corpus.db")
+        self.trees = [T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                      T.parse("(IP (VBD ran))"),
+                      T.parse("(IP (NP (D the) (N cat)) (VBD meowed) (NP (N Mary)))")]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_save(self):
+        with db.CorpusDb(filename=self.filename) as d:
+            d.insert_trees(self.trees)
+            d.matching_trees(Q.label("NP")).save("np")
+            self.assertEqual(d.count_nodes(Q.in_result("np")), 3)
+            # The cached result of a query using the name is invalidated
+            self.assertEqual(d.count(Q.idoms(Q.in_result("np"))), 2)
+            d.save_results("np", Q.label("NP") & Q.idoms(Q.label("D")))
+            self.assertEqual(d.count(Q.idoms(Q.in_result("np"))), 2)
+            self.assertEqual(d.count_nodes(Q.in_result("np")), 2)
+        with db.CorpusDb(filename=self.filename) as d:
+            self.assertEqual(d.saved_result_names(), ["np"])
+            res = d.matching_trees(Q.label("IP") & Q.idoms(Q.in_result("np")))
+            self.assertEqual(list(res), [self.trees[0], self.trees[2]])
+            d.drop_results("np")
+            self.assertEqual(d.saved_result_names(), [])
+            with self.assertRaises(ValueError):
+                d.count(Q.in_result("np"))
+
+    def test_save_empty(self):
+        d = db.CorpusDb()
+        d.insert_trees(self.trees)
+        d.save_results("none", Q.label("CP"))
+        self.assertEqual(d.saved_result_names(), ["none"])
+        self.assertEqual(d.count_nodes(Q.in_result("none")), 0)
+        self.assertEqual(len(d.matching_trees(Q.label("IP") & Q.idoms(Q.in_result("none")))), 0)
+        d.drop_results("none")
+        with self.assertRaises(ValueError):
+            d.count_nodes(Q.in_result("none"))
+
+    def test_save_result_set(self):
+        d = db.CorpusDb()
+        d.insert_trees(self.trees)
+        np = d.matching_trees(Q.label("NP"))
+        vbd = d.matching_trees(Q.label("VBD"))
+        # Only the matches in the trees of a result set are saved
+        np.matching_trees(Q.text("Mary")).save("mary")
+        self.assertEqual(d.count_nodes(Q.in_result("mary")), 1)
+        (vbd - np).save("other")
+        self.assertEqual(d.count_nodes(Q.in_result("other")), 1)
+        (vbd & np).save("both")
+        self.assertEqual(d.count_nodes(Q.in_result("both")), 5)
+        with self.assertRaises(TypeError):
+            Q.in_result("both").match_tree(self.trees[0])
+        with self.assertRaises(TypeError):
+            corpus.ListCorpus(self.trees).matching_trees(Q.label("NP")).save("np")
+
+
+class ExtractTest(unittest.TestCase):
+    def test_extract(self):
+        trees = [T.parse("(IP (NP (D a) (N dog)) (VBD barked))"),
+                 T.parse("(IP (VBD ran))"),
+                 T.parse("(IP (NP (D the) (N cat)) (VBD meowed) (NP (N Mary)))")]
+        trees[0].metadata.ID = "one"
+        trees[2].metadata.FILE = "mary.psd"
+        trees[2].metadata.YEAR = 1500
+        d = db.CorpusDb()
+        d.insert_trees(trees)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "np.db")
+            res = d.matching_trees(Q.label("NP"))
+            with res.to_db(filename) as sub:
+                self.assertEqual(list(sub), [trees[0], trees[2]])
+                self.assertEqual(list(sub.roots), [1, 6])
+                self.assertEqual(sub.id, 13)
+                self.assertEqual(sub.count(Q.text("the cat", mode="fts")), 1)
+                self.assertEqual(sub.count(Q.in_text(year=1500) & Q.label("NP")), 1)
+                q = Q.label("NP") > Q.label("VBD")
+                self.assertEqual(sub.count_nodes(q), res.count_nodes(q))
+                self.assertEqual(sub.label_counts(), dict(
+                    (d._label_ids[label], n) for label, n in
+                    (("IP", 2), ("NP", 3), ("D", 2), ("N", 3), ("VBD", 2))))
+                # New trees follow the copied ones
+                sub.insert_tree(trees[1])
+                self.assertEqual(sub[2], trees[1])
+            with self.assertRaises(ValueError):
+                res.to_db(filename)
+            res = corpus.ListCorpus(trees).matching_trees(Q.label("NP"))
+            with res.to_db(os.path.join(tmp, "list.db")) as sub:
+                self.assertEqual(list(sub), [trees[0], trees[2]])
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.write("a.psd", "( (IP (NP (D a) (N dog)) (VBD barked)) (ID a.1))")
+        self.write("b.psd", "( (IP (NP (D the) (N cat)) (VBD meowed)) (ID b.1))\n" +
+                   "( (IP (NP (D a) (N bird)) (VBD sang)) (ID b.2))")
+        self.loader = loader.FileLoader(self.tmp.name)
+        self.d = db.CorpusDb()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, filename, contents):
+        with open(os.path.join(self.tmp.name, filename), "w") as fout:
+            fout.write(contents)
+
+    def count(self, table):
+        return self.d._connection.execute(sqlalchemy.sql.text("SELECT count(*) FROM " + table)).scalar()
+
+    def test_sync(self):
+        updated, removed = self.d.sync(self.loader)
+        self.assertEqual(sorted(updated), ["a.psd", "b.psd"])
+        self.assertEqual(len(self.d), 3)
+        self.assertEqual(self.d.sync(self.loader), ([], []))
+        self.assertEqual(len(self.d), 3)
+
+    def test_sync_changed(self):
+        self.d.sync(self.loader)
+        nodes = self.count("nodes")
+        self.write("a.psd", "( (IP (NP (D a) (N wolf)) (VBD howled)) (ID a.1))")
+        self.assertEqual(self.d.sync(self.loader), (["a.psd"], []))
+        self.assertEqual(len(self.d), 3)
+        self.assertEqual(self.count("nodes"), nodes)
+        self.assertEqual(self.d[2][1].text, "howled")
+        self.assertEqual(self.d[2].metadata.file, "a.psd")
+
+    def test_sync_removed(self):
+        self.d.sync(self.loader)
+        os.remove(os.path.join(self.tmp.name, "b.psd"))
+        self.assertEqual(self.d.sync(self.loader), ([], ["b.psd"]))
+        self.assertEqual(len(self.d), 1)
+        self.assertEqual(self.count("nodes"), 5)
+        self.assertEqual(self.count("dom"), 5 + 4 + 2)
+        self.assertEqual(self.count("files"), 1)
+
+    def test_texts(self):
+        years = {"a.psd": 1150, "b.psd": 1350}
+        self.loader = loader.FileLoader(self.tmp.name,
+                                        text_metadata=lambda f: {"YEAR": years[f]})
+        self.d.sync(self.loader)
+        texts = "SELECT name, year FROM texts ORDER BY name"
+        self.assertEqual(self.d._connection.execute(sqlalchemy.sql.text(texts)).fetchall(),
+                         [("a.psd", 1150), ("b.psd", 1350)])
+        self.assertEqual(self.d[1].metadata.year, 1350)
+        self.assertEqual(len(self.d.matching_trees(Q.in_text(year__gt=1200))), 2)
+        os.remove(os.path.join(self.tmp.name, "b.psd"))
+        self.d.sync(self.loader)
+        self.assertEqual(self.count("texts"), 1)
+        self.assertEqual(len(self.d.matching_trees(Q.in_text(year__gt=1200))), 0)
+
+    def test_ingest(self):
+        self.write("c.psd", "( (IP (NP (PRO it)) (VBD rained)) (ID c.1))")
+        files = ["a.psd", "b.psd", "c.psd"]
+        self.d.ingest(self.loader, files, processes=2, queue_size=1)
+        serial = db.CorpusDb()
+        for filename in files:
+            serial.insert_trees(self.loader.file_trees(filename))
+        self.assertEqual(self.d.roots, serial.roots)
+        self.assertEqual(list(self.d), list(serial))
+        for table in ("nodes", "dom", "sprec", "metadata"):
+            query = sqlalchemy.sql.text("SELECT * FROM %s ORDER BY 1, 2" % table)
+            self.assertEqual(self.d._connection.execute(query).fetchall(),
+                             serial._connection.execute(query).fetchall())
+        self.assertEqual(self.d.sync(self.loader), ([], []))
+
+    def test_loader_to_db(self):
+        d = self.loader.to_db(files=["a.psd", "b.psd"], batch_size=1)
+        self.assertEqual(list(d), list(self.loader.corpus(["a.psd", "b.psd"])))
+        self.assertEqual(d.sync(self.loader), ([], []))
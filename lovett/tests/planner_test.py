@@ -0,0 +1,144 @@
+import re
+import unittest
+
+from lovett.tree import parse as T
+import lovett.query as Q
+import lovett.db as db
+import lovett.planner as planner
+
+
+class PlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.d = db.CorpusDb()
+        self.d.insert_trees([
+            T("(IP (NP-SBJ (D a) (N dog)) (VBD chased) (NP-ACC (D the) (N cat)))"),
+            T("(IP (NP-SBJ (PRO it)) (VBD ran) (PP (P over) (NP (D the) (N fence))))"),
+            T("(IP (VBD ran))"),
+        ])
+
+    def optimize(self, query):
+        return planner.optimize(query, self.d)
+
+    def test_flatten(self):
+        q = self.optimize(Q.idoms(Q.label("D")) & (Q.idoms(Q.label("N")) & Q.doms(Q.label("D"))))
+        self.assertIsInstance(q, Q.Conjunction)
+        self.assertEqual(len(q.queries), 3)
+
+        q = self.optimize(Q.idoms(Q.label("D")) | (Q.doms(Q.label("N")) | Q.text("ran")))
+        self.assertIsInstance(q, Q.Disjunction)
+        self.assertEqual(len(q.queries), 3)
+
+        # Only chains of the same operator are flattened
+        q = self.optimize(Q.idoms(Q.label("D")) & Q.text("ran") | Q.text("barked"))
+        self.assertIsInstance(q, Q.Disjunction)
+        self.assertEqual(len(q.queries), 2)
+        self.assertEqual(planner.canonical(Q.label("D") & Q.text("ran") | Q.text("barked")),
+                         "((label(exact=False, label='D') & text(mode='exact', text='ran')) | "
+                         "text(mode='exact', text='barked'))")
+
+    def test_canonical(self):
+        self.assertEqual(planner.canonical(Q.label_set(["B", "A"])),
+                         planner.canonical(Q.label_set(["A", "B"])))
+        # The arguments are escaped, so these do not collide
+        self.assertNotEqual(planner.canonical(Q.text('a", mode="prefix')),
+                            planner.canonical(Q.text("a", mode="prefix")))
+        self.assertNotEqual(planner.canonical(Q.label("NP")),
+                            planner.canonical(Q.label("NP", exact=True)))
+        # Colorizing a query for display does not change its key
+        q = Q.label("IP") & Q.idoms(Q.text("ran"))
+        key = planner.canonical(q)
+        q.colorize()
+        self.assertTrue(hasattr(q.right.query, "idx"))
+        self.assertEqual(planner.canonical(q), key)
+
+    def test_dedupe(self):
+        q = self.optimize(Q.idoms(Q.label("D")) & Q.idoms(Q.label("D")))
+        self.assertEqual(str(q), str(Q.idoms(Q.label("D"))))
+
+    def test_merge_labels(self):
+        q = self.optimize(Q.label("NP") | Q.label("PP") | Q.label("VBD", exact=True))
+        self.assertIsInstance(q, Q.label_set)
+        self.assertEqual(q.labels, {"NP", "NP-SBJ", "NP-ACC", "PP", "VBD"})
+
+        q = self.optimize(Q.label("NP") & Q.dash_tag("SBJ"))
+        self.assertEqual(q.labels, {"NP-SBJ"})
+
+        q = self.optimize(Q.label("NP") & ~Q.dash_tag("SBJ"))
+        self.assertEqual(q.labels, {"NP", "NP-ACC"})
+
+        q = self.optimize(~Q.label("NP") & ~Q.label("IP"))
+        self.assertIsInstance(q, Q.Not)
+        self.assertIsInstance(q.fn, Q.label_set)
+
+    def test_merge_labels_limit(self):
+        rx = Q.label(re.compile("^N"))
+        old = Q.MAX_LABEL_EXPANSION
+        Q.MAX_LABEL_EXPANSION = 1
+        try:
+            q = self.optimize(rx | Q.label("VBD"))
+            self.assertIsInstance(q, Q.Disjunction)
+            self.assertIn(rx, q.queries)
+            q = self.optimize(rx & Q.label("NP", exact=True))
+            self.assertIsInstance(q, Q.Conjunction)
+            self.assertIn(rx, q.queries)
+            self.assertIn("REGEXP", str(q.sql(self.d).compile(self.d.engine)))
+            self.assertEqual(self.d.count_nodes(rx | Q.label("VBD")), 10)
+        finally:
+            Q.MAX_LABEL_EXPANSION = old
+        q = self.optimize(rx | Q.label("VBD"))
+        self.assertIsInstance(q, Q.label_set)
+
+    def test_order(self):
+        # NP-SBJ is rarer than IP, and the negation comes last
+        q = self.optimize(~Q.idoms(Q.label("PP")) & Q.label("IP") & Q.idoms(Q.label("NP-SBJ")))
+        self.assertIsInstance(q, Q.Conjunction)
+        self.assertEqual(str(q.queries[0]), str(Q.idoms(Q.label("NP-SBJ"))))
+        self.assertIsInstance(q.queries[-1], Q.Not)
+
+    def test_statistics(self):
+        self.assertEqual(self.d.label_counts()[self.d._label_ids["IP"]], 3)
+        self.d.insert_tree(T("(IP (VBD ran))"))
+        self.assertEqual(self.d.label_counts()[self.d._label_ids["IP"]], 4)
+
+    def test_equivalent(self):
+        queries = (Q.label("NP") | Q.label("PP"),
+                   Q.label("IP") & ~Q.idoms(Q.label("NP-SBJ")),
+                   Q.label("IP") & Q.idoms(Q.label("NP") & ~Q.dash_tag("SBJ")),
+                   Q.idoms(Q.text("the")) & Q.label("NP") & Q.label("NP"),
+                   ~Q.label("IP") & ~Q.label("NP") & ~Q.label("VBD") & Q.idoms(Q.label("D")),
+                   Q.doms(Q.label("N") | Q.text("ran")) | Q.label("PP"))
+        c = self.d.engine.connect()
+        for query in queries:
+            want = sorted(c.execute(query.sql(self.d)).fetchall())
+            got = sorted(c.execute(self.optimize(query).sql(self.d)).fetchall())
+            self.assertEqual(got, want, str(query))
+
+    def test_push_texts(self):
+        trees = [T("(IP (NP (N dog)) (VBD ran))") for _ in range(20)]
+        for i, t in enumerate(trees):
+            t.metadata.file = "%d.psd" % i
+            t.metadata.year = 1100 + 10 * i
+        self.d.insert_trees(trees)
+        texts = Q.in_text(year__lt=1120)
+        # The texts are more selective than the label, so the label is
+        # restricted to them, and the texts are checked before the
+        # structural filter
+        q = self.optimize(Q.idoms(Q.label("N")) & Q.idoms(Q.label("VBD")) & texts)
+        self.assertEqual(str(q.queries[0]),
+                         str(Q.idoms(Q.label_set({"N"}, texts=texts))))
+        self.assertEqual(str(q.queries[1]), str(texts))
+        # Conditions on texts are merged
+        q = self.optimize(Q.label("N") & Q.in_text(year__gte=1100) & texts)
+        self.assertEqual(str(q.queries[0].texts), "in_text(year__gte=1100, year__lt=1120)")
+        # A rare label is not restricted
+        q = self.optimize(Q.label("PP") & Q.in_text(year__gte=1100))
+        self.assertIsNone(q.queries[0].texts)
+        self.assertEqual(planner.estimate(texts, self.d), 8)
+
+        c = self.d.engine.connect()
+        for query in (Q.idoms(Q.label("N")) & texts,
+                      Q.label("NP") & Q.in_text(year__gte=1100) & texts,
+                      Q.doms(Q.label("N") | Q.text("ran")) & ~texts):
+            want = sorted(c.execute(query.sql(self.d)).fetchall())
+            got = sorted(c.execute(self.optimize(query).sql(self.d)).fetchall())
+            self.assertEqual(got, want, str(query))
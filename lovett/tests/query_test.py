@@ -1,9 +1,12 @@
 import unittest
 import re
 
+import sqlalchemy
+
 from lovett.tree import parse as T
 import lovett.query as Q
 import lovett.db as db
+import lovett.transform as transform
 from nose.plugins.skip import SkipTest
 from doctest import Example
 from lxml.doctestcompare import LXMLOutputChecker
@@ -346,6 +349,13 @@ class ISprecTest(QueryTest):
         self.do_all(self.l_oper, type(self).isprec_tests)
 
 
+def set_lemma(t):
+    for node in t.nodes():
+        if getattr(node, "text", None) == "hafði":
+            node.metadata.lemma = "hafa"
+    return t
+
+
 class TextTest(QueryTest):
     def setUp(self):
         self.q = Q.text("foo")
@@ -369,6 +379,108 @@ class TextTest(QueryTest):
                      ("(NP foo)", False),
                      ("(XP (N foo))", False)))
 
+    def test_modes(self):
+        tree = "(IP (NP-SBJ (PRO Ég)) (NP *T*-1) (VBD hafði) (NP (N Hunda)) (. .))"
+        tests = ((Q.text("hun", mode="prefix"), True),
+                 (Q.text("HUNDA", mode="fts"), True),
+                 (Q.text("hund", mode="fts"), False),
+                 (Q.text("hund*", mode="fts"), True),
+                 (Q.text("hafði"), True),
+                 (Q.text("Hafði"), False),
+                 # Empty categories are not words
+                 (Q.text("ég hafði", mode="fts"), True),
+                 (Q.text("ég haf"), False),
+                 (Q.text("ég haf", mode="prefix"), True),
+                 (Q.text("hafði ég", mode="fts"), False),
+                 (Q.text("lemma:hafa", mode="fts"), True),
+                 (Q.text("lemma:hafa hun", mode="prefix"), True),
+                 (Q.text("lemma:hund", mode="prefix"), False))
+        for q, result in tests:
+            self.do_one(Q.doms(q), tree, result, set_lemma)
+        self.assertEqual(str(Q.text("hun", mode="prefix")), "text(\"hun\", mode=\"prefix\")")
+        self.assertRaises(ValueError, Q.text, "hun", mode="regex")
+        self.assertRaises(ValueError, Q.text, "Bob's", mode="fts")
+
+    def test_without_fts(self):
+        t = set_lemma(T("(IP (NP-SBJ (PRO Ég)) (VBD hafði) (NP (N Hunda)))"))
+        d = db.CorpusDb()
+        d.insert_tree(t)
+        d.has_fts = False
+        for q in (Q.text("hun", mode="prefix"), Q.text("lemma:hafa hun*", mode="fts")):
+            self.assertEqual(d.count_nodes(q), 1)
+
+
+def set_year(t):
+    t.metadata.year = 1150
+    t.metadata.alt_ortho = "dogge"
+    return t
+
+
+class HasMetadataTest(QueryTest):
+    def test_str(self):
+        self.assertEqual(str(Q.has_metadata("year", 1150)), "has_metadata(\"YEAR\", 1150)")
+        self.assertEqual(str(Q.has_metadata("year", between=(1100, None))),
+                         "has_metadata(\"YEAR\", between=(1100, None))")
+        self.assertEqual(str(Q.lemma("dog", prefix=True)), "lemma(\"dog\", prefix=True)")
+
+    def test_has_metadata(self):
+        tree = "(IP (N dog))"
+        tests = ((Q.has_metadata("year"), True),
+                 (Q.has_metadata("alt-ortho"), True),
+                 (Q.has_metadata("lemma"), False),
+                 (Q.has_metadata("year", 1150), True),
+                 (Q.has_metadata("year", "1150"), True),
+                 (Q.has_metadata("year", 1151), False),
+                 (Q.has_metadata("year", {1066, 1150}), True),
+                 (Q.has_metadata("year", between=(1100, 1200)), True),
+                 (Q.has_metadata("year", between=(1150, None)), True),
+                 (Q.has_metadata("year", between=(None, 1149)), False),
+                 (Q.has_metadata("alt_ortho", "dog", prefix=True), True),
+                 (Q.has_metadata("alt_ortho", "doge", prefix=True), False),
+                 (Q.has_metadata("alt_ortho", between=(0, None)), False))
+        for q, result in tests:
+            self.do_one(q, tree, result, set_year)
+
+
+def set_text(t):
+    t.metadata.file = "1350.text.nar-sag.psd"
+    t.metadata.year = 1350
+    t.metadata.genre = "nar"
+    return t
+
+
+class InTextTest(QueryTest):
+    def test_str(self):
+        self.assertEqual(str(Q.in_text(year__between=(1300, 1500), genre="nar")),
+                         "in_text(genre=\"nar\", year__between=(1300, 1500))")
+        self.assertEqual(str(Q.in_text(genre__in=["rel", "nar"])),
+                         "in_text(genre__in={\"nar\", \"rel\"})")
+        self.assertRaises(ValueError, Q.in_text, century=14)
+        self.assertRaises(ValueError, Q.in_text, year__near=1300)
+
+    def test_in_text(self):
+        tree = "(IP (NP (N dog)) (VBD barked))"
+        tests = ((Q.in_text(), True),
+                 (Q.in_text(year=1350), True),
+                 (Q.in_text(year__between=(1300, 1500)), True),
+                 (Q.in_text(year__between=(1400, None)), False),
+                 (Q.in_text(year__lt=1350), False),
+                 (Q.in_text(year__lte=1350, genre="nar"), True),
+                 (Q.in_text(year__gt=1300, genre="rel"), False),
+                 (Q.in_text(genre__in={"nar", "rel"}), True),
+                 (Q.in_text(author="Snorri"), False),
+                 (Q.in_text(file="1350.text.nar-sag.psd"), True),
+                 (Q.label("IP") & Q.in_text(year__gte=1350), True),
+                 (Q.idoms(Q.label("NP")) & ~Q.in_text(year__gte=1350), False),
+                 (Q.label("IP") & ~Q.in_text(genre="rel"), True))
+        for q, result in tests:
+            self.do_one(q, tree, result, set_text)
+
+    def test_without_text(self):
+        # Trees without a file have no text metadata
+        self.do_one(Q.in_text(year__gt=0), "(IP (N dog))", False)
+        self.do_one(Q.label("IP") & ~Q.in_text(year__gt=0), "(IP (N dog))", True)
+
 
 class QueryDbTest(unittest.TestCase):
     def setUp(cls):
@@ -392,10 +504,39 @@ class QueryDbTest(unittest.TestCase):
         self.assertEqual(len(res), 1)
         self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0][0])
 
-    def test_label_misc(self):
+    def test_label_regex(self):
+        l = Q.label(re.compile("^N.*-"))
+        c = self.d.engine.connect()
+        res = c.execute(l.sql(self.d).order_by(self.d.nodes.c.rowid)).fetchall()
+        self.assertEqual(len(res), 2)
+        self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0][2])
+        self.assertEqual(self.d._reconstitute(res[1][0]), self.d[0][3][1])
+
         l = Q.label(re.compile("foo"))
-        self.assertRaises(Exception, lambda: l.sql(None))
+        self.assertEqual(c.execute(l.sql(self.d)).fetchall(), [])
+
+    def test_label_regex_fallback(self):
+        l = Q.label(re.compile("^n.*-", re.IGNORECASE))
+        old = Q.MAX_LABEL_EXPANSION
+        Q.MAX_LABEL_EXPANSION = 0
+        try:
+            sql = l.sql(self.d)
+        finally:
+            Q.MAX_LABEL_EXPANSION = old
+        self.assertIn("REGEXP", str(sql.compile(self.d.engine)))
+        c = self.d.engine.connect()
+        res = c.execute(sql.order_by(self.d.nodes.c.rowid)).fetchall()
+        self.assertEqual(len(res), 2)
+        self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0][2])
+        self.assertEqual(self.d._reconstitute(res[1][0]), self.d[0][3][1])
 
+    def test_label_regex_cache(self):
+        rx = re.compile("^NP")
+        self.assertEqual(len(self.d.matching_label_ids(rx)), 3)
+        self.d.insert_tree(T("(IP (NP-SBJ (PRO it)))"))
+        self.assertEqual(len(self.d.matching_label_ids(rx)), 4)
+
+    def test_label_misc(self):
         l = Q.label("NP%")
         self.assertRaises(Exception, lambda: l.sql(None))
 
@@ -418,6 +559,13 @@ class QueryDbTest(unittest.TestCase):
         self.assertEqual(len(res), 1)
         self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0][3])
 
+    def test_dash_tag_multiple(self):
+        l = Q.dash_tag("X-Y")
+        c = self.d.engine.connect()
+        res = c.execute(l.sql(self.d)).fetchall()
+        self.assertEqual(len(res), 1)
+        self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0][3])
+
     def test_and(self):
         l = Q.dash_tag("ACC")
         l2 = Q.label("NP")
@@ -454,3 +602,54 @@ class QueryDbTest(unittest.TestCase):
         res = c.execute(dq.sql(self.d)).fetchall()
         self.assertEqual(len(res), 1)
         self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0])
+
+    def test_not(self):
+        c = self.d.engine.connect()
+        l = Q.label("NP")
+        res = c.execute((~l).sql(self.d)).fetchall()
+        nodes = list(self.d[0].nodes())
+        self.assertEqual(len(res), len([n for n in nodes if not l.match_tree(n)]))
+        self.assertEqual(len(c.execute((~~l).sql(self.d)).fetchall()), 3)
+
+    def test_and_not(self):
+        c = self.d.engine.connect()
+        res = c.execute((Q.label("NP") & ~Q.idoms(Q.label("N"))).sql(self.d)).fetchall()
+        self.assertEqual(len(res), 1)
+        self.assertEqual(self.d._reconstitute(res[0][0]), self.d[0][2])
+        res = c.execute((~Q.idoms(Q.label("N")) & Q.label("NP")).sql(self.d)).fetchall()
+        self.assertEqual(len(res), 1)
+        res = c.execute((Q.label("IP") & ~Q.idoms(Q.label("VBD"))).sql(self.d)).fetchall()
+        self.assertEqual(len(res), 0)
+        res = c.execute((~Q.label("NP") & ~Q.dash_tag("ACC")).sql(self.d)).fetchall()
+        self.assertEqual(len(res), len(list(self.d[0].nodes())) - 3)
+
+    def test_wrapped_not(self):
+        c = self.d.engine.connect()
+        q = Q.label("NP") & Q.idoms(~Q.label("D"))
+        res = c.execute(q.sql(self.d)).fetchall()
+        self.assertEqual(len(res), 3)
+        q = Q.label("PP") & Q.isprec(~Q.label("NP"))
+        self.assertEqual(len(c.execute(q.sql(self.d)).fetchall()), 0)
+        q = Q.label("VBD") & Q.isprec(~Q.label("PP"))
+        self.assertEqual(len(c.execute(q.sql(self.d)).fetchall()), 1)
+
+    def test_lemma(self):
+        d = db.CorpusDb()
+        t = T("(IP (NP (D a-a) (N dogs-dog)) (VBD chased-chase) (NP (N doggies-doggy)))")
+        transform.icepahc_lemma(t)
+        d.insert_tree(t)
+        c = d.engine.connect()
+        res = c.execute(Q.lemma("dog").sql(d)).fetchall()
+        self.assertEqual(len(res), 1)
+        self.assertEqual(d._reconstitute(res[0][0]), d[0][0][1])
+        res = c.execute(Q.lemma("dog", prefix=True).sql(d)).fetchall()
+        self.assertEqual(len(res), 2)
+        res = c.execute(Q.has_metadata("lemma", {"a", "chase"}).sql(d)).fetchall()
+        self.assertEqual(len(res), 2)
+
+    def test_metadata_index(self):
+        c = self.d.engine.connect()
+        for q in (Q.lemma("dog"), Q.has_metadata("year", between=(1100, 1200))):
+            plan = c.execute(sqlalchemy.text("EXPLAIN QUERY PLAN " + str(
+                q.sql(self.d).compile(self.d.engine, compile_kwargs={"literal_binds": True})))).fetchall()
+            self.assertIn("COVERING INDEX", plan[0][-1])
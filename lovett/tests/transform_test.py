@@ -47,3 +47,10 @@ class TransformTest(unittest.TestCase):
         t = T("(N-X-1 foo)")
         trans.icepahc_case(t)
         self.assertIsNone(t.metadata.case)
+
+    def test_icepahc_text_metadata(self):
+        self.assertEqual(trans.icepahc_text_metadata("1150.firstgrammar.sci-lin.psd"),
+                         {"YEAR": 1150, "GENRE": "sci"})
+        self.assertEqual(trans.icepahc_text_metadata("finished/1350.bandamennM.nar-sag.psd"),
+                         {"YEAR": 1350, "GENRE": "nar"})
+        self.assertEqual(trans.icepahc_text_metadata("notes.txt"), {})
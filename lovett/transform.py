@@ -12,6 +12,7 @@ The following corpora are supported by the following functions:
   * `icepahc_case`
   * `icepahc_lemma`
   * `icepahc_year`
+  * `icepahc_text_metadata`
 
 * The PPCHE (in general)
 
@@ -117,6 +118,31 @@ def icepahc_year(tree):
     """
     tree.metadata.year = int(tree.metadata.file[0:4])
 
+
+def icepahc_text_metadata(filename):
+    """Return the text-level metadata of an IcePaHC file.
+
+    IcePaHC file names have the form ``YEAR.TITLE.GENRE-SUBGENRE.psd``, for
+    example ``1150.firstgrammar.sci-lin.psd``.  This function is meant to be
+    passed as the ``text_metadata`` argument of a `lovett.loader.Loader`.
+
+    Args:
+        filename (str): The name of the file.
+
+    Returns:
+        dict: The ``YEAR`` (an integer) and ``GENRE`` of the text, as far as
+        they can be read from the file name.
+
+    """
+    parts = filename.split("/")[-1].split(".")
+    metadata = {}
+    if parts[0].isdigit():
+        metadata["YEAR"] = int(parts[0])
+    if len(parts) > 3:
+        metadata["GENRE"] = parts[2].split("-")[0]
+    return metadata
+
+
 def icepahc_word_splits(tree):
     """Convert IcePaHC word splits to proper metadata.
 
@@ -286,6 +286,52 @@ def _metadata_str_to_py(value):
             return value
 
 
+def _metadata_py_to_num(value):
+    """Return the integer value of a metadata value, if it has one.
+
+    Integers are returned unmodified, and strings which `_metadata_str_to_py`
+    would convert into integers are converted.  Other values (including
+    booleans) have no integer value.  Neither do integers too large to be
+    stored in a database integer column.
+
+    Args:
+        value: The value to convert.
+
+    Returns:
+        int or None
+
+    """
+    if isinstance(value, str):
+        value = _metadata_str_to_py(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    if not -2 ** 63 <= value < 2 ** 63:
+        return None
+    return value
+
+
+def _random_order(length, rng):
+    """Generate the integers ``0 ... length - 1`` in a random order.
+
+    The permutation is drawn lazily (by a Fisher-Yates shuffle which only
+    records the positions it has swapped), so taking the first k integers
+    costs O(k) rather than O(length).
+
+    Args:
+        length (int): The number of integers.
+        rng (random.Random): The source of randomness.
+
+    Yields:
+        int
+
+    """
+    swapped = {}
+    for i in range(length):
+        j = rng.randrange(i, length)
+        yield swapped.get(j, j)
+        swapped[j] = swapped.pop(i, i)
+
+
 def _is_ich(idx, node):
     return is_leaf(node) and node.text == "*ICH*" and node.metadata.index == idx
 